@@ -0,0 +1,166 @@
+'''
+    Chunked columnar tables scrapers write their output to. A table is a directory of .npz chunks, each holding one array per column,
+    and a manifest.json listing the chunks and column types. Kept in sync with data-processing/columnar.py.
+'''
+
+from pandas.api.types import union_categoricals
+import numpy as np
+import pandas as pd
+import json
+import time
+import os
+
+
+class ChunkWriter:
+    '''
+        Writes lists of dicts to a table one chunk at a time. Columns are given as dict mapping column name to numpy dtype, or to
+        str for string columns, which are stored dictionary encoded as int32 codes into the chunk's unique values.
+        The manifest is rewritten after every chunk, so a table is readable up to its last complete chunk if scraping is interrupted.
+        Each chunk can carry info recorded in the manifest alongside it, which makes it a checkpoint of whatever produced the chunk.
+    '''
+
+    def __init__(self, directory, columns, append=False):
+        self.directory = directory
+        self.columns = columns
+
+        # Appending to existing table if asked to, otherwise starting table over like opening a csv in write mode would
+        if append and has_table(directory):
+            self.manifest = read_manifest(directory)
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.npz') or file_name == 'manifest.json':
+                os.remove(os.path.join(directory, file_name))
+
+        self.manifest = {
+            'version': 1,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'columns': {name: 'str' if dtype is str else np.dtype(dtype).str for name, dtype in columns.items()},
+            'chunks': [],
+            'rows': 0
+        }
+        self.save_manifest()
+
+    def write(self, records, info=None):
+        '''
+            Takes in list of dicts, each with a value for every column, and optional dict of JSON serializable info to record with chunk.
+            Saves records as table's next chunk. A chunk with info but no records is only recorded in the manifest.
+        '''
+
+        if not records:
+            if info is not None:
+                self.manifest['chunks'].append({'file': None, 'rows': 0, 'info': info})
+                self.save_manifest()
+            return
+
+        arrays = {}
+        for (name, dtype) in self.columns.items():
+            if dtype is str:
+                (codes, values) = pd.factorize(pd.Series([record[name] for record in records], dtype=object))
+                arrays[f'{name}.codes'] = codes.astype(np.int32)
+                arrays[f'{name}.values'] = np.array(values, dtype=str)
+            else:
+                arrays[name] = np.array([record[name] for record in records], dtype=dtype)
+
+        file_name = f'part-{len(self.manifest["chunks"]):05d}.npz'
+        np.savez_compressed(os.path.join(self.directory, file_name), **arrays)
+
+        self.manifest['chunks'].append({'file': file_name, 'rows': len(records), 'info': info})
+        self.manifest['rows'] += len(records)
+        self.save_manifest()
+
+    def save_manifest(self):
+        '''
+            Saves manifest, replacing it in one step so readers never see it half written.
+        '''
+
+        path = os.path.join(self.directory, 'manifest.json')
+        with open(f'{path}.tmp', 'w') as fh:
+            json.dump(self.manifest, fh, indent=4)
+        os.replace(f'{path}.tmp', path)
+
+
+def has_table(directory):
+    '''
+        Takes in string representing directory.
+        Returns boolean indicating whether directory holds a table.
+    '''
+
+    return os.path.exists(os.path.join(directory, 'manifest.json'))
+
+
+def read_manifest(directory):
+    '''
+        Takes in string representing directory of table.
+        Returns dict representing table's manifest.
+    '''
+
+    with open(os.path.join(directory, 'manifest.json')) as fh:
+        return json.load(fh)
+
+
+def iter_chunks(directory, columns=None, start=0, stop=None):
+    '''
+        Takes in string representing directory of table, optional list of columns to read (defaults to every column), and optional
+        positions in manifest of first chunk to read and chunk to stop before.
+        Yields pandas.DataFrame object of each chunk in turn, with the columns asked for, so a table can be processed without holding
+        all of it in memory. String columns are categoricals of the chunk's own values.
+    '''
+
+    manifest = read_manifest(directory)
+    columns = columns if columns is not None else list(manifest['columns'])
+
+    for chunk in manifest['chunks'][start:stop]:
+        if chunk['file'] is None:
+            continue
+
+        data = {}
+        with np.load(os.path.join(directory, chunk['file'])) as arrays:
+            for name in columns:
+                if manifest['columns'][name] == 'str':
+                    data[name] = pd.Categorical.from_codes(arrays[f'{name}.codes'], arrays[f'{name}.values'])
+                else:
+                    data[name] = arrays[name]
+
+        yield pd.DataFrame(data)
+
+
+def read_table(directory, columns=None):
+    '''
+        Takes in string representing directory of table and optional list of columns to read (defaults to every column).
+        Returns pandas.DataFrame object with the columns asked for, in the order asked for. Only those columns are read from disk.
+        String columns are returned as categoricals, so each distinct string is held once.
+    '''
+
+    manifest = read_manifest(directory)
+    columns = columns if columns is not None else list(manifest['columns'])
+    chunks = list(iter_chunks(directory, columns))
+
+    data = {}
+    for name in columns:
+        if manifest['columns'][name] == 'str':
+            data[name] = union_categoricals([chunk[name] for chunk in chunks]) if chunks else pd.Categorical([])
+        else:
+            data[name] = np.concatenate([chunk[name].to_numpy() for chunk in chunks]) if chunks else np.array([], dtype=manifest['columns'][name])
+
+    return pd.DataFrame(data)
+
+
+def convert_csv(csv_path, directory, columns, chunksize=1000000):
+    '''
+        Takes in string representing path of csv written by appending DataFrame chunks, string representing directory to write table
+        to, dict mapping column name to dtype as ChunkWriter takes, and number of rows per chunk.
+        Rows whose numeric columns don't parse, like the headers repeated before every appended chunk, are dropped.
+        Returns number of rows written.
+    '''
+
+    writer = ChunkWriter(directory, columns)
+    numeric = [name for name, dtype in columns.items() if dtype is not str]
+
+    for df in pd.read_csv(csv_path, usecols=list(columns), dtype=str, chunksize=chunksize):
+        for name in numeric:
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+        writer.write(df.dropna(subset=numeric).to_dict('records'))
+
+    return writer.manifest['rows']
@@ -0,0 +1,133 @@
+'''
+    Pulls the few fields scrapers need out of Letterboxd pages with lxml, without building a BeautifulSoup tree.
+    Kept in sync with data-processing/extract.py.
+'''
+
+from lxml import etree
+
+
+# Parser is reused for every page. Pages are fed in as UTF-8 bytes so encoding declarations in the html are ignored, as they are
+# when BeautifulSoup is given a string.
+parser = etree.HTMLParser(encoding='utf-8')
+
+
+def _class_xpath(tag, class_name):
+    # Selects tag elements with class_name among their classes, like BeautifulSoup's class_ argument does
+    return etree.XPath(f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]")
+
+
+poster_containers = _class_xpath('li', 'poster-container')
+paginate_pages = _class_xpath('li', 'paginate-page')
+pagination = _class_xpath('div', 'pagination')
+route_watches = _class_xpath('li', 'js-route-watches')
+person_summaries = _class_xpath('div', 'person-summary')
+popular_posters = etree.XPath("//li[normalize-space(@class) = 'listitem poster-container']")
+genre_tab = etree.XPath("//div[@id = 'tab-genres']")
+
+
+def parse(html):
+    '''
+        Takes in string representing html of page.
+        Returns lxml element representing root of page. Empty pages give an empty root rather than failing to parse.
+    '''
+
+    root = etree.fromstring(html.encode(), parser)
+
+    return root if root is not None else etree.Element('html')
+
+
+def num_pages(page):
+    '''
+        Takes in parsed page of a paginated list.
+        Returns integer representing number of pages in list, 1 if page has no pagination.
+    '''
+
+    pages = paginate_pages(page)
+
+    return int(pages[-1].find('.//a').xpath('string()')) if pages else 1
+
+
+def has_pagination(page):
+    '''
+        Takes in parsed page of a paginated list.
+        Returns boolean indicating whether page has pagination, which only fully rendered pages do.
+    '''
+
+    return bool(pagination(page))
+
+
+def poster_films(page):
+    '''
+        Takes in parsed page of a member's films.
+        Yields tuple of film href, film title, and rating (None if member didn't rate film) for each film on page, in order.
+        Rating is the number in the rating span's last class, so films that were liked but not rated give '16'.
+    '''
+
+    for film in poster_containers(page):
+        rating_span = film.find('.//p').find('.//span')
+        rating = rating_span.get('class').split()[-1].split('-')[1] if rating_span is not None else None
+
+        film_info = film.find('.//div')
+        yield (film_info.attrib['data-target-link'], film_info.find('.//img').attrib['alt'], rating)
+
+
+def poster_links(page):
+    '''
+        Takes in parsed page of a member's films or watchlist.
+        Yields href of each film on page, in order.
+    '''
+
+    for film in poster_containers(page):
+        yield film.find('.//div').attrib['data-target-link']
+
+
+def popular_films(page):
+    '''
+        Takes in parsed page of Letterboxd's popular film list.
+        Yields tuple of film title and film href for each film on page, in order.
+    '''
+
+    for film in popular_posters(page):
+        film_info = film.find('.//div')
+        yield (film_info.find('.//img').attrib['alt'], film_info.attrib['data-target-link'])
+
+
+def viewers(page):
+    '''
+        Takes in parsed members page of a film.
+        Returns integer representing number of members who've watched film.
+    '''
+
+    watches = route_watches(page)
+
+    return int(watches[0].find('.//a').attrib['title'].split()[0].replace(',', ''))
+
+
+def genres(page):
+    '''
+        Takes in parsed genres page of a film.
+        Returns list of text of every link in page's genres tab, in order.
+    '''
+
+    tab = genre_tab(page)
+
+    return [str(link.xpath('string()')) for link in tab[0].iter('a')]
+
+
+def title(page):
+    '''
+        Takes in parsed page.
+        Returns string representing text of page's title.
+    '''
+
+    return str(page.find('.//title').xpath('string()'))
+
+
+def member_links(page):
+    '''
+        Takes in parsed page of a list of members.
+        Yields href of each member on page, in order.
+    '''
+
+    for member in person_summaries(page):
+        yield member.find('.//a').attrib['href']
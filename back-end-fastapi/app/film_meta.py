@@ -0,0 +1,50 @@
+'''
+    Lookups into the film metadata store built by data-processing/film_scraper.py's enrichment pass.
+'''
+
+import numpy as np
+
+
+class FilmMetadata:
+    '''
+        Holds number of viewers and genres of the films the model knows, so filters can be applied without scraping.
+    '''
+
+    def __init__(self, links, viewers, genre_masks, genre_names):
+        self._rows = {link: row for row, link in enumerate(links.tolist())}
+        self._viewers = viewers
+        self._genre_masks = genre_masks
+        self._genre_names = genre_names.tolist()
+        self.n_films = len(self._rows)
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Takes in string representing path of .npz film metadata store.
+            Returns FilmMetadata object.
+        '''
+
+        with np.load(path) as store:
+            return cls(store['links'], store['viewers'], store['genres'], store['genre_names'])
+
+    def lookup(self, film_link, filters):
+        '''
+            Takes in string representing film href and dict of filters to apply.
+            Returns dict with film's number of viewers and/or genres, whichever filters dict calls for, in the same form
+            scraping.scrape_pred_data returns them. Returns None if store doesn't have everything the filters need.
+        '''
+
+        # Films enrichment pass failed to scrape are stored with -1 viewers. Films stored with no genres really have none.
+        row = self._rows.get(film_link)
+        if row is None or self._viewers[row] < 0:
+            return None
+
+        film_info = {}
+        if 'Popularity' in filters:
+            film_info['viewers'] = int(self._viewers[row])
+
+        if 'Genre' in filters:
+            mask = int(self._genre_masks[row])
+            film_info['genres'] = [genre for i, genre in enumerate(self._genre_names) if mask >> i & 1]
+
+        return film_info
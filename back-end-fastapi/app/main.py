@@ -1,10 +1,48 @@
-from . import use_model
-from fastapi import FastAPI, HTTPException
+from . import use_model, scraping, metrics
+from .registry import ModelRegistry
+from fastapi import FastAPI, HTTPException, Depends, Request
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from contextlib import asynccontextmanager
+import aiohttp
+import asyncio
 import uvicorn
+import uuid
+import time
+import os
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    # Loading model and data once per process rather than on every request, from MODEL_DIR and MODEL_DATA_DIR if they're set
+    with metrics.span('model_load'):
+        app.state.registry = ModelRegistry.load(os.environ.get('MODEL_DIR', 'app/pickles'), os.environ.get('MODEL_DATA_DIR', 'app/data'))
+    metrics.log('model_loaded', **app.state.registry.stats())
+
+    # One pooled session for every request to Letterboxd, so connections stay warm and concurrency is capped process-wide
+    app.state.session = scraping.create_session()
+
+    # Sharing metrics with other worker processes, if METRICS_DIR is set
+    snapshots = asyncio.create_task(metrics.write_snapshots()) if metrics.metrics_dir else None
+
+    yield
+
+    if snapshots is not None:
+        snapshots.cancel()
+        await asyncio.gather(snapshots, return_exceptions=True)
+    await app.state.session.close()
+
+
+def get_registry(request: Request):
+    return request.app.state.registry
+
+
+def get_session(request: Request):
+    return request.app.state.session
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -20,15 +58,66 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Paths metrics are labelled with, every other path counts as 'other' so unknown paths can't add label values
+instrumented_paths = {'/api/', '/metrics'}
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    # Giving each request an id, or keeping the one a proxy gave it, which every log line written while serving it carries. Once it's
+    # served, its time is recorded and what it spent it on is logged.
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+    metrics.request_id.set(request_id)
+    stats = {'stages': {}}
+    metrics.request_stats.set(stats)
+
+    path = request.url.path if request.url.path in instrumented_paths else 'other'
+    status = 500
+    t0 = time.perf_counter()
+
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers['X-Request-ID'] = request_id
+        return response
+
+    finally:
+        seconds = time.perf_counter() - t0
+        metrics.requests.inc(path=path, status=status)
+        metrics.request_seconds.observe(seconds, path=path)
+
+        if path != '/metrics':
+            metrics.log(
+                'request',
+                method=request.method,
+                path=request.url.path,
+                query=dict(request.query_params),
+                status=status,
+                seconds=round(seconds, 4),
+                stages={stage: round(stage_seconds, 4) for stage, stage_seconds in stats['stages'].items()},
+                letterboxd_requests=stats.get('letterboxd_requests', 0),
+                cache_hits=stats.get('cache_hits', 0)
+            )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 @app.get("/api/")
-async def get_recs(users: str, excludeWatchlist: str, popFilter: str, genreFilters: str):
+async def get_recs(users: str, excludeWatchlist: str, popFilter: str, genreFilters: str, registry: ModelRegistry = Depends(get_registry), session: aiohttp.ClientSession = Depends(get_session)):
+    # Blank usernames (e.g. "a,,b" or just ",") are dropped, but at least one real one is needed to recommend for
+    if not any(user.strip() for user in users.split(',')):
+        raise HTTPException(status_code=400, detail='users must include at least one Letterboxd username')
+
     excludeWatchlist = excludeWatchlist.capitalize()
     genreFilters = genreFilters.split(',') if genreFilters else []
     blended = True if len(users.split(',')) > 1 else False
   
     parameters = {'users': users, 'excludeWatchlist': excludeWatchlist, 'popFilter': popFilter, 'genreFilters': genreFilters, 'blended': blended}
 
-    return await use_model.main(parameters)
+    return await use_model.main(parameters, registry, session)
 
 
 if __name__ == '__main__':
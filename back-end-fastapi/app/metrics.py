@@ -0,0 +1,245 @@
+'''
+    Counters, histograms and per-request timing spans for the API, exposed in Prometheus' text format at /metrics, plus structured
+    JSON logs tagged with the id of the request they belong to.
+'''
+
+import contextlib
+import asyncio
+import contextvars
+import json
+import time
+import glob
+import os
+
+
+# Id of request being served and dict of what it's spent time on, set by main.py's middleware for each request. Tasks a request
+# starts inherit both, so spans and counts from concurrent scrapes land on the right request.
+request_id = contextvars.ContextVar('request_id', default=None)
+request_stats = contextvars.ContextVar('request_stats', default=None)
+
+# Every metric, in the order they're exposed
+registry = []
+
+# Seconds bounds of latency histograms' buckets
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+
+class Counter:
+    '''
+        Count that only goes up, kept separately for each combination of values of its labels.
+    '''
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        '''
+            Returns list of tuples of sample name, dict of labels, and value for every combination of labels counted so far.
+        '''
+
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class CallbackCounter:
+    '''
+        Counter whose values are read from a function returning a dict mapping a label's values to counts when metrics are
+        collected, for counts another object keeps already, like RetryPolicy.stats.
+    '''
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelname, function):
+        self.name = name
+        self.help = help
+        self.labelname = labelname
+        self.function = function
+        registry.append(self)
+
+    def samples(self):
+        return [(self.name, {self.labelname: key}, value) for key, value in self.function().items()]
+
+
+class Histogram:
+    '''
+        Counts of observed values falling at or under each bucket bound, with their sum and count, kept separately for each
+        combination of values of its labels.
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        if key not in self._values:
+            self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+
+        counts = self._values[key]
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self):
+        samples = []
+        for (key, counts) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            for (bound, count) in zip(self.buckets, counts):
+                samples.append((f'{self.name}_bucket', {**labels, 'le': repr(float(bound))}, count))
+            samples.append((f'{self.name}_bucket', {**labels, 'le': '+Inf'}, counts[-1]))
+            samples.append((f'{self.name}_sum', labels, counts[-2]))
+            samples.append((f'{self.name}_count', labels, counts[-1]))
+
+        return samples
+
+
+requests = Counter('api_requests_total', 'Requests served, by path and response status.', ('path', 'status'))
+request_seconds = Histogram('api_request_seconds', 'Seconds taken to serve a request, by path.', ('path',))
+stage_seconds = Histogram('api_stage_seconds', 'Seconds spent in each stage of serving recommendations, and loading the model.', ('stage',))
+letterboxd_requests = Counter(
+    'letterboxd_requests_total',
+    'Requests for Letterboxd pages, by kind of page and response status, or "cached" for ones served from the response cache.',
+    ('page', 'status')
+)
+letterboxd_seconds = Histogram('letterboxd_request_seconds', 'Seconds taken by requests to Letterboxd that weren\'t cached, by kind of page.', ('page',))
+
+
+@contextlib.contextmanager
+def span(stage):
+    '''
+        Takes in name of stage. Times the block it wraps, observing it in stage_seconds and adding it to current request's stages.
+    '''
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        stage_seconds.observe(seconds, stage=stage)
+
+        stats = request_stats.get()
+        if stats is not None:
+            stats['stages'][stage] = stats['stages'].get(stage, 0) + seconds
+
+
+def count_request(key, amount=1):
+    '''
+        Takes in name of count and amount to add. Adds amount to count in current request's stats, if a request is being served.
+    '''
+
+    stats = request_stats.get()
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + amount
+
+
+def log(event, **fields):
+    '''
+        Takes in name of event and keyword arguments describing it.
+        Prints event as a line of JSON with the time and id of the request being served, so logs can be searched and joined up by request.
+    '''
+
+    line = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'event': event, 'request_id': request_id.get(), **fields}
+    print(json.dumps(line, default=str), flush=True)
+
+
+def snapshot():
+    '''
+        Returns list of dicts describing every metric and its current samples, JSON serializable.
+    '''
+
+    return [
+        {'name': metric.name, 'type': metric.type, 'help': metric.help, 'samples': [list(sample) for sample in metric.samples()]}
+        for metric in registry
+    ]
+
+
+# When the API runs several worker processes, each writes its snapshot to METRICS_DIR every second and /metrics sums every worker's,
+# so a scrape sees the whole service no matter which worker answers it
+metrics_dir = os.environ.get('METRICS_DIR', '')
+
+
+def write_snapshot():
+    '''
+        Writes this process's snapshot to METRICS_DIR, if it's set.
+    '''
+
+    if not metrics_dir:
+        return
+
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = f'{metrics_dir}/{os.getpid()}.json'
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(snapshot(), fh)
+    os.replace(f'{path}.tmp', path)
+
+
+async def write_snapshots(interval=1.0):
+    '''
+        Takes in number of seconds between snapshots. Writes this process's snapshot to METRICS_DIR every interval seconds until
+        cancelled, and once more when it is.
+    '''
+
+    try:
+        while True:
+            write_snapshot()
+            await asyncio.sleep(interval)
+    finally:
+        write_snapshot()
+
+
+def render():
+    '''
+        Returns string of every metric in Prometheus' text exposition format, summed over every worker's snapshot in METRICS_DIR if
+        it's set. Workers that have exited stay in the sums, so counts never go down.
+    '''
+
+    if metrics_dir:
+        write_snapshot()
+        snapshots = []
+        for path in glob.glob(f'{metrics_dir}/*.json'):
+            with open(path) as fh:
+                snapshots.append(json.load(fh))
+    else:
+        snapshots = [snapshot()]
+
+    # Summing samples with the same name and labels across workers, keeping metrics in the order this process registered them
+    totals = {metric.name: {} for metric in registry}
+    for worker in snapshots:
+        for metric in worker:
+            metric_totals = totals.setdefault(metric['name'], {})
+            for (name, labels, value) in metric['samples']:
+                key = (name, tuple(labels.items()))
+                metric_totals[key] = metric_totals.get(key, 0) + value
+
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for ((name, labels), value) in totals[metric.name].items():
+            lines.append(f'{name}{_format_labels(dict(labels))} {value}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,113 @@
+'''
+    Single-file bundle of everything the API serves recommendations with: item factors and biases, film hrefs and titles, popularity
+    ranks and the retrieval index, stored as flat arrays behind a versioned header. The API memory-maps it read-only, so every worker
+    process shares one copy of the arrays in the page cache. Kept in sync with data-processing/model_bundle.py.
+'''
+
+import numpy as np
+import struct
+import json
+import mmap
+import os
+
+
+magic = b'LBXDRECS'
+version = 1
+
+# Arrays start on 64 byte boundaries so they're aligned for vectorized reads
+alignment = 64
+
+# Rank given to films missing from the popular film list, so they're never treated as too popular
+unranked = np.iinfo(np.int32).max
+
+
+def pack_strings(strings):
+    '''
+        Takes in list of strings.
+        Returns tuple of numpy uint8 array of the strings' UTF-8 bytes back to back and numpy int64 array of offsets where each string
+        starts, with the total length appended.
+    '''
+
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+
+    return (np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+
+def write_bundle(path, arrays, strings, meta):
+    '''
+        Takes in string representing path to write bundle to, dict mapping names to numpy arrays, dict mapping names to lists of
+        strings, and dict of JSON serializable values describing the model. The bundle is written next to path and moved into
+        place, so processes that already mapped the old bundle keep reading it unchanged.
+    '''
+
+    arrays = dict(arrays)
+    for (name, values) in strings.items():
+        (arrays[f'{name}.data'], arrays[f'{name}.offsets']) = pack_strings(values)
+
+    layout = {}
+    offset = 0
+    for (name, array) in arrays.items():
+        arrays[name] = np.ascontiguousarray(array)
+        layout[name] = {'dtype': arrays[name].dtype.str, 'shape': list(arrays[name].shape), 'offset': offset}
+        offset += -(-arrays[name].nbytes // alignment) * alignment
+
+    header = json.dumps({'meta': meta, 'arrays': layout, 'strings': list(strings)}).encode()
+    data_start = -(-(len(magic) + 8 + len(header)) // alignment) * alignment
+
+    with open(f'{path}.tmp', 'wb') as fh:
+        fh.write(magic + struct.pack('<II', version, len(header)) + header)
+        for (name, array) in arrays.items():
+            fh.seek(data_start + layout[name]['offset'])
+            fh.write(array.tobytes())
+        fh.truncate(data_start + offset)
+
+    os.replace(f'{path}.tmp', path)
+
+
+class ModelBundle:
+    '''
+        Read-only view of a bundle written by write_bundle. Arrays are numpy views into the memory-mapped file, so nothing is copied
+        into the process until it's read.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(magic)] != magic:
+            raise ValueError(f'{path} is not a model bundle')
+
+        (bundle_version, header_len) = struct.unpack_from('<II', self._mmap, len(magic))
+        if bundle_version != version:
+            raise ValueError(f'{path} is model bundle version {bundle_version}, expected version {version}. Re-export it with create_model.py')
+
+        header = json.loads(self._mmap[len(magic) + 8:len(magic) + 8 + header_len])
+        data_start = -(-(len(magic) + 8 + header_len) // alignment) * alignment
+
+        self.meta = header['meta']
+        self.nbytes = len(self._mmap)
+        self._arrays = {}
+        for (name, layout) in header['arrays'].items():
+            dtype = np.dtype(layout['dtype'])
+            count = int(np.prod(layout['shape']))
+            self._arrays[name] = np.frombuffer(self._mmap, dtype, count, data_start + layout['offset']).reshape(layout['shape'])
+
+        self._strings = header['strings']
+
+    def __contains__(self, name):
+        return name in self._arrays or name in self._strings
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def strings(self, name):
+        '''
+            Takes in name of list of strings stored in bundle.
+            Returns list of the strings, decoded into the process.
+        '''
+
+        (data, offsets) = (self._arrays[f'{name}.data'].tobytes(), self._arrays[f'{name}.offsets'].tolist())
+
+        return [data[start:end].decode() for start, end in zip(offsets[:-1], offsets[1:])]
@@ -0,0 +1,153 @@
+'''
+    Application-lifetime registry holding the recommendation model and the data it's served with.
+'''
+
+from .scoring import ScoringEngine
+from .item_index import ItemIndex
+from .film_meta import FilmMetadata
+from .rating_store import RatingStore
+from .model_bundle import ModelBundle, unranked
+from . import columnar
+import numpy as np
+import pandas as pd
+import pickle
+import resource
+import time
+import os
+
+
+class ModelRegistry:
+    '''
+        Holds ScoringEngine object with trained model's parameters, mean of ratings model was trained on, numpy array of each film's
+        popularity ranking, dict of film titles by href, and FilmMetadata object with films' genres and viewers if one was built.
+        Loaded once when each API process starts up and shared read-only between requests.
+    '''
+
+    def __init__(self, engine, rating_mean, film_ranks, film_titles, load_seconds, rss_delta, film_meta=None, bundle=None):
+        self._engine = engine
+        self._rating_mean = rating_mean
+        self._film_ranks = film_ranks
+        self._film_titles = film_titles
+        self._film_meta = film_meta
+        self._bundle = bundle
+        self._too_popular_masks = {}
+        self._load_seconds = load_seconds
+        self._rss_delta = rss_delta
+
+    @classmethod
+    def load(cls, pickles_dir='app/pickles', data_dir='app/data'):
+        '''
+            Takes in string representing directory with model bundle (or model pickles) and string representing directory with film
+            metadata store (and films table or films.csv if there's no bundle).
+            Returns ModelRegistry object with model and data loaded. A model bundle is memory-mapped rather than read, so processes
+            serving from the same bundle share its arrays.
+        '''
+
+        t0 = time.time()
+        rss_before = _max_rss()
+
+        # Retrieval index is only searched when INDEX_NPROBE says how many lists to probe. Recall depends on the catalogue and the
+        # number of results, so benchmark_index.py should be run on the model being served first. Otherwise every film is scored.
+        nprobe = int(os.environ['INDEX_NPROBE']) if os.environ.get('INDEX_NPROBE') else None
+
+        bundle_path = f'{pickles_dir}/model.bundle'
+        if os.path.exists(bundle_path):
+            bundle = ModelBundle(bundle_path)
+            engine = ScoringEngine.from_bundle(bundle)
+
+            if nprobe and 'index.centroids' in bundle:
+                engine.attach_index(ItemIndex(bundle['index.centroids'], bundle['index.list_offsets'], bundle['index.list_items']), nprobe)
+
+            rating_mean = bundle.meta['rating_mean']
+            film_ranks = bundle['film_ranks']
+            film_titles = dict(zip(engine.film_links.tolist(), bundle.strings('film_titles')))
+
+        else:
+            bundle = None
+            (engine, rating_mean, film_ranks, film_titles) = _load_pickles(pickles_dir, data_dir, nprobe)
+
+        # Without film metadata store every filtered film gets scraped
+        film_meta_path = f'{data_dir}/film_meta.npz'
+        film_meta = FilmMetadata.load(film_meta_path) if os.path.exists(film_meta_path) else None
+
+        return cls(engine, rating_mean, film_ranks, film_titles, time.time() - t0, _max_rss() - rss_before, film_meta, bundle)
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def film_titles(self):
+        return self._film_titles
+
+    @property
+    def film_meta(self):
+        return self._film_meta
+
+    @property
+    def rating_mean(self):
+        return self._rating_mean
+
+    def too_popular_mask(self, min_rank):
+        '''
+            Takes in integer representing minimum popularity ranking.
+            Returns read-only boolean numpy array over engine's film ids that's True for films ranked more popular than min_rank.
+            Results are cached per min_rank.
+        '''
+
+        if min_rank not in self._too_popular_masks:
+            mask = self._film_ranks < min_rank
+            mask.flags.writeable = False
+            self._too_popular_masks[min_rank] = mask
+
+        return self._too_popular_masks[min_rank]
+
+    def stats(self):
+        '''
+            Returns dict describing where registry was loaded from, how long it took to load and how much memory it occupies.
+        '''
+
+        return {
+            'source': 'bundle' if self._bundle is not None else 'pickles',
+            'load_seconds': round(self._load_seconds, 2),
+            'bundle_mb': round(self._bundle.nbytes / 2**20, 1) if self._bundle is not None else None,
+            'engine_mb': round((self._engine.qi.nbytes + self._engine.bi.nbytes) / 2**20, 1),
+            'index_lists': self._engine.index.n_lists if self._engine.index is not None else None,
+            'film_meta_films': self._film_meta.n_films if self._film_meta is not None else None,
+            'rss_growth_mb': round(self._rss_delta / 2**10, 1)
+        }
+
+
+def _load_pickles(pickles_dir, data_dir, nprobe):
+    # Loading model from pickled algorithm, rating store and films table, for models trained before bundles were exported.
+    # Returns tuple of ScoringEngine object, rating mean, film ranks and film titles, as a bundle would give them.
+    ratings = RatingStore.load(f'{pickles_dir}/ratings.npz')
+    with open(f'{pickles_dir}/rec_model.pkl', 'rb') as pkl:
+        engine = ScoringEngine.from_algo(pickle.load(pkl))
+
+    index_path = f'{pickles_dir}/item_index.npz'
+    if nprobe and os.path.exists(index_path):
+        engine.attach_index(ItemIndex.load(index_path), nprobe)
+
+    # Films scraped before they were written as a table come as films.csv
+    if columnar.has_table(f'{data_dir}/films'):
+        films_df = columnar.read_table(f'{data_dir}/films', ['Film Link', 'Ranking'])
+    else:
+        films_df = pd.read_csv(f'{data_dir}/films.csv', usecols=['Film Link', 'Ranking'])
+        films_df['Ranking'] = pd.to_numeric(films_df['Ranking'], errors='coerce')
+    films_df = films_df.dropna(subset=['Ranking'])
+
+    # Each film's best ranking, with films that aren't in the popular list never counting as too popular
+    film_ranks = np.full(engine.n_films, unranked, dtype=np.int32)
+    film_ids = engine.film_ids(films_df['Film Link'])
+    known = film_ids >= 0
+    np.minimum.at(film_ranks, film_ids[known], films_df['Ranking'].to_numpy()[known].astype(np.int32))
+
+    film_titles = dict(zip(ratings.film_links, ratings.film_titles))
+
+    return (engine, float(ratings.ratings.mean()), film_ranks, film_titles)
+
+
+def _max_rss():
+    # Peak resident set size of process in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
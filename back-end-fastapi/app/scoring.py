@@ -0,0 +1,144 @@
+'''
+    Vectorized scoring of films with the parameters of a trained SVD model.
+'''
+
+import numpy as np
+
+
+class ScoringEngine:
+    '''
+        Holds global mean, item biases and item factors of a trained SVD model as contiguous numpy arrays indexed by integer film ids,
+        along with the hrefs those ids correspond to. Scores every film for a user with a single matrix-vector product.
+    '''
+
+    def __init__(self, global_mean, bi, qi, film_links, rating_scale, reg_bu, reg_pu):
+        self.global_mean = float(global_mean)
+        self.bi = np.ascontiguousarray(bi, dtype=np.float32)
+        self.qi = np.ascontiguousarray(qi, dtype=np.float32)
+        self.film_links = np.asarray(film_links)
+        self.rating_scale = rating_scale
+        self.reg_bu = reg_bu
+        self.reg_pu = reg_pu
+        self.n_films, self.n_factors = self.qi.shape
+
+        self._film_ids = {link: film_id for film_id, link in enumerate(self.film_links)}
+        self.index = None
+        self.nprobe = None
+
+        for array in (self.bi, self.qi):
+            array.flags.writeable = False
+
+    @classmethod
+    def from_algo(cls, algo):
+        '''
+            Takes in trained surprise.SVD algorithm.
+            Returns ScoringEngine object with algorithm's parameters exported. Film ids are the algorithm's inner item ids.
+        '''
+
+        trainset = algo.trainset
+        film_links = [trainset.to_raw_iid(inner_id) for inner_id in range(trainset.n_items)]
+
+        return cls(trainset.global_mean, algo.bi, algo.qi, film_links, trainset.rating_scale, algo.reg_bu, algo.reg_pu)
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        '''
+            Takes in ModelBundle object exported by data-processing/create_model.py.
+            Returns ScoringEngine object whose item biases and factors are views into the bundle's memory-mapped arrays.
+        '''
+
+        meta = bundle.meta
+
+        return cls(meta['global_mean'], bundle['bi'], bundle['qi'], bundle.strings('film_links'), tuple(meta['rating_scale']), meta['reg_bu'], meta['reg_pu'])
+
+    def attach_index(self, index, nprobe):
+        '''
+            Takes in ItemIndex object built over this engine's films and number of inverted lists to probe per query.
+            Makes top_k retrieve candidates from index rather than scanning every film.
+        '''
+
+        if index.n_films != self.n_films:
+            raise ValueError(f'Index covers {index.n_films} films but model has {self.n_films}')
+
+        self.index = index
+        self.nprobe = nprobe
+
+    def film_id(self, film_link):
+        '''
+            Takes in string representing film href.
+            Returns integer id of film, or None if model doesn't know film.
+        '''
+
+        return self._film_ids.get(film_link)
+
+    def film_ids(self, film_links):
+        '''
+            Takes in iterable of film hrefs.
+            Returns numpy array of film ids, with -1 for films model doesn't know.
+        '''
+
+        return np.fromiter((self._film_ids.get(link, -1) for link in film_links), dtype=np.int64)
+
+    def mask(self, film_links):
+        '''
+            Takes in iterable of film hrefs.
+            Returns boolean numpy array over all film ids that's True for the given films.
+        '''
+
+        film_ids = self.film_ids(film_links)
+        mask = np.zeros(self.n_films, dtype=bool)
+        mask[film_ids[film_ids >= 0]] = True
+
+        return mask
+
+    def score(self, user_factors):
+        '''
+            Takes in tuple of user's bias and latent factors.
+            Returns numpy array of unclipped estimated rating for every film id.
+        '''
+
+        (bu, pu) = user_factors
+        ests = self.qi @ np.asarray(pu, dtype=np.float32)
+        ests += self.bi
+        ests += self.global_mean + bu
+
+        return ests
+
+    def top_k(self, user_factors, k, exclude=None):
+        '''
+            Takes in tuple of user's bias and latent factors, number of films to return, and optional boolean numpy array of films to exclude.
+            Returns tuple of numpy arrays of the k highest scoring film ids and their estimated ratings, in descending order of estimate.
+            Films are ranked on unclipped scores so films past the top of the rating scale don't tie. If an ItemIndex has been
+            attached, only the films it retrieves are scored instead of every film.
+        '''
+
+        if self.index is not None:
+            (top, scores) = self.index.search(self.qi, self.bi, user_factors, k, self.nprobe, exclude)
+            return (top, np.clip(scores + self.global_mean + user_factors[0], *self.rating_scale))
+
+        ests = self.score(user_factors)
+        candidates = np.flatnonzero(~exclude) if exclude is not None else np.arange(self.n_films)
+        if not len(candidates):
+            return (candidates, ests[candidates])
+
+        # Partitioning out top k before sorting them, rather than sorting every candidate
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(-ests[candidates], k - 1)[:k]]
+        top = top[np.argsort(-ests[top], kind='stable')]
+
+        return (top, np.clip(ests[top], *self.rating_scale))
+
+    def predict(self, user_factors, film_ids):
+        '''
+            Takes in tuple of user's bias and latent factors and numpy array of film ids (-1 for unknown films).
+            Returns numpy array of estimated ratings. Films model doesn't know only get global mean and user bias, like surprise.SVD does.
+        '''
+
+        (bu, pu) = user_factors
+        film_ids = np.asarray(film_ids, dtype=np.int64)
+        known = film_ids >= 0
+
+        ests = np.full(len(film_ids), self.global_mean + bu, dtype=np.float32)
+        ests[known] += self.bi[film_ids[known]] + self.qi[film_ids[known]] @ np.asarray(pu, dtype=np.float32)
+
+        return np.clip(ests, *self.rating_scale, out=ests)
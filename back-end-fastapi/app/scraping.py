@@ -2,11 +2,22 @@
     Functions useful for scraping Letterboxd.
 '''
 
+from . import extract
+from . import http_cache
+from . import metrics
+from .retry import RetryPolicy
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
+import time
+import os
 
 
+# Site pages are scraped from. Can be pointed at a local stand-in, like benchmark_api.py does, so nothing hits letterboxd.com.
+base_url = os.environ.get('LETTERBOXD_URL', 'https://letterboxd.com').rstrip('/')
+
+# Requests made while serving the API give up after 20 seconds so a throttled upstream can't hold a request open indefinitely
+retry_policy = RetryPolicy(max_attempts=8, base_delay=0.25, max_delay=5.0, max_retry_after=10.0, deadline=20.0)
+
 genres = [
     "Action",
     "Adventure",
@@ -29,15 +40,87 @@ genres = [
     "Western"
 ]
 
+# Exposed at /metrics alongside counts kept by the metrics module
+metrics.CallbackCounter(
+    'letterboxd_retry_events_total',
+    'Requests to Letterboxd made through retry_policy: requests, attempts, retries, throttled and failed responses, and seconds slept.',
+    'event',
+    lambda: retry_policy.stats
+)
+metrics.CallbackCounter(
+    'letterboxd_cache_events_total',
+    'Response cache hits, misses, stores, expired entries, evictions and SQLite errors.',
+    'event',
+    lambda: http_cache.get_response_cache().counts
+)
+
+
+def create_session():
+    '''
+        Returns aiohttp.ClientSession object to be shared by every request the API process makes to Letterboxd. Its connector
+        keeps connections alive between requests and caps concurrent connections to letterboxd.com at LETTERBOXD_MAX_CONNECTIONS.
+    '''
+
+    max_connections = int(os.environ.get('LETTERBOXD_MAX_CONNECTIONS', 50))
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections, ttl_dns_cache=300, keepalive_timeout=60)
+
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+
+async def request_html(url, session):
+    '''
+        Takes in string representing url and aiohttp.ClientSession object. Makes a single request through
+        http_cache.request_html, counting and timing it in metrics.
+        Returns tuple of response status, response text/html, and value of response's Retry-After header respectively.
+    '''
+
+    page = page_kind(url)
+    served = {}
+
+    # Every attempt is counted and timed, including ones that fail to connect
+    t0 = time.perf_counter()
+    status = 'error'
+    try:
+        response = await http_cache.request_html(url, session, served)
+        status = 'cached' if served['cached'] else response[0]
+        return response
+
+    # Scrapes apply_filters no longer needs are cancelled, which isn't a failure of Letterboxd's
+    except asyncio.CancelledError:
+        status = 'cancelled'
+        raise
+
+    finally:
+        metrics.letterboxd_requests.inc(page=page, status=status)
+        if served.get('cached'):
+            metrics.count_request('cache_hits')
+        else:
+            metrics.count_request('letterboxd_requests')
+            if status != 'cancelled':
+                metrics.letterboxd_seconds.observe(time.perf_counter() - t0, page=page)
+
+
+def page_kind(url):
+    '''
+        Takes in string representing url of Letterboxd page.
+        Returns string representing kind of page ('films', 'watchlist', 'members', 'genres' or 'other'), to label metrics with
+        without a label value for every user and film.
+    '''
+
+    for kind in ('members', 'genres', 'watchlist', 'films'):
+        if f'/{kind}/' in url:
+            return kind
+
+    return 'other'
+
 
-async def fetch_html(url, session):
+async def fetch_html(url, session, deadline=None):
     '''
-        Takes in string representing url and aiohttp.ClientSession object.
-        Returns tuple of response status and response text/html respectively.
+        Takes in string representing url, aiohttp.ClientSession object, and optional number of seconds fetching may take overall.
+        Returns tuple of response status and response text/html respectively, retrying failed requests according to retry_policy.
     '''
 
-    async with session.get(url) as response:
-        return (response.status, await response.text())
+    return await retry_policy.call(request_html, url, session, deadline)
     
 
 async def get_num_film_pages(member, session):
@@ -46,26 +129,17 @@ async def get_num_film_pages(member, session):
         Returns integer representing number of pages necessary to scrape to collect all user ratings.
     '''    
 
-    url = f'https://letterboxd.com{member}films/'
+    url = f'{base_url}{member}films/'
     (resp_code, html) = await fetch_html(url, session)
 
-    attempts = 1
-    while resp_code != 200 and attempts < 100:
-        (resp_code, html) = await fetch_html(url, session)
-        attempts += 1
-
     try:
         if resp_code != 200:
             raise Exception(f"Response code {resp_code}")
 
-        # Parsing page using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        paginate_pages = soup.find_all("li", class_="paginate-page")
-
-        return int(paginate_pages[-1].find('a').text) if paginate_pages else 1
+        return extract.num_pages(extract.parse(html))
     
     except Exception as err:
-        print(f"Error finding number of pages to scrape for member {member}: {err}")
+        metrics.log('scrape_error', stage='num_film_pages', user=member, error=str(err))
 
 
 async def scrape_member_ratings(member, page, session):
@@ -74,59 +148,31 @@ async def scrape_member_ratings(member, page, session):
         Returns tuple of list of dicts representing user rated data and list of dict representings user unrated data respectively.
     '''  
 
-    url = f'https://letterboxd.com{member}films/page/{page}/'
+    url = f'{base_url}{member}films/page/{page}/'
     (resp_code, html) = await (fetch_html(url, session))
 
-    attempts = 1
-    while resp_code != 200 and attempts < 100:
-        (resp_code, html) = await (fetch_html(url, session))
-        attempts += 1
-
     rated_data = []
     unrated_data = []
 
     try:
-        # Parsing data using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        
-        films = soup.find_all("li", class_="poster-container")   
-
-        for film in films:
-            rating_span = film.find('p').find('span')
-
-            if rating_span: 
-                rating = rating_span.attrs['class'][-1].split('-')[1]
-                if rating != "16": # Add to rated data
-                    item = {}
-                    item['User'] = member
-                    film_info = film.find('div')
-                    item['Film'] = film_info.find('img').attrs['alt']
-                    item['Film Link'] = film_info.attrs['data-target-link']
-                    item['Rating'] = rating
-
-                    rated_data.append(item)
-
-                else: # If got rating of 16, it means the user liked the film but didn't rate it. Add to unrated data.
-                    item = {}
-                    item['User'] = member
-                    film_info = film.find('div')
-                    item['Film'] = film_info.find('img').attrs['alt']
-                    item['Film Link'] = film_info.attrs['data-target-link']
-
-                    unrated_data.append(item)                    
-
-            # If user doesn't have rating for film, add to unrated data
-            else: 
-                item = {}
-                item['User'] = member
-                film_info = film.find('div')
-                item['Film'] = film_info.find('img').attrs['alt']
-                item['Film Link'] = film_info.attrs['data-target-link']
-
+        # Pulling film info out of page with lxml
+        for (film_link, film_name, rating) in extract.poster_films(extract.parse(html)):
+            item = {}
+            item['User'] = member
+            item['Film'] = film_name
+            item['Film Link'] = film_link
+
+            # If got rating of 16, it means the user liked the film but didn't rate it. If user doesn't have rating for film at all,
+            # rating is None. Either way add to unrated data.
+            if rating is not None and rating != "16":
+                item['Rating'] = rating
+                rated_data.append(item)
+
+            else:
                 unrated_data.append(item)
 
     except Exception as err:
-        print(f"Error scraping member {member}, film page #{page}: {err}")
+        metrics.log('scrape_error', stage='film_page', user=member, page=page, error=str(err))
 
     finally: 
         return (rated_data, unrated_data)
@@ -138,27 +184,17 @@ async def get_num_watchlist_pages(user, session):
         Returns number of pages in user's watchlist.
     '''
 
-    url = f'https://letterboxd.com{user}watchlist/'
+    url = f'{base_url}{user}watchlist/'
     (resp_code, html) = await fetch_html(url, session)
 
     if resp_code in (204, 403): # If this happens, user likely has watchlist privated
         return None
-    
-    # If some other server response error continue attempting to fetch html
-    elif resp_code != 200:
-        attempts = 1
-        while resp_code != 200 and attempts < 100:
-            (resp_code, html) = await fetch_html(url, session)
-            attempts += 1
 
     try:
-        # Parsing data using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        paginate_pages = soup.find_all("li", class_="paginate-page")
-        return int(paginate_pages[-1].find('a').text) if paginate_pages else 1
+        return extract.num_pages(extract.parse(html))
     
     except Exception as err:
-        print(f"Error finding number of pages to scrape for user watchlist: {err}")
+        metrics.log('scrape_error', stage='num_watchlist_pages', user=user, error=str(err))
 
 
 async def scrape_watchlist(user, page, session):
@@ -167,89 +203,81 @@ async def scrape_watchlist(user, page, session):
         Returns list of film hrefs from user's watchlist on given page.
     '''
 
-    url = f'https://letterboxd.com{user}watchlist/page/{page}/'
+    url = f'{base_url}{user}watchlist/page/{page}/'
     (resp_code, html) = await fetch_html(url, session)
 
-    while resp_code != 200:
-        (resp_code, html) = await fetch_html(url, session)
-
     film_links = []
 
     try:
-        # Getting film info using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-
-        films = soup.find_all('li', class_='poster-container')
-        for film in films:
-            film_links.append(film.find('div').attrs['data-target-link'])
+        film_links.extend(extract.poster_links(extract.parse(html)))
 
     except Exception as err:
-        print(f"Error scraping {user} watchlist page #{page}: {err}")
+        metrics.log('scrape_error', stage='watchlist_page', user=user, page=page, error=str(err))
 
     finally:
         return film_links
     
 
-async def scrape_user_data(user, exclude_watchlist):
+async def scrape_user_data(user, exclude_watchlist, session):
     '''
-        Takes in string representing Letterboxd user and boolean indicating whether to exclude films in user's watchlist.
+        Takes in string representing Letterboxd user, boolean indicating whether to exclude films in user's watchlist, and
+        aiohttp.ClientSession object shared by the API process.
         Returns tuple with list of dicts representing user ratings and list of film href's from user's watchlist respectively.
     '''
 
     user_ratings = []
     user_watchlist = []
 
-    # Asynchronously scraping user data
-    async with aiohttp.ClientSession() as session:
-        print(f'Scraping data for {user}. . .')
-        tasks = []
-        
-        # Getting number of pages user has filled with ratings
-        tasks.append(get_num_film_pages(user, session))
-        pages = (await asyncio.gather(*tasks))[0]
-
-        # Scraping user's ratings
-        tasks = [] 
-        for page in range(1, pages + 1):
-            tasks.append(scrape_member_ratings(user, page, session))
-        responses = await asyncio.gather(*tasks)
+    # Asynchronously scraping user data over the shared session
+    metrics.log('scrape_user', user=user, exclude_watchlist=exclude_watchlist)
+    tasks = []
 
-        rating_sum = sum(len(rated_data) for rated_data, _ in responses)
-        if rating_sum: 
-            mean_rating = round(sum(int(data['Rating']) for rated_data, _ in responses for data in rated_data ) / rating_sum, 2)
-            for rated_data, unrated_data in responses:
-                user_ratings += rated_data
+    # Getting number of pages user has filled with ratings
+    tasks.append(get_num_film_pages(user, session))
+    pages = (await asyncio.gather(*tasks))[0]
 
-                # Infering that user would rate films that they logged but didn't give a rating for to be the mean score of the ratings they did give
-                if unrated_data:
-                    for i in range(len(unrated_data)):
-                        unrated_data[i]['Rating'] = mean_rating
+    # Scraping user's ratings
+    tasks = [] 
+    for page in range(1, pages + 1):
+        tasks.append(scrape_member_ratings(user, page, session))
+    responses = await asyncio.gather(*tasks)
 
-                    user_ratings += unrated_data
+    rating_sum = sum(len(rated_data) for rated_data, _ in responses)
+    if rating_sum: 
+        mean_rating = round(sum(int(data['Rating']) for rated_data, _ in responses for data in rated_data ) / rating_sum, 2)
+        for rated_data, unrated_data in responses:
+            user_ratings += rated_data
 
-        # If rating_sum is 0, user didn't rate any films, so give somewhat arbitrary rating of 10 to all films they logged.
-        else:
-            for _, unrated_data in responses:
+            # Infering that user would rate films that they logged but didn't give a rating for to be the mean score of the ratings they did give
+            if unrated_data:
                 for i in range(len(unrated_data)):
-                    unrated_data[i]['Ratings'] = 10
+                    unrated_data[i]['Rating'] = mean_rating
 
                 user_ratings += unrated_data
 
-        if exclude_watchlist:
-            tasks = []
-            tasks.append(get_num_watchlist_pages(user, session))
-            pages = (await asyncio.gather(*tasks))[0]
-            if not pages:
-                print("Couldn't scrape user watchlist. Please try unprivating watchlist.")
-                return (user_ratings, [])
+    # If rating_sum is 0, user didn't rate any films, so give somewhat arbitrary rating of 10 to all films they logged.
+    else:
+        for _, unrated_data in responses:
+            for i in range(len(unrated_data)):
+                unrated_data[i]['Rating'] = 10
+
+            user_ratings += unrated_data
+
+    if exclude_watchlist:
+        tasks = []
+        tasks.append(get_num_watchlist_pages(user, session))
+        pages = (await asyncio.gather(*tasks))[0]
+        if not pages:
+            metrics.log('watchlist_private', user=user)
+            return (user_ratings, [])
 
-            tasks = [] 
-            for page in range(1, pages + 1):
-                tasks.append(scrape_watchlist(user, page, session))
-            responses = await asyncio.gather(*tasks)
+        tasks = [] 
+        for page in range(1, pages + 1):
+            tasks.append(scrape_watchlist(user, page, session))
+        responses = await asyncio.gather(*tasks)
 
-            for response in responses:
-                user_watchlist += response
+        for response in responses:
+            user_watchlist += response
 
     return (user_ratings, user_watchlist)
 
@@ -266,31 +294,17 @@ async def scrape_pred_data(film_link, idx, filters, session):
     try:
         # Getting number of viewers film has gotten
         if 'Popularity' in filters:
-            url = f'https://letterboxd.com{film_link}members/'
+            url = f'{base_url}{film_link}members/'
             (resp_code, html) = await fetch_html(url, session)
 
-            attempts = 1
-            while resp_code != 200 and attempts < 100:
-                (resp_code, html) = await fetch_html(url, session)
-                attempts += 1
-
-            soup = BeautifulSoup(html, 'lxml')
-            num_viewers = int(soup.find('li', class_='js-route-watches').find('a').attrs['title'].split()[0].replace(',', ''))
-            film_info['viewers'] = num_viewers
+            film_info['viewers'] = extract.viewers(extract.parse(html))
 
         # Getting genre of film
         if 'Genre' in filters:
-            url = f'https://letterboxd.com{film_link}genres/'
+            url = f'{base_url}{film_link}genres/'
             (resp_code, html) = await fetch_html(url, session)
 
-            attempts = 1
-            while resp_code != 200 and attempts < 100:
-                (resp_code, html) = await fetch_html(url, session)
-                attempts += 1
-
-            soup = BeautifulSoup(html, 'lxml')
-            film_genres = [genre.text for genre in soup.find('div', id="tab-genres").find_all('a') if genre.text in genres]
-            film_info['genres'] = film_genres
+            film_info['genres'] = [genre for genre in extract.genres(extract.parse(html)) if genre in genres]
             
     finally:
         return film_info
\ No newline at end of file
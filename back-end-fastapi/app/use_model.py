@@ -3,11 +3,12 @@
 '''
 
 from . import scraping
+from . import metrics
+from surprise import Prediction
+import numpy as np
 import pandas as pd
-import aiohttp
 import asyncio
-import pickle
-import functools
+import collections
 
 
 popularity_filter_map = {
@@ -19,10 +20,47 @@ popularity_filter_map = {
 }
 
 
-async def apply_filters(pred_list, filters, n):
+def fold_in_user(ratings, engine):
     '''
-        Takes in list of film predictions, dict of filters to apply, number of films to return.
-        Returns list of filtered film predictions.
+        Takes in list of dicts representing a user's ratings and ScoringEngine object exported from trained model.
+        Returns tuple of user's bias and numpy array representing user's latent factors respectively, solved against the model's
+        frozen item biases and factors so a user who wasn't in the trainset can be scored without retraining.
+    '''
+
+    film_ids = engine.film_ids(rating['Film Link'] for rating in ratings)
+    targets = np.array([float(rating.get('Rating', np.nan)) for rating in ratings])
+    known = (film_ids >= 0) & ~np.isnan(targets)
+
+    if not known.any():
+        return (0.0, np.zeros(engine.n_factors))
+
+    # Ridge regression of the residuals left after global mean and item biases on [1, item factors]. Regularization is scaled by
+    # number of ratings to match the per-rating penalty SVD applies during SGD.
+    film_ids = film_ids[known]
+    residuals = targets[known] - engine.global_mean - engine.bi[film_ids]
+    features = np.hstack([np.ones((len(film_ids), 1)), engine.qi[film_ids]])
+    penalty = len(film_ids) * np.diag([engine.reg_bu] + [engine.reg_pu] * engine.n_factors)
+
+    solution = np.linalg.solve(features.T @ features + penalty, features.T @ residuals)
+
+    return (solution[0], solution[1:])
+
+
+def passes_filters(film_info, max_viewers, genres_to_choose):
+    '''
+        Takes in dict with film's number of viewers and/or genres, max number of viewers film can have, and list of genres to choose from.
+        Returns boolean indicating whether film meets filter criteria.
+    '''
+
+    return not ('viewers' in film_info and film_info['viewers'] > max_viewers) and (not ('genres' in film_info) or any(film_genre in genres_to_choose for film_genre in film_info['genres']))
+
+
+async def apply_filters(pred_list, filters, n, session, film_meta=None, window=50):
+    '''
+        Takes in list of film predictions sorted by estimated rating, dict of filters to apply, number of films to return,
+        aiohttp.ClientSession object, optional FilmMetadata object, and max number of films to scrape at once.
+        Returns list of the first n film predictions that meet the filters, in the same order. Films are looked up in film_meta first
+        and only scraped if they're missing from it.
     '''
 
     if 'Genre' in filters or 'Popularity' in filters:
@@ -30,167 +68,165 @@ async def apply_filters(pred_list, filters, n):
         max_viewers = popularity_filter_map[filters['Popularity']][1] if 'Popularity' in filters else float('inf')
         genres_to_choose = filters['Genre'] if 'Genre' in filters else scraping.genres
 
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            i = 0
-            while i < len(pred_list) and len(filtered_list) < n:
-                tasks.append(scraping.scrape_pred_data(pred_list[i].iid, i, filters, session))
+        # Films are checked strictly in ranking order, while scrapes for up to window films behind the one being checked run
+        # in the background. A slow page only holds up the films ranked below it, not a whole batch.
+        pending = collections.deque()
+        in_flight = 0
+        i = 0
+
+        try:
+            while (i < len(pred_list) or pending) and len(filtered_list) < n:
+                while i < len(pred_list) and in_flight < window:
+                    film_info = film_meta.lookup(pred_list[i].iid, filters) if film_meta else None
+                    if film_info is None:
+                        film_info = asyncio.ensure_future(scraping.scrape_pred_data(pred_list[i].iid, i, filters, session))
+                        in_flight += 1
 
-                if len(tasks) % 50 == 0:
-                    responses = await asyncio.gather(*tasks)
-                    tasks = []
-                    for response in responses:
-                        if not ('viewers' in response and response['viewers'] > max_viewers) and (not ('genres' in response) or any(film_genre in genres_to_choose for film_genre in response['genres'])):
-                            filtered_list.append(pred_list[response['idx']])
+                    pending.append((i, film_info))
+                    i += 1
 
-                i += 1
+                (idx, film_info) = pending.popleft()
+                if asyncio.isfuture(film_info):
+                    film_info = await film_info
+                    in_flight -= 1
 
-        return sorted(filtered_list, key=(lambda x : x.est), reverse=True)[:n]
+                if passes_filters(film_info, max_viewers, genres_to_choose):
+                    filtered_list.append(pred_list[idx])
+
+        finally:
+            # Cancelling scrapes still in flight once top n are confirmed (or if request was cancelled)
+            for (_, film_info) in pending:
+                if asyncio.isfuture(film_info):
+                    film_info.cancel()
+
+        return filtered_list
 
     else:
         return pred_list[:n]
-        
 
 
-async def get_top_n_recs(user, n, df, algo, filters):
+async def get_top_n_recs(user, n, user_df, registry, filters, session):
     '''
-        Takes in string representing Letterboxd user, number of recommendations to return, pandas.DataFrame object with info about user's ratings
-        and ratings used in trained model, trained surprise.SVD algorithm, and dict containing necessary filters to apply.
+        Takes in string representing Letterboxd user, number of recommendations to return, pandas.DataFrame object with info about user's ratings,
+        ModelRegistry object holding trained model's ScoringEngine, ratings used to train it and film metadata, dict containing necessary filters
+        to apply, and aiohttp.ClientSession object shared by the API process.
         Returns list of n tuples containing prediction href and estimated rating for prediction respectively.
     '''
 
+    engine = registry.engine
+
     # All films must have higher popularity ranking than min_rank to be recommended
     min_rank = popularity_filter_map[filters['Popularity']][0] if 'Popularity' in filters else 0
 
-    # Finding mean of all ratings in df to be used to fill missing values when getting predictions from model
-    df['Rating'] = pd.to_numeric(df['Rating'], errors='coerce')
-    rating_mean = df.loc[:, 'Rating'].mean()
-
-    films_df = pd.read_csv('app/data/films.csv')
-    films_df['Ranking'] = pd.to_numeric(films_df['Ranking'], errors='coerce')
+    # Mean of ratings model was trained on is used as each prediction's true rating, which is what 3rd item of Prediction is used for
+    rating_mean = registry.rating_mean
 
-    user_films = set(df[df['User'] == user]['Film Link'].unique())
-    all_films = set(df['Film Link'].unique())
-    films_too_popular = set(films_df[films_df['Ranking'] < min_rank]['Film Link'].unique())
-    # Getting union of users' watchlists (useful when multiple watchlists to exclude like when using blend mode)
-    films_in_watchlists = set(functools.reduce((lambda a, b : set(a).union(set(b))), filters['Watchlists'])) if filters['Watchlists'] else set()
-    
-    # Filtering out films user has seen, films that don't meet popularity filter criteria, 
-    # and films in user watchlists (if user opted to ignore films in watchlists)
-    films = list(all_films - user_films - films_too_popular - films_in_watchlists)
+    user_films = user_df['Film Link'] if 'Film Link' in user_df else []
 
-    # Using mean of all ratings in df to fill missing values when getting predictions from model, which is what 3rd item of tuple is used for
-    user_film_pairs = [(user, film, rating_mean) for film in films]
-    predictions = algo.test(user_film_pairs)
+    with metrics.span('predict'):
+        # Filtering out films user has seen, films that don't meet popularity filter criteria,
+        # and films in user watchlists (if user opted to ignore films in watchlists, more than one when using blend mode)
+        exclude = engine.mask(user_films)
+        for watchlist in filters['Watchlists']:
+            exclude |= engine.mask(watchlist)
+        if min_rank:
+            exclude |= registry.too_popular_mask(min_rank)
 
-    top_1000_recs = sorted(predictions, key=(lambda x : x.est), reverse=True)[:1000]
+        user_factors = fold_in_user(user_df.to_dict('records'), engine)
+        (film_ids, ests) = engine.top_k(user_factors, 1000, exclude)
 
-    print('Applying filters. . .')
+        top_1000_recs = [Prediction(user, engine.film_links[film_id], rating_mean, float(est), {'was_impossible': False}) for film_id, est in zip(film_ids, ests)]
 
-    filtered_recs = await apply_filters(top_1000_recs, filters, n)
+    with metrics.span('filter'):
+        filtered_recs = await apply_filters(top_1000_recs, filters, n, session, registry.film_meta)
 
     return [(pred.iid, pred.est) for pred in filtered_recs]
 
 
 
-def get_blended_ratings(user_1_ratings, user_2_ratings, algo):
+def get_blended_ratings(users_ratings, engine):
     '''
-        Takes in list of user 1's ratings, a list of user 2's ratings, and trained surprise.SVD algorithm.
-        Return list of dicts corresponding to average of the ratings for each film. If 1 user has rated a film the
-        other user hasn't, predict what the other user would rate it, then use the first user's actual rating and the other user's
-        predicted rating to find average.
+        Takes in list of each blended user's list of ratings, and ScoringEngine object exported from trained model.
+        Return list of dicts corresponding to average of the users' ratings for each film any of them has rated, attributed to the first user.
+        If some users haven't rated a film another user has, predict what they would rate it (with every user folded into the model),
+        then use the actual ratings and the predicted ratings to find average.
     '''
 
-    user_1 = user_1_ratings[0]['User']
-    user_2 = user_2_ratings[0]['User']
-
-    to_predict = [] # Will be used as test set for algorithm to predict
-    combined_ratings = []
-    films_in_common_dict = {}
-
-    user_1_total_score = 0
-    for user_1_rating in user_1_ratings:
-        user_1_total_score += int(user_1_rating['Rating'])
-
-        for user_2_rating in user_2_ratings:
-            if user_1_rating['Film Link'] == user_2_rating['Film Link']:
-                combined_ratings.append(user_1_rating)
+    user_1 = users_ratings[0][0]['User'] if users_ratings[0] else None
 
-                # Change rating of film to be average of 2 user's ratings
-                combined_ratings[-1]['Rating'] = str(round((int(user_1_rating['Rating']) + int(user_2_rating['Rating']))/2, 2))
-                films_in_common_dict[user_1_rating['Film Link']] = True
-                break
+    # Hash joining users' ratings on film href, keeping the first title seen for each film
+    film_titles = {}
+    rating_sums = {}
+    ratings_by_user = []
+    for user_ratings in users_ratings:
+        user_ratings_dict = {}
+        for rating in user_ratings:
+            if 'Rating' in rating:
+                user_ratings_dict[rating['Film Link']] = float(rating['Rating'])
+                film_titles.setdefault(rating['Film Link'], rating.get('Film'))
 
-        # If user 2 hasn't seen film, add to test set
-        if user_1_rating['Film Link'] not in films_in_common_dict:
-            to_predict.append((user_2, user_1_rating['Film Link']))
+        for (film, rating) in user_ratings_dict.items():
+            rating_sums[film] = rating_sums.get(film, 0) + rating
 
-    user_1_rating_mean = round(user_1_total_score / len(user_1_ratings), 2)
+        ratings_by_user.append(user_ratings_dict)
 
-    user_2_total_score = 0
-    for user_2_rating in user_2_ratings:
-        user_2_total_score += int(user_2_rating['Rating'])
+    # Predicting ratings for films each user hasn't rated in one batch per user, using latent factors folded in from the user's own ratings
+    for (user_ratings, user_ratings_dict) in zip(users_ratings, ratings_by_user):
+        films = [film for film in rating_sums if film not in user_ratings_dict]
+        ests = engine.predict(fold_in_user(user_ratings, engine), engine.film_ids(films))
 
-        # If user 1 hasn't seen film, add to test set
-        if user_2_rating['Film Link'] not in films_in_common_dict:
-            to_predict.append((user_1, user_2_rating['Film Link']))
+        for (film, est) in zip(films, ests.tolist()):
+            rating_sums[film] += est
 
-    user_2_rating_mean = round(user_2_total_score / len(user_2_ratings), 2)
+    return [
+        {
+            'User': user_1,
+            'Film': film_titles[film],
+            'Film Link': film,
+            'Rating': round(rating_sum / len(users_ratings), 2)
+        }
+        for (film, rating_sum) in rating_sums.items()
+    ]
 
-    # Predicting ratings for films one of the users hasn't rated
-    user_film_pairs = [(user, film, user_1_rating_mean if user == user_1 else user_2_rating_mean) for (user, film) in to_predict]
-    predictions = algo.test(user_film_pairs)
 
-    for pred in predictions:
-        combined_ratings.append({
-                                    'User': user_1, 
-                                    'Film Link': pred.iid,
-                                    'Rating': round(pred.est, 2)
-                                })
-            
-    return combined_ratings
-
-async def main(parameters):
+async def main(parameters, registry, session):
     '''
-        Takes in dict with values representing the query parameters sent to API.
+        Takes in dict with values representing the query parameters sent to API, ModelRegistry object loaded at startup, and
+        aiohttp.ClientSession object shared by the API process.
         Returns list of dicts including film recs and their corresponding links.
     '''
 
-    with open("app/pickles/model_df.pkl", 'rb') as pkl:
-        ratings_df = pickle.load(pkl)
-    with open("app/pickles/rec_model.pkl", 'rb') as pkl:
-        algo = pickle.load(pkl)
-
-    blend_mode = parameters['blended']
-    user_1 = f'/{parameters["users"].split(',')[0]}/'
-    user_2 = f'/{parameters["users"].split(',')[1]}/' if blend_mode else None
+    users = [f'/{user.strip()}/' for user in parameters['users'].split(',') if user.strip()]
+    blend_mode = parameters['blended'] and len(users) > 1
+    user_1 = users[0]
     exclude_watchlist = parameters['excludeWatchlist'] == 'True'
-    
+
     filter_dict = {}
     if parameters['popFilter'] != 'null' and parameters['popFilter'] != 'undefined':
         filter_dict['Popularity'] = parameters['popFilter']
 
     if parameters['genreFilters']:
         filter_dict['Genre'] = parameters['genreFilters']
-  
-    (ratings, user_1_watchlist) = await scraping.scrape_user_data(user_1, exclude_watchlist)
-    watchlists = [user_1_watchlist] if user_1_watchlist else []
 
-    if blend_mode:
-        (user_2_ratings, user_2_watchlist) = await scraping.scrape_user_data(user_2, exclude_watchlist)
-        watchlists.append(user_2_watchlist)
+    # Scraping every user at once
+    with metrics.span('scrape'):
+        responses = await asyncio.gather(*[scraping.scrape_user_data(user, exclude_watchlist, session) for user in users])
 
-        ratings = get_blended_ratings(ratings, user_2_ratings, algo)
+    if blend_mode:
+        with metrics.span('blend'):
+            ratings = get_blended_ratings([user_ratings for (user_ratings, _) in responses], registry.engine)
+    else:
+        ratings = responses[0][0]
 
-    filter_dict['Watchlists'] = watchlists
+    filter_dict['Watchlists'] = [watchlist for (_, watchlist) in responses if watchlist]
 
-    print(f"Gathering recs for {user_1}{f' and {user_2}' if user_2 else ''}. . .")
-    
     user_df = pd.DataFrame(ratings)
-    df = pd.concat([user_df, ratings_df])
 
-    recs = await get_top_n_recs(user_1, 50, df, algo, filter_dict)
+    recs = await get_top_n_recs(user_1, 50, user_df, registry, filter_dict, session)
+
+    with metrics.span('respond'):
+        response = [{'Film': registry.film_titles[rec[0]], 'Link': f'https://letterboxd.com{rec[0]}'} for rec in recs]
 
-    print(f"Process finished, sending recommendations for {user_1}{f' and {user_2}' if user_2 else ''}. . .")
+    metrics.log('recommendations', users=users, filters=[name for name in filter_dict if name != 'Watchlists'], ratings=len(ratings), recs=len(recs))
 
-    return [{'Film': df[df['Film Link'] == rec[0]]['Film'].unique()[0], 'Link': f'https://letterboxd.com{rec[0]}'} for rec in recs]
\ No newline at end of file
+    return response
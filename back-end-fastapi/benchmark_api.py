@@ -0,0 +1,309 @@
+'''
+    End-to-end latency benchmark of the /api/ endpoint. Starts app.main:app with uvicorn against letterboxd_stub.py instead of
+    letterboxd.com, then sends single user, blend, popularity filter, genre filter and watchlist requests at each concurrency level.
+    Reports p50/p95/p99 latency, throughput, Letterboxd pages scraped per request and the API process's peak memory, and saves them
+    to reports/ so runs before and after a change can be compared. Builds a synthetic model to serve if no model directory is given.
+'''
+
+from app.model_bundle import write_bundle, unranked
+from app.scraping import genres
+from letterboxd_stub import film_details, load_fixtures, recorded_users
+import numpy as np
+import subprocess
+import argparse
+import tempfile
+import asyncio
+import aiohttp
+import json
+import time
+import sys
+import os
+
+
+# Query parameters each scenario sends, given the users it's requesting recommendations for
+scenarios = {
+    'single': lambda users: {'users': users[0], 'excludeWatchlist': 'false', 'popFilter': 'null', 'genreFilters': ''},
+    'blend': lambda users: {'users': ','.join(users[:3]), 'excludeWatchlist': 'false', 'popFilter': 'null', 'genreFilters': ''},
+    'popularity': lambda users: {'users': users[0], 'excludeWatchlist': 'false', 'popFilter': '2', 'genreFilters': ''},
+    'genre': lambda users: {'users': users[0], 'excludeWatchlist': 'false', 'popFilter': 'null', 'genreFilters': 'Horror,Science Fiction'},
+    'watchlist': lambda users: {'users': users[0], 'excludeWatchlist': 'true', 'popFilter': 'null', 'genreFilters': ''}
+}
+
+
+def write_synthetic_model(directory, n_films=20000, n_factors=100, seed=0, film_meta=False):
+    '''
+        Takes in string representing directory to write to, number of films, number of latent factors, seed, and boolean indicating
+        whether to write a film metadata store too.
+        Writes model bundle of random factors and biases shaped like a trained model's, with a retrieval index, and if film_meta,
+        data/film_meta.npz with the viewers and genres letterboxd_stub.py serves for each film.
+    '''
+
+    rng = np.random.default_rng(seed)
+    film_links = [f'/film/bench-film-{i}/' for i in range(n_films)]
+    qi = rng.normal(0, 0.1, (n_films, n_factors)).astype(np.float32)
+    bi = rng.normal(0, 0.5, n_films).astype(np.float32)
+
+    # Most films are on the popular list, in a random order
+    film_ranks = np.full(n_films, unranked, dtype=np.int32)
+    ranked = rng.permutation(n_films)[:int(n_films * 0.8)]
+    film_ranks[ranked] = np.arange(1, len(ranked) + 1)
+
+    # Index lists are centred on random films rather than clustered, so recall is worse than a trained index's but queries probe
+    # the same number of lists of about the same sizes
+    items = np.hstack([qi, bi[:, None]])
+    n_lists = max(1, int(4 * np.sqrt(n_films)))
+    centroids = items[rng.choice(n_films, n_lists, replace=False)]
+    assignments = np.argmax(items @ centroids.T, axis=1)
+    list_items = np.argsort(assignments, kind='stable')
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    os.makedirs(f'{directory}/data', exist_ok=True)
+    write_bundle(
+        f'{directory}/model.bundle',
+        arrays={
+            'qi': qi,
+            'bi': bi,
+            'film_ranks': film_ranks,
+            'index.centroids': centroids,
+            'index.list_offsets': list_offsets,
+            'index.list_items': list_items
+        },
+        strings={'film_links': film_links, 'film_titles': [f'Bench Film {i}' for i in range(n_films)]},
+        meta={
+            'global_mean': 6.5,
+            'rating_scale': [1, 10],
+            'reg_bu': 0.02,
+            'reg_pu': 0.02,
+            'rating_mean': 6.5,
+            'n_films': n_films,
+            'n_factors': n_factors,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+    )
+
+    # Store is laid out the way data-processing/film_scraper.py saves it, with hrefs sorted
+    if film_meta:
+        bits = {genre: 1 << i for i, genre in enumerate(genres)}
+        details = [film_details(link) for link in sorted(film_links)]
+        np.savez_compressed(
+            f'{directory}/data/film_meta.npz',
+            links=np.array(sorted(film_links), dtype=str),
+            viewers=np.array([viewers for (viewers, _) in details], dtype=np.int64),
+            genres=np.array([sum(bits[genre] for genre in film_genres) for (_, film_genres) in details], dtype=np.uint32),
+            genre_names=np.array(genres, dtype=str)
+        )
+
+
+def process_memory(pid):
+    '''
+        Takes in integer representing process id.
+        Returns tuple of process's peak and current resident set size in megabytes, or Nones where /proc isn't available.
+    '''
+
+    try:
+        with open(f'/proc/{pid}/status') as fh:
+            fields = dict(line.split(':', 1) for line in fh if ':' in line)
+        return tuple(round(int(fields[name].split()[0]) / 2**10, 1) for name in ('VmHWM', 'VmRSS'))
+
+    except (OSError, KeyError, ValueError):
+        return (None, None)
+
+
+async def wait_until_up(url, session, timeout=60):
+    # Polling url until it responds, so requests aren't timed while the server is still loading
+    deadline = time.time() + timeout
+    while True:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+
+        if time.time() > deadline:
+            raise RuntimeError(f'{url} did not come up within {timeout} seconds')
+        await asyncio.sleep(0.2)
+
+
+async def run_level(api_url, scenario, users_for, concurrency, n_requests, session):
+    '''
+        Takes in string representing url of /api/, name of scenario, function returning list of users for request number i,
+        number of requests to keep in flight, total number of requests, and aiohttp.ClientSession object.
+        Returns tuple of numpy array of each successful request's latency in milliseconds, number of failed requests, and seconds
+        the level took.
+    '''
+
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal errors, next_request
+        while next_request < n_requests:
+            i = next_request
+            next_request += 1
+
+            t0 = time.perf_counter()
+            try:
+                async with session.get(api_url, params=scenarios[scenario](users_for(i))) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+
+            if ok:
+                latencies.append((time.perf_counter() - t0) * 1000)
+            else:
+                errors += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    return (np.array(latencies), errors, time.perf_counter() - t0)
+
+
+async def run_benchmark(args, api_url, stub_url, api_pid, users):
+    '''
+        Takes in parsed arguments, string representing url of /api/, string representing url of stub, integer representing API
+        process id, and list of recorded users to request (generated users are named per request if empty).
+        Returns list of dicts of results, one per scenario and concurrency level.
+    '''
+
+    results = []
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        await wait_until_up(f'{stub_url}/_stats', session)
+        await wait_until_up(api_url.replace('/api/', '/openapi.json'), session, timeout=args.timeout)
+
+        # One untimed request so first timed one doesn't pay for anything loaded lazily
+        await run_level(api_url, 'single', lambda i: ['bench-warmup'], 1, 1, session)
+
+        for scenario in args.scenarios.split(','):
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                # Each request gets users no other request has asked for, unless recorded users are being cycled through
+                def users_for(i):
+                    if users:
+                        return [users[(i + j) % len(users)] for j in range(3)]
+                    return [f'bench-{scenario}-{concurrency}-{i}-{j}' for j in range(3)]
+
+                async with session.get(f'{stub_url}/_stats') as response:
+                    before = await response.json()
+
+                (latencies, errors, seconds) = await run_level(api_url, scenario, users_for, concurrency, args.requests, session)
+
+                async with session.get(f'{stub_url}/_stats') as response:
+                    after = await response.json()
+
+                pages = sum(after[kind] - before[kind] for kind in ('films', 'watchlist', 'members', 'genres'))
+                (peak_rss, rss) = process_memory(api_pid)
+                percentiles = np.percentile(latencies, [50, 95, 99]).round(1).tolist() if len(latencies) else [None] * 3
+
+                results.append({
+                    'scenario': scenario,
+                    'concurrency': concurrency,
+                    'requests': args.requests,
+                    'errors': errors,
+                    'p50_ms': percentiles[0],
+                    'p95_ms': percentiles[1],
+                    'p99_ms': percentiles[2],
+                    'mean_ms': round(float(latencies.mean()), 1) if len(latencies) else None,
+                    'throughput_rps': round(len(latencies) / seconds, 2),
+                    'pages_per_request': round(pages / args.requests, 1),
+                    'api_peak_rss_mb': peak_rss,
+                    'api_rss_mb': rss
+                })
+                print(f'{scenario:>12}{concurrency:>6}{percentiles[0] or 0:>10.1f}{percentiles[1] or 0:>10.1f}{percentiles[2] or 0:>10.1f}'
+                      f'{results[-1]["throughput_rps"]:>10.2f}{results[-1]["pages_per_request"]:>9.1f}{errors:>8}{peak_rss or 0:>10.1f}')
+
+    return results
+
+
+def git_commit():
+    # Commit benchmark was run at, so reports can be matched with the change they measured
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /api/ latency end to end against a local stand-in for Letterboxd.')
+    parser.add_argument('--scenarios', default=','.join(scenarios), help='Comma separated scenarios to run')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma separated numbers of requests in flight')
+    parser.add_argument('--requests', type=int, default=32, help='Number of requests sent at each concurrency level')
+    parser.add_argument('--model-dir', default=None, help='Directory with model.bundle to serve instead of a synthetic model')
+    parser.add_argument('--data-dir', default=None, help='Directory with film_meta.npz to serve with --model-dir')
+    parser.add_argument('--films', type=int, default=20000, help='Number of films in synthetic model')
+    parser.add_argument('--factors', type=int, default=100, help='Number of latent factors in synthetic model')
+    parser.add_argument('--film-meta', action='store_true', help='Give synthetic model a film metadata store so filters scrape less')
+    parser.add_argument('--fixtures', default=None, help='Directory of pages recorded by data-processing/benchmark_parsers.py to serve')
+    parser.add_argument('--films-per-user', type=int, default=300, help='Average number of films in a generated member\'s films')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Milliseconds stub delays each page by')
+    parser.add_argument('--jitter-ms', type=float, default=20.0, help='Standard deviation of stub\'s delay in milliseconds')
+    parser.add_argument('--http-cache', action='store_true', help='Leave API\'s response cache on (it\'s off so every page is fetched)')
+    parser.add_argument('--api-port', type=int, default=8090, help='Port to run API on')
+    parser.add_argument('--stub-port', type=int, default=8091, help='Port to run stub on')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Seconds a request may take before it counts as failed')
+    parser.add_argument('--output', default='reports', help='Directory to save report and server logs in')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = args.model_dir
+        data_dir = args.data_dir or (f'{tmp}/data' if model_dir is None else 'app/data')
+        if model_dir is None:
+            model_dir = tmp
+            write_synthetic_model(tmp, args.films, args.factors, film_meta=args.film_meta)
+            print(f'Wrote synthetic model of {args.films} films to {tmp}')
+
+        fixtures = load_fixtures(args.fixtures) if args.fixtures else {}
+        users = recorded_users(fixtures)
+
+        stub_url = f'http://127.0.0.1:{args.stub_port}'
+        env = dict(
+            os.environ,
+            LETTERBOXD_URL=stub_url,
+            MODEL_DIR=model_dir,
+            MODEL_DATA_DIR=data_dir,
+            HTTP_CACHE_PATH=os.environ.get('HTTP_CACHE_PATH', 'cache/http_cache.sqlite3') if args.http_cache else ''
+        )
+
+        stub_command = [sys.executable, 'letterboxd_stub.py', '--port', str(args.stub_port), '--model-dir', model_dir,
+                        '--films-per-user', str(args.films_per_user), '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms)]
+        if args.fixtures:
+            stub_command += ['--fixtures', args.fixtures]
+        api_command = [sys.executable, '-m', 'uvicorn', 'app.main:app', '--host', '127.0.0.1', '--port', str(args.api_port), '--log-level', 'warning']
+
+        # Server output goes to a log next to the report, since the API prints a few lines for every request
+        log_path = f'{args.output}/api-bench-{stamp}.log'
+        with open(log_path, 'w') as log:
+            stub = subprocess.Popen(stub_command, stdout=log, stderr=subprocess.STDOUT)
+            api = subprocess.Popen(api_command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+            try:
+                print(f'{"scenario":>12}{"conc":>6}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}{"pages":>9}{"errors":>8}{"peak MB":>10}')
+                results = asyncio.run(run_benchmark(args, f'http://127.0.0.1:{args.api_port}/api/', stub_url, api.pid, users))
+            finally:
+                api.terminate()
+                stub.terminate()
+                api.wait()
+                stub.wait()
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'api_port', 'stub_port')},
+        'results': results
+    }
+    path = f'{args.output}/api-bench-{stamp}.json'
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=4)
+
+    print(f'Saved benchmark report to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+'''
+    Local stand-in for the Letterboxd pages the API scrapes: members' films and watchlists, and films' /members/ and /genres/ pages.
+    Serves pages recorded by data-processing/benchmark_parsers.py where there are some, and generates the rest from the films in a
+    model bundle, with the markup app/extract.py reads. Every response can be delayed to stand in for Letterboxd's latency.
+    Used by benchmark_api.py, and can be run on its own with the API's LETTERBOXD_URL pointed at it.
+'''
+
+from app.model_bundle import ModelBundle
+from app.scraping import genres
+from aiohttp import web
+import numpy as np
+import argparse
+import asyncio
+import random
+import html
+import zlib
+import os
+
+
+# Films per page of a member's films and of a watchlist, as Letterboxd paginates them
+films_per_page = 72
+watchlist_per_page = 28
+
+
+def film_details(film_link, seed=0):
+    '''
+        Takes in string representing film href and seed.
+        Returns tuple of film's number of viewers and list of its genres, the same every time for the same film and seed.
+    '''
+
+    rng = np.random.default_rng([seed, zlib.crc32(film_link.encode())])
+    viewers = int(10 ** rng.uniform(1, 6.5))
+    film_genres = [genres[i] for i in sorted(rng.choice(len(genres), rng.integers(1, 4), replace=False))]
+
+    return (viewers, film_genres)
+
+
+def load_fixtures(fixtures_dir):
+    '''
+        Takes in string representing directory of pages saved by data-processing/benchmark_parsers.py.
+        Returns dict mapping each path stub serves to html recorded for it. Recorded films and watchlist pages are their first pages.
+    '''
+
+    paths = {}
+    for file_name in sorted(os.listdir(fixtures_dir)):
+        if '--' not in file_name or not file_name.endswith('.html'):
+            continue
+
+        (kind, name) = file_name[:-len('.html')].split('--', 1)
+        with open(os.path.join(fixtures_dir, file_name), encoding='utf-8') as fh:
+            page = fh.read()
+
+        if kind in ('films', 'watchlist'):
+            paths[f'/{name}/{kind}/'] = paths[f'/{name}/{kind}/page/1/'] = page
+        elif kind == 'film-members':
+            paths[f'/film/{name}/members/'] = page
+        elif kind == 'film-genres':
+            paths[f'/film/{name}/genres/'] = page
+
+    return paths
+
+
+def recorded_users(fixtures):
+    '''
+        Takes in dict of recorded pages load_fixtures returned.
+        Returns sorted list of names of users whose films page was recorded.
+    '''
+
+    return sorted({path.split('/')[1] for path in fixtures if path.endswith('/films/')})
+
+
+def pagination(page, pages):
+    return '<div class="pagination"><ul>' + ''.join(f'<li class="paginate-page"><a>{i}</a></li>' for i in range(1, pages + 1)) + '</ul></div>'
+
+
+class LetterboxdStub:
+    '''
+        Generates members' films and watchlists from the films in film_links, at random but the same every time for the same user
+        and seed, and films' viewers and genres with film_details. Members have about films_per_user films, of which most are rated.
+        Keeps counts of requests served by kind of page in stats.
+    '''
+
+    def __init__(self, film_links, film_titles, fixtures=None, films_per_user=300, latency=0.0, jitter=0.0, seed=0):
+        self.film_links = film_links
+        self.film_titles = film_titles
+        self.fixtures = fixtures or {}
+        self.films_per_user = films_per_user
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.stats = {'films': 0, 'watchlist': 0, 'members': 0, 'genres': 0, 'recorded': 0}
+
+    def user_films(self, user):
+        # User's films with their ratings, None for films logged without a rating and '16' for films liked but not rated
+        rng = np.random.default_rng([self.seed, zlib.crc32(user.encode())])
+        n_films = min(max(1, int(rng.poisson(self.films_per_user))), len(self.film_links))
+        films = rng.choice(len(self.film_links), n_films, replace=False)
+        ratings = [str(rating) if kind < 0.85 else ('16' if kind < 0.9 else None)
+                   for (rating, kind) in zip(rng.integers(1, 11, n_films).tolist(), rng.random(n_films).tolist())]
+
+        return (films.tolist(), ratings)
+
+    def user_watchlist(self, user):
+        rng = np.random.default_rng([self.seed + 1, zlib.crc32(user.encode())])
+        n_films = min(max(1, int(rng.poisson(self.films_per_user / 3))), len(self.film_links))
+
+        return rng.choice(len(self.film_links), n_films, replace=False).tolist()
+
+    def films_page(self, user, page):
+        (films, ratings) = self.user_films(user)
+        pages = -(-len(films) // films_per_page)
+        start = (page - 1) * films_per_page
+
+        posters = []
+        for (film, rating) in zip(films[start:start + films_per_page], ratings[start:start + films_per_page]):
+            rating_span = f'<span class="rating rated-{rating}"></span>' if rating is not None else ''
+            posters.append(
+                f'<li class="poster-container"><div class="film-poster" data-target-link="{self.film_links[film]}">'
+                f'<img alt="{html.escape(self.film_titles[film])}"/></div><p class="poster-viewingdata">{rating_span}</p></li>'
+            )
+
+        return f'<html><body><ul class="poster-list">{"".join(posters)}</ul>{pagination(page, pages)}</body></html>'
+
+    def watchlist_page(self, user, page):
+        films = self.user_watchlist(user)
+        pages = -(-len(films) // watchlist_per_page)
+        start = (page - 1) * watchlist_per_page
+
+        posters = [
+            f'<li class="poster-container"><div class="film-poster" data-target-link="{self.film_links[film]}">'
+            f'<img alt="{html.escape(self.film_titles[film])}"/></div></li>'
+            for film in films[start:start + watchlist_per_page]
+        ]
+
+        return f'<html><body><ul class="poster-list">{"".join(posters)}</ul>{pagination(page, pages)}</body></html>'
+
+    def members_page(self, film_link):
+        (viewers, _) = film_details(film_link, self.seed)
+        return f'<html><body><ul><li class="js-route-watches"><a title="{viewers:,} people">Watched</a></li></ul></body></html>'
+
+    def genres_page(self, film_link):
+        (_, film_genres) = film_details(film_link, self.seed)
+        links = ''.join(f'<a href="/films/genre/{genre.lower()}/">{genre}</a>' for genre in film_genres)
+        return f'<html><body><div id="tab-genres"><div class="text-sluglist">{links}</div></div></body></html>'
+
+    async def handle(self, request):
+        # Every page is delayed by latency plus or minus jitter seconds before it's served
+        delay = max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+
+        path = request.path
+        parts = path.strip('/').split('/')
+        kind = parts[2] if parts[0] == 'film' and len(parts) == 3 else parts[1] if len(parts) > 1 else None
+        if kind not in self.stats:
+            raise web.HTTPNotFound()
+        self.stats[kind] += 1
+
+        if path in self.fixtures:
+            self.stats['recorded'] += 1
+            return web.Response(text=self.fixtures[path], content_type='text/html')
+
+        if kind in ('films', 'watchlist'):
+            page = int(parts[3]) if len(parts) == 4 and parts[2] == 'page' else 1
+            body = (self.films_page if kind == 'films' else self.watchlist_page)(f'/{parts[0]}/', page)
+        elif kind == 'members':
+            body = self.members_page(f'/film/{parts[1]}/')
+        else:
+            body = self.genres_page(f'/film/{parts[1]}/')
+
+        return web.Response(text=body, content_type='text/html')
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        '''
+            Returns aiohttp.web.Application object serving stub's pages, and counts of requests served so far at /_stats.
+        '''
+
+        app = web.Application()
+        app.router.add_get('/_stats', self.handle_stats)
+        app.router.add_get('/{path:.*}', self.handle)
+
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stand-ins for the Letterboxd pages the API scrapes.')
+    parser.add_argument('--port', type=int, default=8081, help='Port to serve on')
+    parser.add_argument('--model-dir', default='app/pickles', help='Directory with model.bundle whose films members have logged')
+    parser.add_argument('--fixtures', default=None, help='Directory of pages recorded by data-processing/benchmark_parsers.py')
+    parser.add_argument('--films-per-user', type=int, default=300, help='Average number of films in a generated member\'s films')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Milliseconds each page is delayed by')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Standard deviation of each page\'s delay in milliseconds')
+    parser.add_argument('--seed', type=int, default=0, help='Seed members\' films and films\' details are generated from')
+    args = parser.parse_args()
+
+    bundle = ModelBundle(f'{args.model_dir}/model.bundle')
+    stub = LetterboxdStub(
+        bundle.strings('film_links'),
+        bundle.strings('film_titles'),
+        load_fixtures(args.fixtures) if args.fixtures else None,
+        films_per_user=args.films_per_user,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        seed=args.seed
+    )
+
+    web.run_app(stub.app(), host='127.0.0.1', port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
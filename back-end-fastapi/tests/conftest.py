@@ -0,0 +1,25 @@
+import sys
+import os
+
+# Tests import the API as the app package, the way uvicorn runs it from back-end-fastapi
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.scoring import ScoringEngine
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def make_engine():
+    '''
+        Returns function taking in number of films, number of latent factors, regularization of folded in users and seed, that
+        returns ScoringEngine object with random biases and factors for films named /film/film-<i>/.
+    '''
+
+    def make(n_films=200, n_factors=5, reg=0.02, seed=0):
+        rng = np.random.default_rng(seed)
+        film_links = [f'/film/film-{i}/' for i in range(n_films)]
+
+        return ScoringEngine(3.5, rng.normal(0, 0.3, n_films), rng.normal(0, 0.5, (n_films, n_factors)), film_links, (0.5, 5.0), reg, reg)
+
+    return make
@@ -0,0 +1,70 @@
+from app.item_index import ItemIndex
+from app.scoring import ScoringEngine
+import numpy as np
+
+
+def make_users(engine, n_users=20, seed=1):
+    rng = np.random.default_rng(seed)
+    return [(float(bu), pu) for (bu, pu) in zip(rng.normal(0, 0.2, n_users), rng.normal(0, 0.5, (n_users, engine.n_factors)))]
+
+
+def indexed(engine, nprobe, **build_args):
+    index = ItemIndex.build(engine.qi, engine.bi, **build_args)
+    copy = ScoringEngine(engine.global_mean, engine.bi, engine.qi, engine.film_links, engine.rating_scale, engine.reg_bu, engine.reg_pu)
+    copy.attach_index(index, nprobe)
+
+    return copy
+
+
+def test_build_puts_every_film_in_exactly_one_list(make_engine):
+    engine = make_engine(n_films=2000, n_factors=8)
+    index = ItemIndex.build(engine.qi, engine.bi, n_lists=40)
+
+    assert index.n_lists == 40
+    assert index.list_offsets[-1] == engine.n_films
+    assert sorted(index.list_items) == list(range(engine.n_films))
+
+
+def test_probing_every_list_matches_exact_scan(make_engine):
+    engine = make_engine(n_films=2000, n_factors=8)
+    index_engine = indexed(engine, nprobe=40, n_lists=40)
+
+    for user in make_users(engine):
+        (exact_top, exact_scores) = engine.top_k(user, 50)
+        (top, scores) = index_engine.top_k(user, 50)
+
+        assert list(top) == list(exact_top)
+        assert np.allclose(scores, exact_scores, atol=1e-5)
+
+
+def test_probing_some_lists_finds_most_of_exact_top_k(make_engine):
+    engine = make_engine(n_films=2000, n_factors=8)
+    index_engine = indexed(engine, nprobe=10, n_lists=40)
+
+    recalls = [len(np.intersect1d(engine.top_k(user, 20)[0], index_engine.top_k(user, 20)[0])) / 20 for user in make_users(engine)]
+
+    assert np.mean(recalls) > 0.75
+
+
+def test_indexed_top_k_leaves_out_excluded_films_and_still_returns_k(make_engine):
+    engine = make_engine(n_films=2000, n_factors=8)
+    index_engine = indexed(engine, nprobe=1, n_lists=40)
+    user = make_users(engine)[0]
+    exclude = np.arange(engine.n_films) % 3 > 0
+
+    (top, _) = index_engine.top_k(user, 200, exclude)
+
+    assert len(top) == 200
+    assert not exclude[top].any()
+
+
+def test_save_and_load_round_trip(make_engine, tmp_path):
+    engine = make_engine(n_films=300, n_factors=8)
+    index = ItemIndex.build(engine.qi, engine.bi, n_lists=10)
+    index.save(tmp_path / 'item_index.npz')
+
+    loaded = ItemIndex.load(tmp_path / 'item_index.npz')
+
+    assert np.array_equal(loaded.centroids, index.centroids)
+    assert np.array_equal(loaded.list_offsets, index.list_offsets)
+    assert np.array_equal(loaded.list_items, index.list_items)
@@ -0,0 +1,85 @@
+from app.retry import RetryPolicy, parse_retry_after
+from email.utils import formatdate
+import asyncio
+import time
+import pytest
+
+
+def responses(*results):
+    # Stand-in for request_html returning each of results in turn, a tuple of status, text and Retry-After
+    results = list(results)
+
+    async def request(url, session):
+        return results.pop(0)
+
+    return request
+
+
+def run_call(policy, request, monkeypatch, deadline=None):
+    # Recording sleeps instead of taking them
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    result = asyncio.run(policy.call(request, 'https://letterboxd.com/film/x/', None, deadline))
+
+    return (result, sleeps)
+
+
+def test_parse_retry_after_takes_seconds_or_http_date():
+    assert parse_retry_after('7') == 7.0
+    assert parse_retry_after('-3') == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    assert 25 < parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+    assert parse_retry_after(formatdate(time.time() - 30, usegmt=True)) == 0.0
+
+
+def test_throttled_request_waits_at_least_retry_after(monkeypatch):
+    policy = RetryPolicy(base_delay=0.01, max_delay=0.01)
+    request = responses((429, '', '12'), (200, 'ok', None))
+
+    (result, sleeps) = run_call(policy, request, monkeypatch)
+
+    assert result == (200, 'ok')
+    assert sleeps == [12.0]
+    assert policy.stats['throttled'] == 1 and policy.stats['retries'] == 1
+
+
+def test_retry_after_is_capped_at_max_retry_after(monkeypatch):
+    policy = RetryPolicy(base_delay=0.01, max_delay=0.01, max_retry_after=5.0)
+
+    (_, sleeps) = run_call(policy, responses((503, '', '3600'), (200, 'ok', None)), monkeypatch)
+
+    assert sleeps == [5.0]
+
+
+def test_retry_after_past_deadline_gives_up_with_last_response(monkeypatch):
+    policy = RetryPolicy(base_delay=0.01, max_delay=0.01)
+
+    (result, sleeps) = run_call(policy, responses((429, 'slow down', '60')), monkeypatch, deadline=10)
+
+    assert result == (429, 'slow down')
+    assert sleeps == []
+    assert policy.stats['gave_up'] == 1
+
+
+def test_client_errors_are_returned_without_retrying(monkeypatch):
+    policy = RetryPolicy()
+
+    (result, sleeps) = run_call(policy, responses((404, 'not found', '5')), monkeypatch)
+
+    assert result == (404, 'not found')
+    assert sleeps == []
+    assert policy.stats['client_errors'] == 1
+
+
+@pytest.mark.parametrize('attempt', [1, 3, 8])
+def test_backoff_without_retry_after_stays_under_exponential_cap(attempt):
+    policy = RetryPolicy(base_delay=0.5, max_delay=30.0)
+
+    delays = [policy.backoff(attempt) for _ in range(200)]
+
+    assert all(0 <= delay <= min(30.0, 0.5 * 2 ** (attempt - 1)) for delay in delays)
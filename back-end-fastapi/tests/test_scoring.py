@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def make_user(engine, seed=1):
+    rng = np.random.default_rng(seed)
+    return (0.2, rng.normal(0, 0.5, engine.n_factors))
+
+
+def test_top_k_matches_full_sort_of_scores(make_engine):
+    engine = make_engine(n_films=500, n_factors=8)
+    user = make_user(engine)
+    ests = engine.score(user)
+
+    (top, scores) = engine.top_k(user, 25)
+
+    assert list(top) == list(np.argsort(-ests, kind='stable')[:25])
+    assert np.allclose(scores, np.clip(ests[top], 0.5, 5.0))
+
+
+def test_top_k_leaves_out_excluded_films(make_engine):
+    engine = make_engine(n_films=500, n_factors=8)
+    user = make_user(engine)
+    exclude = engine.mask(engine.film_links[engine.top_k(user, 10)[0]])
+
+    (top, _) = engine.top_k(user, 10, exclude)
+
+    assert len(top) == 10
+    assert not exclude[top].any()
+    assert engine.score(user)[top].max() <= engine.score(user)[exclude].min()
+
+
+def test_top_k_returns_every_candidate_when_k_exceeds_them(make_engine):
+    engine = make_engine(n_films=20, n_factors=8)
+    user = make_user(engine)
+    exclude = np.zeros(engine.n_films, dtype=bool)
+    exclude[5:] = True
+
+    (top, scores) = engine.top_k(user, 100, exclude)
+
+    assert sorted(top) == [0, 1, 2, 3, 4]
+    assert list(scores) == sorted(scores, reverse=True)
+
+
+def test_top_k_with_every_film_excluded_is_empty(make_engine):
+    engine = make_engine(n_films=20, n_factors=8)
+
+    (top, scores) = engine.top_k(make_user(engine), 10, np.ones(engine.n_films, dtype=bool))
+
+    assert len(top) == 0 and len(scores) == 0
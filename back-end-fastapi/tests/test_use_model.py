@@ -0,0 +1,47 @@
+from app.use_model import fold_in_user
+import numpy as np
+
+
+def test_fold_in_user_recovers_factors_of_user_model_would_fit(make_engine):
+    engine = make_engine(reg=1e-6)
+    (bu, pu) = (0.4, np.array([0.5, -0.3, 0.2, 0.0, 0.8]))
+    film_ids = np.arange(0, 200, 2)
+    targets = engine.global_mean + bu + engine.bi[film_ids] + engine.qi[film_ids] @ pu
+    ratings = [{'Film Link': engine.film_links[i], 'Rating': rating} for (i, rating) in zip(film_ids, targets)]
+
+    (fit_bu, fit_pu) = fold_in_user(ratings, engine)
+
+    assert np.isclose(fit_bu, bu, atol=1e-3)
+    assert np.allclose(fit_pu, pu, atol=1e-3)
+
+
+def test_fold_in_user_ignores_unknown_and_unrated_films(make_engine):
+    engine = make_engine()
+    ratings = [{'Film Link': engine.film_links[i], 'Rating': 1 + i % 5} for i in range(30)]
+    extra = [{'Film Link': '/film/not-in-model/', 'Rating': 5}, {'Film Link': engine.film_links[40]}]
+
+    (bu, pu) = fold_in_user(ratings, engine)
+    (extra_bu, extra_pu) = fold_in_user(ratings + extra, engine)
+
+    assert np.isclose(bu, extra_bu)
+    assert np.allclose(pu, extra_pu)
+
+
+def test_fold_in_user_without_known_ratings_gives_average_user(make_engine):
+    engine = make_engine()
+    ratings = [{'Film Link': '/film/not-in-model/', 'Rating': 4}, {'Film Link': engine.film_links[0]}]
+
+    (bu, pu) = fold_in_user(ratings, engine)
+
+    assert bu == 0.0
+    assert pu.shape == (engine.n_factors,) and not pu.any()
+
+
+def test_fold_in_user_shrinks_towards_average_user_with_few_ratings(make_engine):
+    engine = make_engine(reg=0.5)
+    ratings = [{'Film Link': engine.film_links[0], 'Rating': 5.0}]
+    residual = 5.0 - engine.global_mean - engine.bi[0]
+
+    (bu, _) = fold_in_user(ratings, engine)
+
+    assert 0 < bu < residual
@@ -0,0 +1,81 @@
+'''
+    For choosing how many inverted lists to probe in pickles/item_index.npz. Compares index's top-k against exact full scan for
+    users in the trained model and reports recall and latency at each setting.
+'''
+
+from item_index import ItemIndex
+import numpy as np
+import argparse
+import pickle
+import time
+
+
+def exact_top_k(qi, bi, user_factors, k):
+    '''
+        Takes in numpy array of item factors, numpy array of item biases, tuple of user's bias and latent factors, and number of films.
+        Returns numpy array of ids of the k highest scoring films found by scoring every film.
+    '''
+
+    scores = qi @ user_factors[1] + bi
+    top = np.argpartition(-scores, k - 1)[:k]
+
+    return top[np.argsort(-scores[top])]
+
+
+def time_queries(search, queries):
+    '''
+        Takes in function that runs a single query and list of queries.
+        Returns tuple of list of each query's results and numpy array of each query's latency in milliseconds.
+    '''
+
+    results = []
+    latencies = []
+    for query in queries:
+        t0 = time.perf_counter()
+        results.append(search(query))
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    return (results, np.array(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark recall and latency of item index against exact search.')
+    parser.add_argument('--nprobe', default='1,2,4,8,16,32,64', help='Comma separated numbers of lists to probe')
+    parser.add_argument('--k', type=int, default=1000, help='Number of films retrieved per query')
+    parser.add_argument('--queries', type=int, default=200, help='Number of users to query with')
+    parser.add_argument('--n-lists', type=int, default=None, help='Rebuild index with this many lists instead of loading it')
+    args = parser.parse_args()
+
+    with open('pickles/rec_model.pkl', 'rb') as pkl:
+        algo = pickle.load(pkl)
+
+    qi = np.ascontiguousarray(algo.qi, dtype=np.float32)
+    bi = np.ascontiguousarray(algo.bi, dtype=np.float32)
+
+    if args.n_lists:
+        t0 = time.time()
+        index = ItemIndex.build(qi, bi, n_lists=args.n_lists)
+        print(f'Built index with {index.n_lists} lists in {time.time() - t0:.1f} seconds')
+    else:
+        index = ItemIndex.load('pickles/item_index.npz')
+
+    # Querying with factors of users the model was trained on
+    rng = np.random.default_rng(0)
+    users = rng.choice(len(algo.pu), min(args.queries, len(algo.pu)), replace=False)
+    queries = [(algo.bu[user], algo.pu[user].astype(np.float32)) for user in users]
+    k = min(args.k, len(qi))
+
+    (exact_results, exact_latencies) = time_queries(lambda query: exact_top_k(qi, bi, query, k), queries)
+    print(f'{len(qi)} films, {index.n_lists} lists, k={k}, {len(queries)} queries')
+    print(f'exact scan: mean {exact_latencies.mean():.2f} ms, p95 {np.percentile(exact_latencies, 95):.2f} ms')
+
+    print(f'{"nprobe":>8}{"recall":>10}{"mean ms":>10}{"p95 ms":>10}{"speedup":>10}')
+    for nprobe in (int(n) for n in args.nprobe.split(',')):
+        (results, latencies) = time_queries(lambda query: index.search(qi, bi, query, k, nprobe)[0], queries)
+        recall = np.mean([len(np.intersect1d(result, exact)) / k for result, exact in zip(results, exact_results)])
+
+        print(f'{nprobe:>8}{recall:>10.4f}{latencies.mean():>10.2f}{np.percentile(latencies, 95):>10.2f}{exact_latencies.mean() / latencies.mean():>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+'''
+    For checking extract.py against the BeautifulSoup parsing it replaced. Runs both on html fixtures saved in fixtures/, reports any
+    page where their output differs, and reports pages/sec for each kind of page. The committed fixtures are hand-written pages in
+    Letterboxd's markup, so the benchmark runs offline; --record-user and --record-film add real pages alongside them.
+'''
+
+from members_scraper import fetch_html
+from bs4 import BeautifulSoup
+import extract
+import argparse
+import asyncio
+import aiohttp
+import time
+import os
+
+
+# Each kind of page is parsed the way scrapers used to with BeautifulSoup (soup_*) and the way they do now with extract.py (lxml_*).
+# Both return the same fields so their output can be compared.
+
+def soup_num_pages(soup):
+    paginate_pages = soup.find_all("li", class_="paginate-page")
+    return int(paginate_pages[-1].find('a').text) if paginate_pages else 1
+
+
+def soup_films(html):
+    soup = BeautifulSoup(html, 'lxml')
+    films = []
+    for film in soup.find_all("li", class_="poster-container"):
+        rating_span = film.find('p').find('span')
+        rating = rating_span.attrs['class'][-1].split('-')[1] if rating_span else None
+        film_info = film.find('div')
+        films.append((film_info.attrs['data-target-link'], film_info.find('img').attrs['alt'], rating))
+
+    return (soup_num_pages(soup), films)
+
+
+def lxml_films(html):
+    page = extract.parse(html)
+    return (extract.num_pages(page), list(extract.poster_films(page)))
+
+
+def soup_watchlist(html):
+    soup = BeautifulSoup(html, 'lxml')
+    return (soup_num_pages(soup), [film.find('div').attrs['data-target-link'] for film in soup.find_all('li', class_='poster-container')])
+
+
+def lxml_watchlist(html):
+    page = extract.parse(html)
+    return (extract.num_pages(page), list(extract.poster_links(page)))
+
+
+def soup_viewers(html):
+    soup = BeautifulSoup(html, 'lxml')
+    return int(soup.find('li', class_='js-route-watches').find('a').attrs['title'].split()[0].replace(',', ''))
+
+
+def lxml_viewers(html):
+    return extract.viewers(extract.parse(html))
+
+
+def soup_genres(html):
+    soup = BeautifulSoup(html, 'lxml')
+    return [genre.text for genre in soup.find('div', id="tab-genres").find_all('a')]
+
+
+def lxml_genres(html):
+    return extract.genres(extract.parse(html))
+
+
+def soup_popular_films(html):
+    soup = BeautifulSoup(html, 'lxml')
+    films = [(film.find('div').find('img').attrs['alt'], film.find('div').attrs['data-target-link']) for film in soup.find_all("li", class_="listitem poster-container")]
+    return (bool(soup.find('div', class_='pagination')), films)
+
+
+def lxml_popular_films(html):
+    page = extract.parse(html)
+    return (extract.has_pagination(page), list(extract.popular_films(page)))
+
+
+def soup_popular_members(html):
+    soup = BeautifulSoup(html, 'lxml')
+    return (soup.title.text, [member.find('a').attrs['href'] for member in soup.find_all("div", class_="person-summary")])
+
+
+def lxml_popular_members(html):
+    page = extract.parse(html)
+    return (extract.title(page), list(extract.member_links(page)))
+
+
+# Fixtures committed with the repo, found relative to this file so the benchmark runs from any directory
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Kind of page each fixture holds is the part of its file name before '--'. Each kind maps to the old and new way of parsing it.
+parsers = {
+    'films': (soup_films, lxml_films),
+    'watchlist': (soup_watchlist, lxml_watchlist),
+    'film-members': (soup_viewers, lxml_viewers),
+    'film-genres': (soup_genres, lxml_genres),
+    'popular-films': (soup_popular_films, lxml_popular_films),
+    'popular-members': (soup_popular_members, lxml_popular_members)
+}
+
+
+async def record(fixtures_dir, users, films):
+    '''
+        Takes in string representing directory to save fixtures in, list of Letterboxd user hrefs, and list of film hrefs.
+        Saves first page of each user's films and watchlist, each film's members and genres pages, and first page of popular films
+        and popular members.
+    '''
+
+    urls = {
+        'popular-films--1': 'https://letterboxd.com/films/ajax/popular/page/1/',
+        'popular-members--1': 'https://letterboxd.com/members/popular/page/1/'
+    }
+    for user in users:
+        urls[f'films--{user.strip("/")}'] = f'https://letterboxd.com{user}films/'
+        urls[f'watchlist--{user.strip("/")}'] = f'https://letterboxd.com{user}watchlist/'
+    for film in films:
+        urls[f'film-members--{film.strip("/").split("/")[-1]}'] = f'https://letterboxd.com{film}members/'
+        urls[f'film-genres--{film.strip("/").split("/")[-1]}'] = f'https://letterboxd.com{film}genres/'
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    async with aiohttp.ClientSession() as session:
+        responses = await asyncio.gather(*[fetch_html(url, session) for url in urls.values()])
+
+    for (name, (resp_code, html)) in zip(urls, responses):
+        if resp_code != 200:
+            print(f'Skipping {name}: response code {resp_code}')
+            continue
+
+        with open(os.path.join(fixtures_dir, f'{name}.html'), 'w', encoding='utf-8') as fh:
+            fh.write(html)
+
+        print(f'Saved {name}')
+
+
+def load_fixtures(fixtures_dir):
+    '''
+        Takes in string representing directory fixtures are saved in.
+        Returns dict mapping each kind of page to list of tuples of fixture name and its html.
+    '''
+
+    fixtures = {kind: [] for kind in parsers}
+    for file_name in sorted(os.listdir(fixtures_dir)):
+        kind = file_name.split('--')[0]
+        if kind in parsers and file_name.endswith('.html'):
+            with open(os.path.join(fixtures_dir, file_name), encoding='utf-8') as fh:
+                fixtures[kind].append((file_name, fh.read()))
+
+    return fixtures
+
+
+def pages_per_second(parse, pages, repeat):
+    '''
+        Takes in function that parses a page, list of html of pages, and number of times to parse each page.
+        Returns number of pages parsed per second.
+    '''
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            try:
+                parse(html)
+            except Exception:
+                pass
+
+    return repeat * len(pages) / (time.perf_counter() - t0)
+
+
+def run(parse, html):
+    try:
+        return parse(html)
+    except Exception as err:
+        return type(err)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lxml extraction against BeautifulSoup parsing on saved pages.')
+    parser.add_argument('--fixtures', default=fixtures_dir, help='Directory html fixtures are saved in')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of times each fixture is parsed')
+    parser.add_argument('--record-user', action='append', default=[], help='Letterboxd user href (e.g. /user/) to save pages of')
+    parser.add_argument('--record-film', action='append', default=[], help='Film href (e.g. /film/parasite-2019/) to save pages of')
+    args = parser.parse_args()
+
+    if args.record_user or args.record_film:
+        asyncio.run(record(args.fixtures, args.record_user, args.record_film))
+
+    fixtures = load_fixtures(args.fixtures)
+    mismatches = 0
+
+    print(f'{"page":>16}{"fixtures":>10}{"bs4 p/s":>12}{"lxml p/s":>12}{"speedup":>10}')
+    for (kind, (old_parse, new_parse)) in parsers.items():
+        if not fixtures[kind]:
+            continue
+
+        # Errors count as matching as long as both ways of parsing raise one, since scrapers handle any error the same way
+        for (file_name, html) in fixtures[kind]:
+            (old, new) = (run(old_parse, html), run(new_parse, html))
+            if old != new and not (isinstance(old, type) and isinstance(new, type)):
+                mismatches += 1
+                print(f'Mismatch in {file_name}:\n    bs4:  {old}\n    lxml: {new}')
+
+        pages = [html for (_, html) in fixtures[kind]]
+        old_rate = pages_per_second(old_parse, pages, args.repeat)
+        new_rate = pages_per_second(new_parse, pages, args.repeat)
+
+        print(f'{kind:>16}{len(pages):>10}{old_rate:>12.1f}{new_rate:>12.1f}{new_rate / old_rate:>10.1f}')
+
+    print(f'{mismatches} mismatches')
+
+
+if __name__ == '__main__':
+    main()
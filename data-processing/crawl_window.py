@@ -0,0 +1,59 @@
+'''
+    Concurrency window for crawls that adapts to how Letterboxd is responding, in the manner of TCP congestion control.
+'''
+
+import asyncio
+
+
+class AdaptiveWindow:
+    '''
+        Limits how many requests are in flight at once. Every request that succeeds grows the limit by 1/limit, so it grows by about
+        one per window's worth of requests, and a failed request halves it (additive increase, multiplicative decrease). The limit is
+        halved at most once per window's worth of requests, so one burst of failures doesn't collapse it.
+        Keeps counts of how the window moved.
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=50):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self._since_decrease = self.limit
+        self._changed = asyncio.Condition()
+        self.stats = {
+            'successes': 0,
+            'failures': 0,
+            'decreases': 0,
+            'peak_limit': self.limit
+        }
+
+    async def acquire(self):
+        '''
+            Waits until there's room in the window, then takes a slot.
+        '''
+
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, ok):
+        '''
+            Takes in boolean indicating whether request succeeded. Gives back slot and grows or shrinks window accordingly.
+        '''
+
+        async with self._changed:
+            self.in_flight -= 1
+            self._since_decrease += 1
+
+            if ok:
+                self.stats['successes'] += 1
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.stats['peak_limit'] = max(self.stats['peak_limit'], self.limit)
+            else:
+                self.stats['failures'] += 1
+                if self._since_decrease >= self.limit:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._since_decrease = 0
+                    self.stats['decreases'] += 1
+
+            self._changed.notify_all()
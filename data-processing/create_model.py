@@ -1,80 +1,248 @@
 '''
-    For creating SVD collaborative filtering model using random samples of scraped Letterboxd user data from data/ratings.csv.
-    Dumps algorithm to pickle file and dumps dataframe of user samples to pickle file to allow usage of model in recommendations.
+    For creating SVD collaborative filtering model from scraped Letterboxd user data in data/ratings, trained out of core on every
+    rating (or with surprise on random samples of each user's ratings).
+    Dumps algorithm to pickle file and saves ratings it was trained on as a compact rating store to allow usage of model in recommendations.
+    Also builds retrieval index over the model's item factors so recommendations don't have to score every film, and exports
+    everything the API serves with to a memory-mappable model bundle.
 '''
 
-from surprise import SVD, Reader, Dataset, accuracy
+from surprise import SVD, Reader, Dataset
+from item_index import ItemIndex
+from rating_store import RatingStore
+from sampling import sample_ratings
+from trainer import TrainingSet, StreamingSVD, drift_report, load_params
+from ratings_scraper import ratings_columns
+from film_scraper import films_columns, read_films
+from model_bundle import write_bundle, unranked
+import columnar
+import evaluation
+import tuning
+import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
 import time
-import random
 import pickle
+import json
+import sys
+import os
 
 
-def sample_ratings(user, user_ratings, n=200):
-    print(f'Sampling user {user}. . .')
-    
-    # Taking random samples from user's ratings
-    available_indices = list(range(len(user_ratings)))
-    sampled_data = []
-    i = 0
-    while i < len(user_ratings) and i < n:
-        idx = random.choice(available_indices)
-        sampled_data.append({
-            'User': user,
-            'Film': user_ratings[idx][2],
-            'Film Link': user_ratings[idx][3],
-            'Rating': user_ratings[idx][4]
-        })
+def main(mode='full'):
+    t0 = time.time()
+
+    if mode == 'sampled':
+        (algo, store) = train_sampled()
+    else:
+        # Training on every rating in data/ratings out of core. Ratings are coded into data/train a block of TRAIN_BLOCK_ROWS at a
+        # time and each epoch streams them back a block at a time, so memory use is set by block size and model size, not data size.
+        seed = os.environ.get('TRAIN_SEED')
+        seed = int(seed) if seed is not None else None
+        trainset = TrainingSet.build('data/ratings', 'data/train', block_rows=int(os.environ.get('TRAIN_BLOCK_ROWS', 1000000)), seed=seed)
+        print(f'Coded {trainset.n_ratings} ratings of {trainset.n_users} users and {trainset.n_films} films in {time.time() - t0:.1f} seconds')
+
+        # Hyperparameters found by "py create_model.py search" are used if it was run, surprise's defaults otherwise
+        model = StreamingSVD(**load_params(), random_state=seed).fit(trainset)
+        algo = model.to_surprise(trainset)
+        store = trainset.to_store()
 
-        available_indices.remove(idx)
-        i += 1
+    save_model(algo, store)
+
+    t1 = time.time()
+    print((t1-t0)/60, 'mins to build model.')
+
+    # Prompting user to evaluate model on held out ratings
+    test_model = input('Evaluate model? (Y/N): ').capitalize()
+    while (test_model != 'Y' and test_model != 'N'):
+        test_model = input('Evaluate model? (Y/N): ').capitalize()
+    if test_model == 'Y':
+        evaluation.main(sampled=mode == 'sampled')
 
-    return sampled_data
 
+def train_sampled():
+    '''
+        Trains surprise.SVD on a random sample of each user's ratings, as models were trained before the out-of-core trainer.
+        Returns tuple of trained surprise.SVD algorithm and RatingStore object with the sampled ratings.
+    '''
 
-def main():
     t0 = time.time()
 
-    # Sampling data
-    full_df = pd.read_csv('data/ratings.csv')
-    results = Parallel(n_jobs=-1)(
-        delayed(sample_ratings)(user, full_df[full_df['User'] == user].values.tolist())
-        for user in full_df['User'].unique()
+    # Sampling up to SAMPLE_PER_USER ratings per user in one streaming pass over data/ratings, SAMPLE_BATCH_ROWS rows at a time.
+    # Setting SAMPLE_SEED makes the sample reproducible.
+    seed = os.environ.get('SAMPLE_SEED')
+    store = sample_ratings(
+        'data/ratings',
+        per_user=int(os.environ.get('SAMPLE_PER_USER', 200)),
+        seed=int(seed) if seed is not None else None,
+        batch_rows=int(os.environ.get('SAMPLE_BATCH_ROWS', 2000000))
     )
+    print(f'Sampled {store.n_ratings} ratings of {len(store.user_links)} users in {time.time() - t0:.1f} seconds')
 
-    data = [rating for result in results for rating in result] 
-    df = pd.DataFrame(data)
-    df.to_pickle('pickles/model_df.pkl') # Dumping dataframe to pickle file to be used with model
     reader = Reader(rating_scale=(1, 10))
-    data = Dataset.load_from_df(df[["User", "Film Link", "Rating"]], reader)
+    data = Dataset.load_from_df(store.to_df(), reader)
 
     # Building trainset
     trainset = data.build_full_trainset()
 
     # Creating algorithm and training it
-    algo = SVD()
+    algo = SVD(**load_params())
     algo.fit(trainset)
 
+    return (algo, store)
+
+
+def update():
+    # Updating model with ratings scraped since it was trained (by "py ratings_scraper.py incremental"), rather than training again.
+    # New ratings are appended to data/train, then model is warm started from its parameters and trained for UPDATE_EPOCHS epochs on
+    # just the ratings of users who have new ones. How the updated model drifted from the previous one is saved to
+    # pickles/update_report.json.
+    t0 = time.time()
+
+    trainset = TrainingSet('data/train')
+    if not trainset.is_current('data/ratings'):
+        print('data/ratings was scraped again from scratch since model was trained. Run py create_model.py to train on it.')
+        return
+
+    with open('pickles/rec_model.pkl', 'rb') as pkl:
+        algo = pickle.load(pkl)
+
+    # Model's ids have to be data/train's first codes, which they only are if it was trained on data/train. Model's trainset records
+    # how many of data/train's ratings it was trained on, and ratings past those are the new ones. Ratings appended by an update
+    # that failed before saving the model are past them too, so they're trained on by the next update rather than lost.
+    (model_users, model_films) = (list(algo.trainset._raw2inner_id_users), list(algo.trainset._raw2inner_id_items))
+    first_new = algo.trainset.n_ratings
+    if trainset.user_links[:len(model_users)] != model_users or trainset.film_links[:len(model_films)] != model_films or first_new > trainset.n_ratings:
+        print("pickles/rec_model.pkl wasn't trained on data/train. Run py create_model.py to train on every rating first.")
+        return
+
+    seed = os.environ.get('TRAIN_SEED')
+    seed = int(seed) if seed is not None else None
+    trainset.append('data/ratings', block_rows=int(os.environ.get('TRAIN_BLOCK_ROWS', 1000000)), seed=seed)
+    if first_new == trainset.n_ratings:
+        print('No new ratings to update model with.')
+        return
+
+    previous = StreamingSVD.from_surprise(algo)
+    affected = np.unique(trainset.users[first_new:])
+    model = StreamingSVD.from_surprise(algo).partial_fit(trainset, affected, n_epochs=int(os.environ.get('UPDATE_EPOCHS', 3)))
+
+    report = drift_report(previous, model, trainset, first_new, affected, seed=seed)
+    report['seconds'] = round(time.time() - t0, 2)
+    report['ratings_trained_vs_full_fit'] = round(sum(epoch['ratings'] for epoch in model.epochs) / (trainset.n_ratings * algo.n_epochs), 4)
+    report['epochs'] = model.epochs
+
+    save_model(model.to_surprise(trainset), trainset.to_store())
+
+    with open('pickles/update_report.json', 'w') as fh:
+        json.dump(report, fh, indent=4)
+    print(f'Updated model with {report["new_ratings"]} new ratings in {report["seconds"]} seconds. Drift report:')
+    print(json.dumps({key: value for key, value in report.items() if key != 'epochs'}, indent=4))
+
+
+def save_model(algo, store):
+    '''
+        Takes in trained surprise.SVD algorithm and RatingStore object with ratings it was trained on.
+        Saves them to pickles, builds retrieval index over algorithm's item factors, and exports model bundle.
+    '''
+
+    store.save('pickles/ratings.npz') # Saving ratings model was trained on as integer coded rating store to be used with model
+
     # Dumping algorithm to pickle file
     with open('pickles/rec_model.pkl', 'wb') as file:
         pickle.dump(algo, file)
 
-    t1 = time.time()
-    print((t1-t0)/60, 'mins to build model.')
+    # Building index over item factors, list ids line up with algorithm's inner item ids
+    index = ItemIndex.build(algo.qi, algo.bi)
+    index.save('pickles/item_index.npz')
+
+    export_bundle(algo, store, index)
+
+
+def export_bundle(algo, store, index, path='pickles/model.bundle'):
+    '''
+        Takes in trained surprise.SVD algorithm, RatingStore object with ratings it was trained on, ItemIndex object built over its
+        item factors, and string representing path to write bundle to. Writes item factors and biases, film hrefs, titles and
+        popularity rankings, and index into a model bundle, with film ids matching algorithm's inner item ids.
+    '''
+
+    trainset = algo.trainset
+    film_links = [trainset.to_raw_iid(inner_id) for inner_id in range(trainset.n_items)]
+    film_ids = {link: film_id for film_id, link in enumerate(film_links)}
+
+    # Each film's best popularity ranking, with films that aren't in the popular list never counting as too popular
+    films_df = read_films(['Film Link', 'Ranking']).dropna(subset=['Ranking'])
+    ranked_ids = np.array([film_ids.get(link, -1) for link in films_df['Film Link']], dtype=np.int64)
+    known = ranked_ids >= 0
+    film_ranks = np.full(len(film_links), unranked, dtype=np.int32)
+    np.minimum.at(film_ranks, ranked_ids[known], films_df['Ranking'].to_numpy()[known].astype(np.int32))
+
+    write_bundle(
+        path,
+        arrays={
+            'qi': algo.qi.astype(np.float32),
+            'bi': algo.bi.astype(np.float32),
+            'film_ranks': film_ranks,
+            'index.centroids': index.centroids,
+            'index.list_offsets': index.list_offsets,
+            'index.list_items': index.list_items
+        },
+        strings={
+            'film_links': film_links,
+            'film_titles': [store.film_titles[store.film_code(link)] for link in film_links]
+        },
+        meta={
+            'global_mean': float(trainset.global_mean),
+            'rating_scale': list(trainset.rating_scale),
+            'reg_bu': float(algo.reg_bu),
+            'reg_pu': float(algo.reg_pu),
+            'rating_mean': float(store.ratings.mean()),
+            'n_films': len(film_links),
+            'n_factors': int(algo.qi.shape[1]),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+    )
 
-    # Prompting user to test model's RMSE
-    test_model = input('Test model? (Y/N): ').capitalize()
-    while (test_model != 'Y' and test_model != 'N'):
-        test_model = input('Test model? (Y/N): ').capitalize()
-    if test_model == 'Y':
-        try:
-            predictions_svd = algo.test(trainset.build_anti_testset())
-            accuracy.rmse(predictions_svd)
+    print(f'Exported model bundle to {path}')
+
+
+def convert():
+    # Converting files saved by older versions of the scrapers and this script, so previously scraped data and a previously trained
+    # model can be used without scraping, sampling and training again
+    if os.path.exists('pickles/model_df.pkl'):
+        store = RatingStore.from_df(pd.read_pickle('pickles/model_df.pkl'))
+        store.save('pickles/ratings.npz')
+        print(f'Converted {store.n_ratings} ratings to pickles/ratings.npz')
+
+    for (name, columns) in (('ratings', ratings_columns), ('films', films_columns)):
+        if os.path.exists(f'data/{name}.csv'):
+            rows = columnar.convert_csv(f'data/{name}.csv', f'data/{name}', columns)
+            print(f'Converted {rows} rows to data/{name}')
+
+    if os.path.exists('pickles/rec_model.pkl') and os.path.exists('pickles/ratings.npz'):
+        with open('pickles/rec_model.pkl', 'rb') as pkl:
+            algo = pickle.load(pkl)
+
+        # Models trained before the retrieval index existed don't have one saved, so one is built for them
+        if os.path.exists('pickles/item_index.npz'):
+            index = ItemIndex.load('pickles/item_index.npz')
+        else:
+            index = ItemIndex.build(algo.qi, algo.bi)
+            index.save('pickles/item_index.npz')
+            print(f'Built retrieval index of {index.n_lists} lists to pickles/item_index.npz')
 
-        except Exception as err:
-            print(f'Error testing model: {err}')
+        export_bundle(algo, RatingStore.load('pickles/ratings.npz'), index)
 
 
 if __name__ == '__main__':
-    main()
+    # "py create_model.py convert" converts existing pickles/model_df.pkl, data/ratings.csv and data/films.csv, and exports a model
+    # bundle from an existing model, instead of building a new model. "py create_model.py sampled" trains surprise.SVD on a sample
+    # of each user's ratings instead of training on every rating. "py create_model.py update" updates model with ratings scraped
+    # since it was trained. "py create_model.py search [random]" runs a grid (or random) search for the model's hyperparameters.
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        convert()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'sampled':
+        main('sampled')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'update':
+        update()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'search':
+        tuning.main('random' if 'random' in sys.argv[2:] else 'grid')
+    else:
+        main()
@@ -0,0 +1,178 @@
+'''
+    Offline evaluation of the SVD model on ratings held out of training. Holds out part of each user's ratings, at random or their
+    most recently logged, trains on the rest, then measures rating error on the held out ratings and how well held out films users
+    rated highly rank against films sampled from ones they haven't rated. Results are saved as a JSON report.
+'''
+
+from trainer import StreamingSVD, load_params, open_training_set
+from sampling import keep_per_user
+import numpy as np
+import resource
+import json
+import time
+import sys
+import os
+
+
+def holdout_mask(trainset, mode='random', fraction=0.1, min_ratings=5, seed=None):
+    '''
+        Takes in TrainingSet object, string representing how to choose ratings to hold out ('random' or 'time'), fraction of each
+        user's ratings to hold out, fewest ratings a user needs to have any held out, and optional seed.
+        Returns boolean numpy array over training set's ratings that's True for held out ratings. 'time' holds out each user's most
+        recently logged ratings.
+    '''
+
+    rng = np.random.default_rng(seed)
+    users = np.asarray(trainset.users)
+    counts = np.bincount(users, minlength=trainset.n_users)
+    n_held = np.where(counts >= min_ratings, np.maximum(1, np.floor(counts * fraction)), 0).astype(np.int64)
+
+    # Ordering each user's ratings by what should be held out first
+    keys = rng.random(len(users)) if mode == 'random' else -np.asarray(trainset.logged)
+    order = np.lexsort((keys, users))
+    sorted_users = users[order]
+    starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+    ranks = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    held = np.zeros(len(users), dtype=bool)
+    held[order[ranks < n_held[sorted_users]]] = True
+
+    return held
+
+
+def rating_metrics(model, trainset, held, rows=1000000):
+    '''
+        Takes in trained StreamingSVD object, TrainingSet object, boolean numpy array of held out ratings, and number of ratings to
+        predict at a time.
+        Returns tuple of RMSE and MAE of model's predictions for held out ratings.
+    '''
+
+    (squared_error, absolute_error, n) = (0.0, 0.0, 0)
+    for start in range(0, trainset.n_ratings, rows):
+        selected = np.flatnonzero(held[start:start + rows]) + start
+        errors = model.predict(trainset.users[selected], trainset.films[selected]) - trainset.ratings[selected]
+        squared_error += float(errors @ errors)
+        absolute_error += float(np.abs(errors).sum())
+        n += len(selected)
+
+    return (round(np.sqrt(squared_error / max(n, 1)), 4), round(absolute_error / max(n, 1), 4))
+
+
+def ranking_metrics(model, trainset, held, ks=(10, 20), n_users=1000, n_negatives=100, relevant_rating=8, seed=None):
+    '''
+        Takes in trained StreamingSVD object, TrainingSet object, boolean numpy array of held out ratings, tuple of cutoffs to measure
+        at, number of users to measure, number of unrated films to sample per user, lowest rating that counts as relevant, and optional seed.
+        Returns dict of mean precision@k and recall@k over sampled users with a relevant held out rating. Each user's held out films
+        are ranked along with n_negatives films they haven't rated, and relevant films are held out films rated relevant_rating or higher.
+    '''
+
+    rng = np.random.default_rng(seed)
+    positions = np.flatnonzero(held)
+    (held_users, held_films, held_ratings) = (trainset.users[positions], trainset.films[positions], trainset.ratings[positions])
+
+    relevant_users = np.unique(held_users[held_ratings >= relevant_rating])
+    users = np.sort(rng.choice(relevant_users, size=min(n_users, len(relevant_users)), replace=False))
+
+    # Every film measured users rated, so negatives are only sampled from films they haven't
+    (rated_users, rated_films, _) = trainset.user_ratings(users)
+    rated_order = np.argsort(rated_users, kind='stable')
+    (rated_users, rated_films) = (rated_users[rated_order], rated_films[rated_order])
+    held_order = np.argsort(held_users, kind='stable')
+    (held_users, held_films, held_ratings) = (held_users[held_order], held_films[held_order], held_ratings[held_order])
+
+    hits = {k: [] for k in ks}
+    relevant_counts = []
+    for user in users.tolist():
+        (start, end) = np.searchsorted(held_users, [user, user + 1])
+        (films, ratings) = (held_films[start:end], held_ratings[start:end])
+        relevant = films[ratings >= relevant_rating]
+
+        (start, end) = np.searchsorted(rated_users, [user, user + 1])
+        negatives = rng.choice(trainset.n_films, size=min(2 * n_negatives, trainset.n_films), replace=False)
+        negatives = negatives[~np.isin(negatives, rated_films[start:end])][:n_negatives]
+
+        # User's bias and global mean shift every candidate's score equally, so they're left out of ranking
+        candidates = np.concatenate([films, negatives])
+        scores = model.qi[candidates] @ model.pu[user] + model.bi[candidates]
+        ranked = candidates[np.argsort(-scores, kind='stable')]
+
+        for k in ks:
+            hits[k].append(np.isin(ranked[:k], relevant).sum())
+        relevant_counts.append(len(relevant))
+
+    relevant_counts = np.array(relevant_counts)
+    metrics = {'users': len(users), 'negatives': n_negatives, 'relevant_rating': relevant_rating}
+    for k in ks:
+        metrics[f'precision@{k}'] = round(float(np.mean(np.array(hits[k]) / k)), 4) if len(users) else None
+        metrics[f'recall@{k}'] = round(float(np.mean(np.array(hits[k]) / relevant_counts)), 4) if len(users) else None
+
+    return metrics
+
+
+def evaluate(trainset, mode='random', fraction=0.1, per_user=None, seed=None, model_params=None, **ranking_params):
+    '''
+        Takes in TrainingSet object, string representing how to hold out ratings ('random' or 'time'), fraction of each user's
+        ratings to hold out, optional number of ratings per user to sample for training (trains on every rating not held out if None),
+        optional seed, optional dict of StreamingSVD parameters, and keyword arguments passed on to ranking_metrics.
+        Returns dict representing evaluation report, with how long each stage took and peak memory.
+    '''
+
+    t0 = time.time()
+    held = holdout_mask(trainset, mode, fraction, seed=seed)
+
+    # Leaving ratings that aren't in each user's sample out of training too, to compare against training on samples
+    exclude = held
+    if per_user is not None:
+        rng = np.random.default_rng(seed)
+        candidates = np.flatnonzero(~held)
+        kept = candidates[keep_per_user(np.asarray(trainset.users)[candidates], rng.random(len(candidates)), per_user)]
+        exclude = np.ones(trainset.n_ratings, dtype=bool)
+        exclude[kept] = False
+
+    t1 = time.time()
+    model = StreamingSVD(**{'random_state': seed, **(model_params or {})}).fit(trainset, exclude)
+
+    t2 = time.time()
+    (rmse, mae) = rating_metrics(model, trainset, held)
+    ranking = ranking_metrics(model, trainset, held, seed=seed, **ranking_params)
+    t3 = time.time()
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'holdout': {'mode': mode, 'fraction': fraction, 'ratings': int(held.sum()), 'users': int(len(np.unique(trainset.users[held])))},
+        'train': {
+            'ratings': int(trainset.n_ratings - exclude.sum()),
+            'per_user': per_user,
+            'params': {key: getattr(model, key) for key in ('n_factors', 'n_epochs', 'lr_all', 'reg_all', 'batch_size')},
+            'epochs': model.epochs
+        },
+        'rmse': rmse,
+        'mae': mae,
+        'ranking': ranking,
+        'seconds': {'holdout': round(t1 - t0, 2), 'train': round(t2 - t1, 2), 'evaluate': round(t3 - t2, 2), 'total': round(t3 - t0, 2)},
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1)
+    }
+
+
+def main(mode='random', sampled=False):
+    # Evaluating model trained the way create_model.py trains it, with any searched hyperparameters, on ratings coded in data/train,
+    # coding them first if they haven't been or data/ratings has changed since. Report is saved to reports/ so runs can be compared.
+    trainset = open_training_set(block_rows=int(os.environ.get('TRAIN_BLOCK_ROWS', 1000000)))
+
+    seed = int(os.environ.get('EVAL_SEED', 0))
+    per_user = int(os.environ.get('SAMPLE_PER_USER', 200)) if sampled else None
+    report = evaluate(trainset, mode, float(os.environ.get('EVAL_HOLDOUT', 0.1)), per_user, seed, load_params())
+
+    os.makedirs('reports', exist_ok=True)
+    path = f'reports/eval-{mode}{"-sampled" if sampled else ""}-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=4)
+
+    print(json.dumps({key: value for key, value in report.items() if key != 'train'}, indent=4))
+    print(f'Saved evaluation report to {path}')
+
+
+if __name__ == '__main__':
+    # "py evaluation.py [random|time] [sampled]" holds out random or most recent ratings, and trains on samples of each user's
+    # ratings like "py create_model.py sampled" if sampled is given
+    main('time' if 'time' in sys.argv[1:] else 'random', 'sampled' in sys.argv[1:])
@@ -1,54 +1,111 @@
 '''
-    For scraping films listed at https://letterboxd.com/films/
+    For scraping films listed at https://letterboxd.com/films/, and for enriching films the model knows with their genres and
+    number of viewers so the API can apply filters without scraping.
 '''
 
-from members_scraper import fetch_html
-from bs4 import BeautifulSoup
+from members_scraper import fetch_html, retry_policy
+from rating_store import RatingStore
+from crawl_window import AdaptiveWindow
+import columnar
+import extract
+import numpy as np
 import pandas as pd
 import asyncio
 import aiohttp
 import time
+import sys
+import os
 
 
-async def scrape_films_page(page, session):
+genres = [
+    "Action",
+    "Adventure",
+    "Animation",
+    "Comedy",
+    "Crime",
+    "Documentary",
+    "Drama",
+    "Family",
+    "Fantasy",
+    "History",
+    "Horror",
+    "Music",
+    "Mystery",
+    "Romance",
+    "Science Fiction",
+    "Thriller",
+    "TV Movie",
+    "War",
+    "Western"
+]
+
+
+# Columns of data/films table
+films_columns = {'Film Name': str, 'Film Link': str, 'Ranking': np.int32}
+
+
+def read_films(columns):
     '''
-        Takes in integer representing page number and aiohttp.ClientSession object and scrapes said page number on Letterboxd's popular film list.
-        Returns list of dicts representing film info including film name, href link, and it's popularity ranking.
+        Takes in list of columns to read.
+        Returns pandas.DataFrame object with those columns of data/films, or of data/films.csv if films were scraped before they were
+        written as a table.
+    '''
+
+    if columnar.has_table('data/films'):
+        return columnar.read_table('data/films', columns)
+
+    films_df = pd.read_csv('data/films.csv', usecols=columns)
+    if 'Ranking' in columns:
+        films_df['Ranking'] = pd.to_numeric(films_df['Ranking'], errors='coerce')
+
+    return films_df
+
+
+async def scrape_films_page(page, session, outcome=None):
+    '''
+        Takes in integer representing page number, aiohttp.ClientSession object, and optional dict to count the attempts, retries and
+        failures of page's requests in, and scrapes said page number on Letterboxd's popular film list.
+        Returns tuple of list of dicts representing film info including film name, href link, and it's popularity ranking, and boolean
+        indicating whether page is past the end of the list. No films on a page that isn't past the end means it couldn't be scraped.
     '''
 
     # Calculating film ranking, since there's 72 films listed on a single Letterboxd films page
     film_num = (72 * (page-1))
 
     url = f'https://letterboxd.com/films/ajax/popular/page/{page}/'
-    _, html = await fetch_html(url, session)
     data = []
+    past_end = False
 
     try:
-        # Getting list of all films on film page using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        films = soup.find_all("li", class_="listitem poster-container")
+        resp_code, html = await fetch_html(url, session, outcome=outcome)
+        past_end = resp_code == 404
 
-        if not films:
+        # Getting list of all films on film page with lxml
+        page_root = extract.parse(html)
+        films = list(extract.popular_films(page_root))
+
+        if not films and not past_end:
             attempts = 1
 
-            # If server response error, wait 5 seconds and try again
-            while not soup.find('div', class_='pagination') and attempts < 10:
-                time.sleep(5)
-                _, html = await fetch_html(url, session)
-                soup = BeautifulSoup(html, 'lxml')
-                films = soup.find_all("li", class_="listitem poster-container")
+            # Pages past the end of the list still have pagination. If page doesn't, server response was bad, so back off and try again
+            # without blocking other pages being scraped
+            while not extract.has_pagination(page_root) and attempts < 10:
+                await asyncio.sleep(retry_policy.backoff(attempts))
+                resp_code, html = await fetch_html(url, session, outcome=outcome)
+                page_root = extract.parse(html)
+                films = list(extract.popular_films(page_root))
                 attempts += 1
 
+            past_end = not films and extract.has_pagination(page_root)
             if attempts == 10:
                 print(f"Server response error while scraping film page #{page}")
 
-        for film in films:
+        for (film_name, film_link) in films:
             film_num += 1
 
             item = {}
-            film_info = film.find('div')
-            item['Film Name'] = film_info.find('img').attrs['alt']
-            item['Film Link'] = film_info.attrs['data-target-link']
+            item['Film Name'] = film_name
+            item['Film Link'] = film_link
             item['Ranking'] = film_num
 
             data.append(item)
@@ -59,53 +116,228 @@ async def scrape_films_page(page, session):
         print(f'Error scraping page film page #{page}: {err}')
 
     finally:
-        return data
+        return (data, past_end)
+
+
+async def find_end(session):
+    '''
+        Takes in aiohttp.ClientSession object.
+        Returns integer representing first page past the end of the popular film list, found by doubling page number until a page is
+        past the end and then bisecting, or None if a page probed couldn't be scraped. Probed pages aren't kept, so the crawl
+        requests them again (a few dozen pages at most).
+    '''
+
+    # last is the last page known to have films, end the first page known to be past the end
+    (last, end) = (0, 1)
+    while True:
+        (data, past_end) = await scrape_films_page(end, session)
+        if past_end:
+            break
+        if not data:
+            return None
+        (last, end) = (end, end * 2)
+
+    while end - last > 1:
+        page = (last + end) // 2
+        (data, past_end) = await scrape_films_page(page, session)
+        if past_end:
+            end = page
+        elif data:
+            last = page
+        else:
+            return None
+
+    return end
+
+
+async def scrape_film_details(film_link, session):
+    '''
+        Takes in string representing film href and aiohttp.ClientSession object.
+        Returns tuple of film's number of viewers and list of film's genres respectively, or -1 and an empty list if either page
+        couldn't be scraped, so a film is never stored with one half of its details missing.
+    '''
+
+    try:
+        # Pages of failed requests parse fine but hold no genres, so statuses are checked rather than relying on parsing to fail
+        (status, html) = await fetch_html(f'https://letterboxd.com{film_link}members/', session)
+        if status != 200:
+            raise ValueError(f'members page returned {status}')
+
+        viewers = extract.viewers(extract.parse(html))
+
+        (status, html) = await fetch_html(f'https://letterboxd.com{film_link}genres/', session)
+        if status != 200:
+            raise ValueError(f'genres page returned {status}')
+
+        film_genres = [genre for genre in extract.genres(extract.parse(html)) if genre in genres]
+
+    except Exception as err:
+        print(f'Error scraping details for film {film_link}: {err}')
+        return (-1, [])
+
+    return (viewers, film_genres)
+
+
+def load_film_meta(path):
+    '''
+        Takes in string representing path of film metadata store.
+        Returns dict mapping film href to tuple of number of viewers and genre bitmask. Empty if store doesn't exist yet.
+    '''
+
+    if not os.path.exists(path):
+        return {}
+
+    with np.load(path) as store:
+        # Remapping bitmasks in case store was written with a different genre list
+        bits = {genre: 1 << i for i, genre in enumerate(genres)}
+        genre_bits = [bits.get(genre, 0) for genre in store['genre_names']]
+        masks = [sum(bit for j, bit in enumerate(genre_bits) if mask >> j & 1) for mask in store['genres'].tolist()]
+
+        return {link: (viewers, mask) for link, viewers, mask in zip(store['links'].tolist(), store['viewers'].tolist(), masks)}
+
+
+def save_film_meta(film_meta, path):
+    '''
+        Takes in dict mapping film href to tuple of number of viewers and genre bitmask, and string representing path to save store to.
+        Store is a .npz file of hrefs sorted for binary search, number of viewers, genre bitmasks, and names of genres each bit stands for.
+    '''
+
+    links = sorted(film_meta)
+    np.savez_compressed(
+        path,
+        links=np.array(links, dtype=str),
+        viewers=np.array([film_meta[link][0] for link in links], dtype=np.int64),
+        genres=np.array([film_meta[link][1] for link in links], dtype=np.uint32),
+        genre_names=np.array(genres, dtype=str)
+    )
+
+
+async def enrich_films():
+    # Scraping genres and number of viewers for every film the model was trained on and saving them to data/film_meta.npz.
+    # Films already in the store are skipped, so the pass can be rerun to fill in new or failed films.
+    store = RatingStore.load('pickles/ratings.npz')
+    film_meta = load_film_meta('data/film_meta.npz')
+
+    # Films that failed to scrape last time (-1 viewers) get another attempt
+    film_links = [link for link in store.film_links if film_meta.get(link, (-1, 0))[0] < 0]
+    bits = {genre: 1 << i for i, genre in enumerate(genres)}
+
+    # Bounding films scraped at once the same way main's window is capped, rather than starting a whole batch of them together
+    slots = asyncio.Semaphore(int(os.environ.get('CRAWL_CONCURRENCY', 50)))
+
+    async def scrape_limited(link, session):
+        async with slots:
+            return await scrape_film_details(link, session)
+
+    t0 = time.time()
+
+    async with aiohttp.ClientSession() as session:
+        for start in range(0, len(film_links), 500):
+            batch = film_links[start:start + 500]
+            responses = await asyncio.gather(*[scrape_limited(link, session) for link in batch])
+
+            for link, (viewers, film_genres) in zip(batch, responses):
+                film_meta[link] = (viewers, sum(bits[genre] for genre in set(film_genres)))
+
+            # Saving progress every batch so an interrupted pass doesn't lose everything
+            save_film_meta(film_meta, 'data/film_meta.npz')
+            print(f'Enriched {start + len(batch)}/{len(film_links)} films')
+
+    t1 = time.time()
+
+    print(f'Enriched {len(film_links)} films in {(t1-t0)/60} minutes. Store holds {len(film_meta)} films.')
+    print(f"Retry stats: {retry_policy.stats}")
 
 
 async def main():
-    data = []
+    # Pages are scraped through a window of concurrent requests that grows while Letterboxd keeps up and halves when a page fails
+    # or requests get throttled. The end of the list is probed for up front, so no pages past it are requested, and films are
+    # written to data/films as they come in rather than held in memory.
+    writer = columnar.ChunkWriter('data/films', films_columns)
+    window = AdaptiveWindow(initial=4, maximum=int(os.environ.get('CRAWL_CONCURRENCY', 50)))
+    crawl = {'end': float('inf'), 'pages': 0, 'failed': [], 'failing': 0}
+    buffer = []
+    write_lock = asyncio.Lock()
+
+    async def flush(rows_min):
+        # Writing buffered films to a chunk of data/films in a thread, one chunk at a time
+        nonlocal buffer
+        if len(buffer) >= max(rows_min, 1):
+            (rows, buffer) = (buffer, [])
+            async with write_lock:
+                await asyncio.to_thread(writer.write, rows)
+
+    async def scrape_page(page, session):
+        # Window only hears about this page's own requests, so failures of pages in flight alongside it aren't counted against it
+        outcome = {}
+        (data, past_end) = await scrape_films_page(page, session, outcome)
+        failed = outcome.get('throttled', 0) + outcome.get('server_errors', 0) + outcome.get('connection_errors', 0)
+        await window.release(bool(data or past_end) and not failed)
 
-    open("data/films.csv", "w").close()
+        crawl['failing'] = 0 if data or past_end else crawl['failing'] + 1
+        if past_end:
+            crawl['end'] = min(crawl['end'], page)
+        elif not data:
+            crawl['failed'].append(page)
+        else:
+            crawl['pages'] += 1
+            buffer.extend(data)
+
+            # Write data to a chunk of data/films about every 1000 pages scraped
+            await flush(72 * 1000)
 
     t0 = time.time()
 
-    # Asynchronously scraping all film data (appx. 950k films as of 7/11/24) and saving to data/films.csv
+    # Asynchronously scraping all film data (appx. 950k films as of 7/11/24) and saving to data/films
     async with aiohttp.ClientSession() as session:
-        tasks = []
+        end = await find_end(session)
+        if end is not None:
+            crawl['end'] = end
+            print(f'Film list ends before page {end}')
+
+        tasks = set()
         page = 1
-        all_films_scraped = False
-
-        while not all_films_scraped:
-            # Dump data to csv every 1000 pages scraped
-            if page != 1 and (page - 1) % 1000 == 0:
-                df = pd.DataFrame(data)
-                df.to_csv("data/films.csv", mode='a')
-                data = []
-
-            # Sending 50 requests at a time
-            for p in range(page, page+50):
-                tasks.append(scrape_films_page(p, session))
-
-            responses = await asyncio.gather(*tasks)
-            page += 50
-            tasks = []
-
-            # Once a response is empty, no more film data to be scraped
-            for response in responses:
-                if not response:
-                    all_films_scraped = True
-                else:
-                    data += response
-
-    # Cleaning up data that hasn't been dumped to csv and dumping it
-    if len(data) > 0:
-        df = pd.DataFrame(data)
-        df.to_csv("data/films.csv", mode='a')
+
+        # Any page found past the end stops more being sent, in case list got shorter since probing. When the end couldn't be found,
+        # a full window's worth of pages failing in a row stops it too, so a crawl Letterboxd keeps failing for doesn't run forever.
+        while True:
+            await window.acquire()
+            if page >= crawl['end'] or crawl['failing'] >= window.maximum:
+                await window.release(True)
+                if page < crawl['end']:
+                    print(f'Stopped sending pages at page {page} after {crawl["failing"]} pages in a row failed')
+                break
+
+            task = asyncio.create_task(scrape_page(page, session))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            page += 1
+
+        await asyncio.gather(*tasks)
+
+        # Giving pages that couldn't be scraped one more attempt now things have calmed down
+        retry_pages = [page for page in crawl['failed'] if page < crawl['end']]
+        crawl['failed'] = []
+        for page in retry_pages:
+            await window.acquire()
+            await scrape_page(page, session)
+
+    # Cleaning up data that hasn't been written yet and writing it
+    await flush(0)
 
     t1 = time.time()
 
-    print(f'Scraped {page-1} pages in {(t1-t0)/60} minutes. That\'s {1/((page-1)/((t1-t0)/60))} mins/pg.')
+    print(f'Scraped {crawl["pages"]} pages in {(t1-t0)/60} minutes. That\'s {(t1-t0)/60/max(crawl["pages"], 1)} mins/pg.')
+    if crawl['failed']:
+        print(f'Couldn\'t scrape film pages {crawl["failed"]}')
+    print(f"Window stats: {window.stats}, final limit {window.limit:.1f}")
+    print(f"Retry stats: {retry_policy.stats}")
     print("Films finished scraping")
 
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    # "py film_scraper.py enrich" runs enrichment pass over the model's films instead of scraping the film list
+    if len(sys.argv) > 1 and sys.argv[1] == 'enrich':
+        asyncio.run(enrich_films())
+    else:
+        asyncio.run(main())
\ No newline at end of file
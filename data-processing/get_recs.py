@@ -4,13 +4,15 @@
 
 from ratings_scraper import get_num_film_pages, scrape_member_ratings
 from members_scraper import fetch_html
+from rating_store import RatingStore
+from film_scraper import read_films
+import extract
 import asyncio
 import aiohttp
+import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
 from colorama import Fore
 import time
-import functools
 import pickle
 
 
@@ -56,19 +58,9 @@ async def get_num_watchlist_pages(user, session):
 
     if resp_code in (204, 403): # If this happens, user likely has watchlist privated
         return None
-    
-    # If some other server response error continue attempting to fetch html
-    elif resp_code != 200:
-        attempts = 1
-        while resp_code != 200 and attempts < 100:
-            resp_code, html = await fetch_html(url, session)
-            attempts += 1
 
     try:
-        # Parsing data using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        paginate_pages = soup.find_all("li", class_="paginate-page")
-        return int(paginate_pages[-1].find('a').text) if paginate_pages else 1
+        return extract.num_pages(extract.parse(html))
     
     except Exception as err:
         print(f"Error finding number of pages to scrape for user watchlist: {err}")
@@ -83,20 +75,10 @@ async def scrape_watchlist(user, page, session):
     url = f'https://letterboxd.com{user}watchlist/page/{page}/'
     resp_code, html = await fetch_html(url, session)
 
-    attempts = 1
-    while resp_code != 200 and attempts < 100:
-        resp_code, html = await fetch_html(url, session)
-        attempts += 1
-
     film_links = []
 
     try:
-        # Getting film info using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-
-        films = soup.find_all('li', class_='poster-container')
-        for film in films:
-            film_links.append(film.find('div').attrs['data-target-link'])
+        film_links.extend(extract.poster_links(extract.parse(html)))
 
     except Exception as err:
         print(f"Error scraping {user} watchlist page #{page}: {err}")
@@ -183,28 +165,14 @@ async def scrape_pred_data(film_link, idx, filters, session):
             url = f'https://letterboxd.com{film_link}members/'
             resp_code, html = await fetch_html(url, session)
 
-            attempts = 1
-            while resp_code != 200 and attempts < 100:
-                resp_code, html = await fetch_html(url, session)
-                attempts += 1
-
-            soup = BeautifulSoup(html, 'lxml')
-            num_viewers = int(soup.find('li', class_='js-route-watches').find('a').attrs['title'].split()[0].replace(',', ''))
-            film_info['viewers'] = num_viewers
+            film_info['viewers'] = extract.viewers(extract.parse(html))
 
         # Getting genre of film
         if 'Genre' in filters:
             url = f'https://letterboxd.com{film_link}genres/'
             resp_code, html = await fetch_html(url, session)
 
-            attempts = 1
-            while resp_code != 200 and attempts < 100:
-                resp_code, html = await fetch_html(url, session)
-                attempts += 1
-
-            soup = BeautifulSoup(html, 'lxml')
-            film_genres = [genre.text for genre in soup.find('div', id="tab-genres").find_all('a') if genre.text in genres]
-            film_info['genres'] = film_genres
+            film_info['genres'] = [genre for genre in extract.genres(extract.parse(html)) if genre in genres]
             
     finally:
         return film_info
@@ -242,34 +210,31 @@ async def apply_filters(pred_list, filters, n):
         return pred_list[:n]
         
 
-async def get_top_n_recs(user, n, df, algo, filters):
+async def get_top_n_recs(user, n, user_df, store, algo, filters):
     '''
-        Takes in string representing Letterboxd user, number of recommendations to return, pandas.DataFrame object with info about user's ratings
-        and ratings used in trained model, trained surprise.SVD algorithm, and dict containing necessary filters to apply.
+        Takes in string representing Letterboxd user, number of recommendations to return, pandas.DataFrame object with info about user's ratings,
+        RatingStore object with ratings used in trained model, trained surprise.SVD algorithm, and dict containing necessary filters to apply.
         Returns list of n tuples containing prediction href and estimated rating for prediction respectively.
     '''
 
     # All films must have higher popularity ranking than min_rank to be recommended
     min_rank = popularity_filter_map[filters['Popularity']][0] if 'Popularity' in filters else 0
 
-    # Finding mean of all ratings in df to be used to fill missing values when getting predictions from model
-    df['Rating'] = pd.to_numeric(df['Rating'], errors='coerce')
-    rating_mean = df.loc[:, 'Rating'].mean()
+    # Finding mean of ratings model was trained on to be used to fill missing values when getting predictions from model
+    rating_mean = store.ratings.mean()
 
-    films_df = pd.read_csv('data/films.csv')
-    films_df['Ranking'] = pd.to_numeric(films_df['Ranking'], errors='coerce')
+    films_df = read_films(['Film Link', 'Ranking'])
 
-    user_films = set(df[df['User'] == user]['Film Link'].unique())
-    all_films = set(df['Film Link'].unique())
-    films_too_popular = set(films_df[films_df['Ranking'] < min_rank]['Film Link'].unique())
-    # Getting union of users' watchlists (useful when multiple watchlists to exclude like when using blend mode)
-    films_in_watchlists = set(functools.reduce((lambda a, b : set(a).union(set(b))), filters['Watchlists'])) if filters['Watchlists'] else set()
-    
-    # Filtering out films user has seen, films that don't meet popularity filter criteria, 
-    # and films in user watchlists (if user opted to ignore films in watchlists)
-    films = list(all_films - user_films - films_too_popular - films_in_watchlists)
+    # Filtering out films user has seen, films that don't meet popularity filter criteria, and films in user watchlists
+    # (if user opted to ignore films in watchlists, more than one when using blend mode) with a mask over the model's films
+    all_films = np.array(store.film_links, dtype=object)
+    exclude = np.isin(all_films, user_df['Film Link'].unique()) | np.isin(all_films, films_df[films_df['Ranking'] < min_rank]['Film Link'].unique())
+    for watchlist in filters['Watchlists']:
+        exclude |= np.isin(all_films, watchlist)
 
-    # Using mean of all ratings in df to fill missing values when getting predictions from model, which is what 3rd item of tuple is used for
+    films = all_films[~exclude].tolist()
+
+    # Using mean of ratings model was trained on to fill missing values when getting predictions from model, which is what 3rd item of tuple is used for
     user_film_pairs = [(user, film, rating_mean) for film in films]
     predictions = algo.test(user_film_pairs)
 
@@ -341,11 +306,16 @@ def get_blended_ratings(user_1_ratings, user_2_ratings, algo):
 
 
 async def main():
-    with open("pickles/model_df.pkl", 'rb') as pkl:
-        ratings_df = pickle.load(pkl)
+    store = RatingStore.load('pickles/ratings.npz')
     with open("pickles/rec_model.pkl", 'rb') as pkl:
         algo = pickle.load(pkl)
 
+    # Indexing film titles by href once so printing recs doesn't search every rating for each of them. Titles in ratings take
+    # precedence over data/films, which only covers films that were in the popular list when it was scraped.
+    films_df = read_films(['Film Name', 'Film Link'])
+    film_titles = dict(zip(films_df['Film Link'], films_df['Film Name']))
+    film_titles.update(zip(store.film_links, store.film_titles))
+
     blend_mode = input('Blend mode? (Y/N): ').capitalize()
     while blend_mode not in ('Y', 'N'):
         blend_mode = input('Blend mode? (Y/N): ').capitalize()
@@ -411,13 +381,12 @@ async def main():
         print(f'Gathering recs. . .')
         
         user_df = pd.DataFrame(ratings)
-        df = pd.concat([user_df, ratings_df])
 
-        recs = await get_top_n_recs(user_1, 50, df, algo, filter_dict)
+        recs = await get_top_n_recs(user_1, 50, user_df, store, algo, filter_dict)
 
         print('Recommendations: ')
         for rec in recs:
-            film_name = df[df['Film Link'] == rec[0]]['Film'].unique()[0]
+            film_name = film_titles[rec[0]]
 
             print(f'{Fore.YELLOW}{film_name} {Fore.CYAN}https://letterboxd.com{rec[0]} {Fore.GREEN}{Fore.WHITE}')
 
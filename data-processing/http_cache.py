@@ -0,0 +1,242 @@
+'''
+    Disk-backed cache of Letterboxd responses used under fetch_html, so pages that were fetched recently aren't downloaded again.
+    Kept in sync with back-end-fastapi/app/http_cache.py.
+'''
+
+from urllib.parse import urlsplit
+import threading
+import asyncio
+import sqlite3
+import zlib
+import time
+import re
+import os
+
+
+# Seconds each class of page stays cached, matched against the url's path so pages are cached whichever host serves them (see
+# scraping.base_url). First matching pattern wins. Pages not matching any pattern aren't cached.
+ttls = [
+    (re.compile(r'^/film/[^/]+/genres/'), 30 * 24 * 60 * 60),
+    (re.compile(r'^/film/[^/]+/members/'), 24 * 60 * 60),
+    (re.compile(r'^/films/ajax/popular/'), 24 * 60 * 60),
+    (re.compile(r'^/members/popular/'), 24 * 60 * 60),
+    (re.compile(r'^/[^/]+/films/'), 10 * 60),
+    (re.compile(r'^/[^/]+/watchlist/'), 10 * 60)
+]
+
+
+def get_ttl(url):
+    '''
+        Takes in string representing url.
+        Returns number of seconds a response from url should stay cached, 0 if it shouldn't be cached.
+    '''
+
+    path = urlsplit(url).path
+    for (pattern, ttl) in ttls:
+        if pattern.match(path):
+            return ttl
+
+    return 0
+
+
+class ResponseCache:
+    '''
+        LRU cache of response html keyed by url, stored zlib-compressed in a SQLite file and capped at max_bytes of compressed html.
+        get and put run their SQLite work in a worker thread so they don't hold up the event loop, and treat any SQLite error, like
+        the file being locked by another process for longer than timeout, as a miss. Keeps counts of hits, misses, stores, expired
+        entries, evictions and errors.
+    '''
+
+    # Number of hits whose access times are held in memory before being written in one statement
+    touch_batch = 256
+
+    def __init__(self, path, max_bytes, timeout=1.0):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.counts = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'evictions': 0, 'errors': 0}
+
+        # One connection shared by every worker thread, used by one at a time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body BLOB, size INTEGER, expires REAL, last_access REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+        # Urls hit since access times were last written, mapped to when they were last hit
+        self._touched = {}
+
+        # Bytes stored by this process since the cache's size was last read from the file. Other processes share the file, so the
+        # size is re-read every 1% of the cap stored rather than tracked here.
+        self._unchecked = max_bytes
+
+    async def get(self, url):
+        '''
+            Takes in string representing url.
+            Returns cached html for url, or None if it isn't cached, has expired, or couldn't be read.
+        '''
+
+        return await asyncio.to_thread(self._get, url)
+
+    async def put(self, url, html):
+        '''
+            Takes in string representing url and string representing html fetched from it. Caches html if url's class of page has a ttl.
+        '''
+
+        if get_ttl(url):
+            await asyncio.to_thread(self._put, url, html)
+
+    def _get(self, url):
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._db.execute('SELECT body, expires FROM responses WHERE url = ?', (url,)).fetchone()
+                if row is not None and row[1] < now:
+                    self._db.execute('DELETE FROM responses WHERE url = ?', (url,))
+                    self.counts['expired'] += 1
+                    row = None
+
+                if row is not None:
+                    # Recording hit in memory, since an UPDATE per hit would make every read a write
+                    self._touched[url] = now
+                    if len(self._touched) >= self.touch_batch:
+                        self._write_touched()
+
+        except sqlite3.Error:
+            self.counts['errors'] += 1
+            row = None
+
+        if row is None:
+            self.counts['misses'] += 1
+            return None
+
+        self.counts['hits'] += 1
+
+        return zlib.decompress(row[0]).decode()
+
+    def _put(self, url, html):
+        now = time.time()
+        body = zlib.compress(html.encode(), 6)
+
+        try:
+            with self._lock:
+                self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (url, body, len(body), now + get_ttl(url), now))
+                self._touched.pop(url, None)
+                self.counts['stores'] += 1
+
+                self._unchecked += len(body)
+                if self._unchecked >= 0.01 * self.max_bytes:
+                    self._unchecked = 0
+                    if self._size() > self.max_bytes:
+                        self._evict()
+
+        except sqlite3.Error:
+            self.counts['errors'] += 1
+
+    def _write_touched(self):
+        self._db.executemany('UPDATE responses SET last_access = ? WHERE url = ?', [(when, url) for (url, when) in self._touched.items()])
+        self._touched.clear()
+
+    def _size(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _evict(self):
+        # Removing least recently used responses until cache is back under 90% of its cap, counting every process's responses
+        self._write_touched()
+        to_free = self._size() - 0.9 * self.max_bytes
+        evicted = []
+        for (url, size) in self._db.execute('SELECT url, size FROM responses ORDER BY last_access'):
+            if to_free <= 0:
+                break
+            evicted.append((url,))
+            to_free -= size
+
+        self._db.executemany('DELETE FROM responses WHERE url = ?', evicted)
+        self.counts['evictions'] += len(evicted)
+
+    def stats(self):
+        '''
+            Returns dict of cache's counters, its size in bytes, and number of cached responses.
+        '''
+
+        with self._lock:
+            (entries, size) = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+
+        return {**self.counts, 'bytes': size, 'entries': entries}
+
+
+class NullCache:
+    '''
+        Stand-in for ResponseCache when caching is turned off. Every lookup misses and nothing is stored.
+    '''
+
+    def __init__(self):
+        self.counts = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'evictions': 0, 'errors': 0}
+
+    async def get(self, url):
+        self.counts['misses'] += 1
+        return None
+
+    async def put(self, url, html):
+        pass
+
+    def stats(self):
+        return {**self.counts, 'bytes': 0, 'entries': 0}
+
+
+# Where the cache is kept when HTTP_CACHE_PATH isn't set, or an empty string to not cache unless it is. The crawlers set it to an
+# empty string, since they fetch each page once and a stale page could hide new ratings from an incremental crawl.
+default_path = 'cache/http_cache.sqlite3'
+
+
+def cache_from_env():
+    '''
+        Returns ResponseCache object configured by HTTP_CACHE_PATH and HTTP_CACHE_MAX_MB environment variables,
+        or NullCache object if HTTP_CACHE_PATH (or default_path, when it isn't set) is an empty string.
+    '''
+
+    path = os.environ.get('HTTP_CACHE_PATH', default_path)
+    if not path:
+        return NullCache()
+
+    return ResponseCache(path, int(os.environ.get('HTTP_CACHE_MAX_MB', 512)) * 2**20)
+
+
+# Cache used by fetch_html, created on first use. Can be swapped for any object with get, put and stats methods.
+response_cache = None
+
+
+def get_response_cache():
+    '''
+        Returns cache fetch_html should use, creating it from environment variables the first time it's needed.
+    '''
+
+    global response_cache
+    if response_cache is None:
+        response_cache = cache_from_env()
+
+    return response_cache
+
+
+async def request_html(url, session, served=None):
+    '''
+        Takes in string representing url, aiohttp.ClientSession object, and optional dict to note in whether the response was
+        served from the cache. Makes a single request, with successful responses served from and stored in the response cache.
+        Returns tuple of response status, response text/html, and value of response's Retry-After header respectively.
+    '''
+
+    cache = get_response_cache()
+    html = await cache.get(url)
+    if served is not None:
+        served['cached'] = html is not None
+    if html is not None:
+        return (200, html, None)
+
+    async with session.get(url) as response:
+        html = await response.text()
+        if response.status == 200:
+            await cache.put(url, html)
+
+        return (response.status, html, response.headers.get('Retry-After'))
@@ -0,0 +1,133 @@
+'''
+    Approximate maximum-inner-product index over the item factors of a trained SVD model. Films are clustered offline into
+    inverted lists by data-processing/create_model.py, and a query only scores the films in the lists whose centroids best match
+    the user.
+    Kept in sync with back-end-fastapi/app/item_index.py.
+'''
+
+import numpy as np
+
+
+class ItemIndex:
+    '''
+        Inverted-file index over SVD item vectors. Each item vector is its factors with its bias appended, so that a user vector
+        of factors with 1 appended scores films exactly like the model does up to a constant.
+    '''
+
+    def __init__(self, centroids, list_offsets, list_items):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_items = np.asarray(list_items, dtype=np.int64)
+        self.n_lists = len(self.centroids)
+        self.n_films = len(self.list_items)
+
+    @classmethod
+    def build(cls, qi, bi, n_lists=None, n_iter=20, max_samples_per_list=64, seed=0):
+        '''
+            Takes in numpy array of item factors, numpy array of item biases, optional number of inverted lists, number of k-means
+            iterations, number of films per list to train k-means on, and random seed.
+            Returns ItemIndex object with every item assigned to exactly one list.
+        '''
+
+        items = _augment(qi, bi)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(items))))
+        n_lists = min(n_lists, len(items))
+
+        # Appending each vector's distance from largest norm turns maximum inner product into nearest neighbour, so plain k-means
+        # groups films that score alike for the same users
+        norms = np.einsum('ij,ij->i', items, items)
+        padded = np.hstack([items, np.sqrt(np.maximum(norms.max() - norms, 0))[:, None]])
+
+        # Training k-means on a sample of films, then assigning every film to nearest centroid once at the end
+        rng = np.random.default_rng(seed)
+        sample = padded[rng.choice(len(padded), min(len(padded), max_samples_per_list * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = _nearest_centroids(sample, centroids)
+            order = np.argsort(assignments, kind='stable')
+            counts = np.bincount(assignments, minlength=n_lists)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+            # Re-seeding empty lists with random films keeps every list in use
+            nonempty = counts > 0
+            centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+            centroids[nonempty] = np.add.reduceat(sample[order], starts[nonempty], axis=0) / counts[nonempty, None]
+
+        assignments = _nearest_centroids(padded, centroids)
+        list_items = np.argsort(assignments, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+        # Last dimension is always multiplied by 0 in queries, so only first dimensions are kept
+        return cls(centroids[:, :-1], list_offsets, list_items)
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Takes in string representing path of .npz file written by ItemIndex.save.
+            Returns ItemIndex object.
+        '''
+
+        with np.load(path) as index:
+            return cls(index['centroids'], index['list_offsets'], index['list_items'])
+
+    def save(self, path):
+        '''
+            Takes in string representing path to write index to as .npz file.
+        '''
+
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, list_items=self.list_items)
+
+    def search(self, qi, bi, user_factors, k, nprobe=8, exclude=None):
+        '''
+            Takes in numpy array of item factors, numpy array of item biases, tuple of user's bias and latent factors, number of films
+            to return, number of lists to probe, and optional boolean numpy array of films to exclude. More lists are probed if the
+            first nprobe lists don't hold k films that aren't excluded.
+            Returns tuple of numpy arrays of the k highest scoring film ids found and their unclipped scores without global mean and
+            user bias, in descending order of score. Raising nprobe trades latency for recall.
+        '''
+
+        (_, pu) = user_factors
+        query = np.append(np.asarray(pu, dtype=np.float32), np.float32(1))
+        list_order = np.argsort(-(self.centroids @ query))
+        list_sizes = np.diff(self.list_offsets)[list_order]
+
+        # Probing lists in order of centroid score until both nprobe lists and k candidates have been gathered
+        candidates = []
+        n_candidates = 0
+        for probed, list_id in enumerate(list_order):
+            if probed >= nprobe and n_candidates >= k:
+                break
+            if not list_sizes[probed]:
+                continue
+
+            items = self.list_items[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+            if exclude is not None:
+                items = items[~exclude[items]]
+            candidates.append(items)
+            n_candidates += len(items)
+
+        candidates = np.concatenate(candidates) if candidates else np.array([], dtype=np.int64)
+        if not len(candidates):
+            return (candidates, np.array([], dtype=np.float32))
+
+        scores = qi[candidates] @ query[:-1] + bi[candidates]
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+
+        return (candidates[top], scores[top])
+
+
+def _augment(qi, bi):
+    return np.hstack([np.asarray(qi, dtype=np.float32), np.asarray(bi, dtype=np.float32)[:, None]])
+
+
+def _nearest_centroids(points, centroids, batch_size=65536):
+    # Assigning points to nearest centroid in batches so distance matrix stays small
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        assignments[start:start + batch_size] = np.argmin(centroid_norms - 2 * (batch @ centroids.T), axis=1)
+
+    return assignments
@@ -2,21 +2,30 @@
     For scraping https://letterboxd.com/members/popular/
 '''
 
-from bs4 import BeautifulSoup
+from retry import RetryPolicy
+import extract
+import http_cache
 import pandas as pd
 import asyncio
 import aiohttp
 import time
 
 
-async def fetch_html(url, session):
+# Crawls have no deadline, but back off for up to a minute between attempts when Letterboxd throttles or errors
+retry_policy = RetryPolicy(max_attempts=10, base_delay=1.0, max_delay=60.0, max_retry_after=300.0)
+
+# Crawls only cache responses when HTTP_CACHE_PATH asks them to
+http_cache.default_path = ''
+
+
+async def fetch_html(url, session, deadline=None, outcome=None):
     '''
-        Takes in string representing url and aiohttp.ClientSession object.
-        Returns tuple of response status and response text/html respectively.
+        Takes in string representing url, aiohttp.ClientSession object, optional number of seconds fetching may take overall, and
+        optional dict to count this fetch's attempts, retries and failures in.
+        Returns tuple of response status and response text/html respectively, retrying failed requests according to retry_policy.
     '''
 
-    async with session.get(url) as response:
-        return (response.status, await response.text())
+    return await retry_policy.call(http_cache.request_html, url, session, deadline, outcome)
 
 
 async def scrape_popular_members(page, session):
@@ -29,21 +38,13 @@ async def scrape_popular_members(page, session):
     resp_code, html = await fetch_html(url, session)
     data = []
 
-    attempts = 1
-    while resp_code != 200 and attempts < 100:
-        resp_code, html = await fetch_html(url, session)
-        attempts += 1
-
     try:
-        # Parsing page using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-
-        if soup.title.text != "Letterboxd - Not Found":
-            members = soup.find_all("div", class_="person-summary")
+        page_root = extract.parse(html)
 
-            for member in members:
+        if extract.title(page_root) != "Letterboxd - Not Found":
+            for member_link in extract.member_links(page_root):
                 item = {}
-                item['userHref'] = member.find('a').attrs['href']
+                item['userHref'] = member_link
                 data.append(item)
 
             # Removing featured popular reviewers on right side of screen on webpage
@@ -80,6 +81,7 @@ async def main():
     t1=time.time()
 
     print(f"{(t1-t0)/60} minutes to scrape {num_pages} member pages")
+    print(f"Retry stats: {retry_policy.stats}")
 
     df = pd.DataFrame(data)
     df.to_csv("data/members.csv")
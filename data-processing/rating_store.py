@@ -0,0 +1,112 @@
+'''
+    Compact store of the ratings the model is trained on: integer user and film codes, float32 ratings, and each code's
+    href kept once. Kept in sync with back-end-fastapi/app/rating_store.py.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+class RatingStore:
+    '''
+        Holds ratings as parallel numpy arrays of int32 user codes, int32 film codes and float32 ratings, along with lists mapping
+        each user code to user href and each film code to film href and title. Ratings are floats since films members logged
+        without rating are given the member's mean rating.
+    '''
+
+    def __init__(self, users, films, ratings, user_links, film_links, film_titles):
+        self.users = users
+        self.films = films
+        self.ratings = ratings
+        self.user_links = user_links
+        self.film_links = film_links
+        self.film_titles = film_titles
+        self._film_codes = None
+
+    @classmethod
+    def from_df(cls, df):
+        '''
+            Takes in pandas.DataFrame object with User, Film, Film Link and Rating columns. Rows whose rating isn't a number are dropped.
+            Returns RatingStore object. Codes are assigned in order of first appearance.
+        '''
+
+        df = df.assign(Rating=pd.to_numeric(df['Rating'], errors='coerce')).dropna(subset=['Rating'])
+
+        (users, user_links) = pd.factorize(df['User'])
+        (films, film_links) = pd.factorize(df['Film Link'])
+
+        # Title of each film is taken from its first rating
+        film_titles = df['Film'].to_numpy()[np.unique(films, return_index=True)[1]]
+
+        return cls(
+            users.astype(np.int32),
+            films.astype(np.int32),
+            df['Rating'].to_numpy().astype(np.float32),
+            user_links.tolist(),
+            film_links.tolist(),
+            [str(title) for title in film_titles]
+        )
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Takes in string representing path of .npz rating store.
+            Returns RatingStore object.
+        '''
+
+        with np.load(path) as store:
+            return cls(
+                store['users'],
+                store['films'],
+                store['ratings'],
+                store['user_links'].tolist(),
+                store['film_links'].tolist(),
+                store['film_titles'].tolist()
+            )
+
+    def save(self, path):
+        '''
+            Takes in string representing path to save store to as .npz file.
+        '''
+
+        np.savez_compressed(
+            path,
+            users=self.users,
+            films=self.films,
+            ratings=self.ratings,
+            user_links=np.array(self.user_links, dtype=str),
+            film_links=np.array(self.film_links, dtype=str),
+            film_titles=np.array(self.film_titles, dtype=str)
+        )
+
+    @property
+    def n_ratings(self):
+        return len(self.ratings)
+
+    @property
+    def nbytes(self):
+        # Bytes held by rating arrays, hrefs and titles aren't counted
+        return self.users.nbytes + self.films.nbytes + self.ratings.nbytes
+
+    def film_code(self, film_link):
+        '''
+            Takes in string representing film href.
+            Returns integer representing film's code, or -1 if store has no ratings of film.
+        '''
+
+        if self._film_codes is None:
+            self._film_codes = {link: code for code, link in enumerate(self.film_links)}
+
+        return self._film_codes.get(film_link, -1)
+
+    def to_df(self):
+        '''
+            Returns pandas.DataFrame object with User, Film Link and Rating columns, in the form surprise.Dataset.load_from_df takes.
+            Hrefs are categorical, so each one is only held once.
+        '''
+
+        return pd.DataFrame({
+            'User': pd.Categorical.from_codes(self.users, self.user_links),
+            'Film Link': pd.Categorical.from_codes(self.films, self.film_links),
+            'Rating': self.ratings
+        })
@@ -2,12 +2,23 @@
     For scraping Letterboxd user pages.
 '''
 
-from members_scraper import fetch_html
-from bs4 import BeautifulSoup
-import pandas as pd
+from members_scraper import fetch_html, retry_policy
+import columnar
+import extract
+import numpy as np
 import asyncio
 import aiohttp
-import time   
+import time
+import sys
+import os
+
+
+# Number of films listed first when a member was crawled that are kept in their state, to find where an incremental crawl of
+# them can stop even if some of those films have since been removed from their diary
+recent_films = 10
+
+# Columns of data/ratings table. Ratings are floats since films logged without rating are given the member's mean rating.
+ratings_columns = {'User': str, 'Film': str, 'Film Link': str, 'Rating': np.float32}
 
 
 async def get_num_film_pages(member, session):
@@ -19,161 +30,318 @@ async def get_num_film_pages(member, session):
     url = f'https://letterboxd.com{member}films/'
     (resp_code, html) = await fetch_html(url, session)
 
-    attempts = 1
-    while resp_code != 200 and attempts < 100:
-        (resp_code, html) = await fetch_html(url, session)
-        attempts += 1
-
     try:
         if resp_code != 200:
             raise Exception(f"Response code {resp_code}")
         
-        # Parsing page using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        paginate_pages = soup.find_all("li", class_="paginate-page")
-
-        return int(paginate_pages[-1].find('a').text) if paginate_pages else 1
+        return extract.num_pages(extract.parse(html))
     
     except Exception as err:
         print(f"Error finding number of pages to scrape for member {member}: {err}")
 
 
-async def scrape_member_ratings(member, page, session):
+async def scrape_member_page(member, page, session):
     '''
-        Takes in string representing Letterboxd user href, int representing page number, and aiohttp.ClientSession object.  
-        Returns tuple of list of dicts representing user rated data and list of dict representings user unrated data respectively.
+        Takes in string representing Letterboxd user href, int representing page number, and aiohttp.ClientSession object.
+        Returns list of dicts representing films on page in the order they're listed, empty if page is past the end of user's films,
+        or None if page couldn't be scraped. Films user rated have a Rating, others don't.
     '''
 
     url = f'https://letterboxd.com{member}films/page/{page}/'
     (resp_code, html) = await (fetch_html(url, session))
 
-    attempts = 1
-    while resp_code != 200 and attempts < 100:
-        (resp_code, html) = await (fetch_html(url, session))
-        attempts += 1
-
-    rated_data = []
-    unrated_data = []
+    data = []
 
     try:
-        # Parsing data using BeautifulSoup
-        soup = BeautifulSoup(html, 'lxml')
-        films = soup.find_all("li", class_="poster-container")   
-
-        for film in films:
-            rating_span = film.find('p').find('span')
-
-            if rating_span: 
-                rating = rating_span.attrs['class'][-1].split('-')[1]
-                if rating != "16": # Adding to rated data
-                    item = {}
-                    item['User'] = member
-                    film_info = film.find('div')
-                    item['Film'] = film_info.find('img').attrs['alt']
-                    item['Film Link'] = film_info.attrs['data-target-link']
-                    item['Rating'] = rating
-
-                    rated_data.append(item)
-
-                else: # If got rating of 16, it means the user liked the film but didn't rate it. Add to unrated data.
-                    item = {}
-                    item['User'] = member
-                    film_info = film.find('div')
-                    item['Film'] = film_info.find('img').attrs['alt']
-                    item['Film Link'] = film_info.attrs['data-target-link']
-
-                    unrated_data.append(item)                    
-
-            # If user doesn't have rating for film, add to unrated data
-            else: 
-                item = {}
-                item['User'] = member
-                film_info = film.find('div')
-                item['Film'] = film_info.find('img').attrs['alt']
-                item['Film Link'] = film_info.attrs['data-target-link']
-
-                unrated_data.append(item)
+        if resp_code != 200:
+            raise Exception(f"Response code {resp_code}")
+
+        # Pulling film info out of page with lxml
+        for (film_link, film_name, rating) in extract.poster_films(extract.parse(html)):
+            item = {}
+            item['User'] = member
+            item['Film'] = film_name
+            item['Film Link'] = film_link
+
+            # If got rating of 16, it means the user liked the film but didn't rate it. If user doesn't have rating for film at all,
+            # rating is None. Either way film is left unrated.
+            if rating is not None and rating != "16":
+                item['Rating'] = rating
+
+            data.append(item)
 
     except Exception as err:
         print(f"Error scraping member {member}, film page #{page}: {err}")
+        return None
 
-    finally: 
-        return (rated_data, unrated_data)
-    
+    return data
+
+
+async def scrape_member_ratings(member, page, session):
+    '''
+        Takes in string representing Letterboxd user href, int representing page number, and aiohttp.ClientSession object.  
+        Returns tuple of list of dicts representing user rated data and list of dict representings user unrated data respectively.
+    '''
+
+    data = await scrape_member_page(member, page, session) or []
+
+    return ([item for item in data if 'Rating' in item], [item for item in data if 'Rating' not in item])
+
+
+async def limited(slots, coro):
+    '''
+        Takes in asyncio.Semaphore object and coroutine.
+        Returns result of coroutine, awaited once one of the semaphore's slots is free.
+    '''
+
+    async with slots:
+        return await coro
+
+
+async def scrape_member(member, session, slots):
+    '''
+        Takes in string representing Letterboxd user href, aiohttp.ClientSession object, and asyncio.Semaphore object bounding page
+        fetches in flight across the crawl. Scrapes every page of member's films.
+        Returns tuple of list of dicts representing member's films in the order they're listed and number of pages scraped.
+    '''
+
+    # Get number of pages user has filled in ratings
+    pages = await limited(slots, get_num_film_pages(member, session))
+    if pages is None:
+        raise Exception("Couldn't find number of pages")
+
+    # Scraping every page user has filled in ratings. Pages wait their turn for a slot, so heavy members don't burst.
+    tasks = []
+    for page in range(1, pages + 1):
+        print(f'Scraping member {member}, page {page}. . .')
+        tasks.append(limited(slots, scrape_member_page(member, page, session)))
+    responses = await asyncio.gather(*tasks)
+
+    # A missing page would leave a hole in member's films, so member is crawled again instead
+    if any(response is None for response in responses):
+        raise Exception("Couldn't scrape every page")
+
+    return ([item for response in responses for item in response], pages + 1)
+
+
+async def scrape_new_films(member, recent, session, slots):
+    '''
+        Takes in string representing Letterboxd user href, list of hrefs of the films listed first when member was last crawled,
+        most recent first (empty if they weren't), aiohttp.ClientSession object, and asyncio.Semaphore object bounding page fetches
+        in flight across the crawl. Member's films are listed most recently logged first, so pages are scraped one at a time until
+        reaching the first of those films that's still listed.
+        Returns tuple of list of dicts representing films member logged since then in the order they're listed and number of pages
+        scraped. Raises exception if a page couldn't be scraped, or if none of those films are listed any more, since everything
+        scraped would then be stored a second time.
+    '''
+
+    data = []
+    page = 0
+    while True:
+        page += 1
+        print(f'Scraping member {member}, page {page}. . .')
+        films = await limited(slots, scrape_member_page(member, page, session))
+
+        if films is None:
+            raise Exception(f"Couldn't scrape page {page}")
+
+        # An empty page means the end of member's films was reached
+        if not films:
+            if recent:
+                raise Exception("None of the films listed first at last crawl are listed any more")
+            break
+
+        film_links = [film['Film Link'] for film in films]
+        seen = [i for (i, film_link) in enumerate(film_links) if film_link in recent]
+        if seen:
+            data += films[:seen[0]]
+            break
 
-async def main():
-    pages_scraped = 0
+        data += films
+
+    return (data, page)
+
+
+async def crawl_member(member, previous, mode, session, slots):
+    '''
+        Takes in string representing Letterboxd user href, dict representing member's state when last crawled (empty if they weren't),
+        string representing crawl mode, aiohttp.ClientSession object, and asyncio.Semaphore object bounding page fetches in flight.
+        Returns tuple of list of dicts representing member's ratings to store, dict representing member's new state, and number of
+        pages scraped.
+    '''
+
+    # States from crawls before several films were kept only hold the newest one
+    previous_recent = previous.get('recent') or ([previous['newest']] if previous.get('newest') else [])
+
+    if mode == 'incremental':
+        (films, pages) = await scrape_new_films(member, previous_recent, session, slots)
+    else:
+        (films, pages) = await scrape_member(member, session, slots)
+
+    recent = list(dict.fromkeys([film['Film Link'] for film in films[:recent_films]] + previous_recent))[:recent_films]
+
+    # Films logged without rating are given the mean of all the ratings member gave. Mean is updated from the previous crawl's
+    # rather than recomputed, since films rated then aren't scraped again.
+    rated = [float(film['Rating']) for film in films if 'Rating' in film]
+    n_rated = previous.get('rated', 0) + len(rated)
+    mean_rating = round(((previous.get('mean') or 0) * previous.get('rated', 0) + sum(rated)) / n_rated, 2) if n_rated else None
+
+    # Only store data if user rated any films
+    if mean_rating is None:
+        films = []
+    for film in films:
+        film.setdefault('Rating', mean_rating)
+
+    return (films, {'recent': recent, 'mean': mean_rating, 'rated': n_rated}, pages)
+
+
+async def crawl_worker(members, results, member_state, mode, session, slots, progress):
+    '''
+        Takes in iterator of member hrefs shared by every worker, asyncio.Queue object to put each crawled member's (member, ratings,
+        state) on, dict mapping member href to state when last crawled, string representing crawl mode, aiohttp.ClientSession object,
+        asyncio.Semaphore object bounding page fetches in flight, and dict counting members and pages crawled.
+        Crawls members one at a time until iterator runs out. Members that error are left out of results and added to progress's
+        list of failed members, so they keep their state from their last crawl and the next crawl tries them again.
+    '''
+
+    for member in members:
+        try:
+            previous = member_state.get(member, {}) if mode == 'incremental' else {}
+            (films, state, pages) = await crawl_member(member, previous, mode, session, slots)
+
+            progress['members'] += 1
+            progress['pages'] += pages
+            print(f'Finished scraping {member}. {progress["pages"]} pages scraped so far. . .')
+
+            # Waits if writer has fallen behind, so finished members don't pile up in memory
+            await results.put((member, films, state))
+
+        except Exception as err:
+            progress['failed'].append(member)
+            print(f'Error caught member {member}: {err}')
+
+
+async def write_chunks(writer, results, crawl_id, members_per_chunk=100):
+    '''
+        Takes in columnar.ChunkWriter object, asyncio.Queue object of (member, ratings, state) tuples ended by None, integer
+        representing id of crawl, and number of members per chunk.
+        Writes members' ratings to a chunk of table every members_per_chunk members, with their states as its checkpoint. Chunks are
+        compressed and saved in a thread so crawling carries on meanwhile.
+    '''
+
+    data = []
+    checkpoint = {}
+
+    while True:
+        result = await results.get()
+        if result is None:
+            break
+
+        (member, films, state) = result
+        data += films
+        checkpoint[member] = state
+
+        if len(checkpoint) >= members_per_chunk:
+            await asyncio.to_thread(writer.write, data, {'crawl': crawl_id, 'members': checkpoint})
+            data = []
+            checkpoint = {}
+
+    # Cleaning up data that hasn't been written yet and writing it
+    if checkpoint:
+        await asyncio.to_thread(writer.write, data, {'crawl': crawl_id, 'members': checkpoint})
+
+
+def crawl_state(manifest):
+    '''
+        Takes in dict representing manifest of data/ratings table.
+        Returns tuple of dict mapping member href to their state when last crawled (films listed first, mean rating and number of films
+        rated), and set of members already crawled by the crawl the manifest records as current.
+    '''
+
+    crawl_id = manifest['crawl']['id'] if manifest.get('crawl') else None
+    members = {}
+    done = set()
+
+    # Later chunks hold later crawls of a member, so their state wins
+    for chunk in manifest['chunks']:
+        info = chunk.get('info') or {}
+        members.update(info.get('members', {}))
+        if info.get('crawl') == crawl_id:
+            done.update(info.get('members', {}))
+
+    return (members, done)
+
+
+async def main(mode='full'):
+    # Crawl is checkpointed in data/ratings manifest with every chunk written, along with each member's state when crawled.
+    # Rerunning an interrupted crawl resumes it from the last checkpoint. Incremental crawls only scrape films logged since each
+    # member's last crawl and append them to the table.
+    # Members are crawled concurrently by CRAWL_CONCURRENCY workers, which share that many page fetch slots between them, so the
+    # same number of requests stays in flight however many pages each member has.
+    concurrency = int(os.environ.get('CRAWL_CONCURRENCY', 50))
 
     # Scraping member pages listed in data/members.csv
     with open("data/members.csv") as fh:
         fh.readline()
-        members_lines = fh.readlines()
+        members = [line.split(',')[1].strip() for line in fh.readlines()]
+
+    manifest = columnar.read_manifest('data/ratings') if columnar.has_table('data/ratings') else None
+    crawl = manifest.get('crawl') if manifest else None
+    resume = crawl is not None and not crawl['finished'] and crawl['mode'] == mode
+
+    if mode == 'incremental' and not (manifest and crawl_state(manifest)[0]):
+        print("data/ratings has no crawl checkpoints to refresh from. Run a full crawl first.")
+        return
 
-    open("data/ratings.csv", "w").close()
+    writer = columnar.ChunkWriter('data/ratings', ratings_columns, append=resume or mode == 'incremental')
+    if not resume:
+        crawl_id = crawl['id'] + 1 if crawl is not None and mode == 'incremental' else 1
+        writer.manifest['crawl'] = {'id': crawl_id, 'mode': mode, 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'finished': False}
+        writer.save_manifest()
+
+    crawl_id = writer.manifest['crawl']['id']
+    (member_state, done) = crawl_state(writer.manifest)
+    if resume:
+        print(f'Resuming {mode} crawl started {writer.manifest["crawl"]["started"]}, {len(done)} members already crawled. . .')
 
     t0 = time.time()
 
     # Scraping all films logged by members in data/members.csv
-    async with aiohttp.ClientSession() as session:
-        users_scraped = 0
-        data = []
-
-        for line in members_lines:
-            # After every 100 members' ratings are scraped, dump data to data/ratings.csv
-            if users_scraped != 0 and users_scraped % 100 == 0:
-                df = pd.DataFrame(data)
-                df.to_csv("data/ratings.csv", mode='a')
-                data = []
-                users_scraped = 0
-
-            tasks = []
-            member = line.split(',')[1].strip()
-
-            try:
-                # Get number of pages user has filled in ratings
-                tasks.append(get_num_film_pages(member, session))
-                pages = (await asyncio.gather(*tasks))[0]
-                pages_scraped += 1
-                
-                # Scraping every page user has filled in ratings
-                tasks = []
-                for page in range(1, pages + 1):
-                    print(f'Scraping member {member}, page {page}. . .')
-                    tasks.append(scrape_member_ratings(member, page, session))
-                responses = await asyncio.gather(*tasks)
-
-                rating_sum = sum(len(rated_data) for rated_data, _ in responses)
-                if rating_sum: # Only store data if user rated any films
-                    mean_rating = round(sum(int(data['Rating']) for rated_data, _ in responses for data in rated_data ) / rating_sum, 2)
-                    for rated_data, unrated_data in responses:
-                        data += rated_data
-
-                        if unrated_data:
-                            for i in range(len(unrated_data)):
-                                unrated_data[i]['Rating'] = mean_rating
-
-                            data += unrated_data
-
-                pages_scraped += pages
-                print(f'Finished scraping {member}. {pages_scraped} pages scraped so far. . .')
-
-            except Exception as err:
-                print(f'Error caught member {member}: {err}')
-
-            finally:
-                users_scraped += 1
+    progress = {'members': 0, 'pages': 0, 'failed': []}
+    slots = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue(maxsize=concurrency)
+    pending = iter([member for member in members if member not in done])
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        chunk_writer = asyncio.create_task(write_chunks(writer, results, crawl_id))
+        crawlers = asyncio.gather(*[crawl_worker(pending, results, member_state, mode, session, slots, progress) for _ in range(concurrency)])
+
+        # Writer only finishes early if writing a chunk failed, in which case crawling stops rather than waiting on it forever
+        await asyncio.wait([crawlers, chunk_writer], return_when=asyncio.FIRST_COMPLETED)
+        if chunk_writer.done():
+            crawlers.cancel()
+            chunk_writer.result()
+
+        await results.put(None)
+        await chunk_writer
 
     t1=time.time()
 
-    print(f"{(t1-t0)/60} minutes to scrape {pages_scraped} member film pages")
+    print(f"{(t1-t0)/60} minutes to scrape {progress['pages']} film pages of {progress['members']} members ({progress['pages'] / max(t1 - t0, 1e-9):.1f} pages/s)")
+    print(f"Retry stats: {retry_policy.stats}")
+
+    # A resumed crawl only tries members this one didn't write, so members that failed are retried by a rerun if crawl is left
+    # unfinished. Once a rerun has had its go at them the crawl is finished anyway, and they're tried again by the next crawl.
+    writer.manifest['crawl']['failed'] = progress['failed']
+    writer.manifest['crawl']['finished'] = not progress['failed'] or resume
+    writer.save_manifest()
 
-    # Cleaning up data that hasn't been dumped to csv and dumping it
-    if len(data) > 0:
-        df = pd.DataFrame(data)
-        df.to_csv("data/ratings.csv", mode='a')
+    if progress['failed']:
+        print(f"{len(progress['failed'])} members couldn't be crawled{'' if resume else ', rerun to retry them'}.")
 
     print("Ratings finished scraping.")
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    # "py ratings_scraper.py incremental" only scrapes films members logged since the last crawl
+    asyncio.run(main('incremental' if sys.argv[1:] == ['incremental'] else 'full'))
@@ -0,0 +1,133 @@
+'''
+    Retry policy with exponential backoff, jitter and Retry-After handling for requests to Letterboxd.
+    Kept in sync with back-end-fastapi/app/retry.py.
+'''
+
+from email.utils import parsedate_to_datetime
+import asyncio
+import aiohttp
+import random
+import time
+
+
+class RetryPolicy:
+    '''
+        Retries a request while it fails with a retryable status or a connection error, sleeping a random time up to an exponentially
+        growing cap between attempts (full jitter). Throttling responses that come with Retry-After wait at least that long.
+        Other 4xx responses are returned straight away since retrying them won't change the answer.
+        Keeps counts of what happened to every request made through it.
+    '''
+
+    # Statuses worth retrying: request timeout, too early, throttled, and any server error
+    retry_statuses = {408, 425, 429}
+
+    def __init__(self, max_attempts=10, base_delay=0.5, max_delay=30.0, max_retry_after=120.0, deadline=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.deadline = deadline
+        self.stats = {
+            'requests': 0,
+            'attempts': 0,
+            'retries': 0,
+            'throttled': 0,
+            'server_errors': 0,
+            'client_errors': 0,
+            'connection_errors': 0,
+            'gave_up': 0,
+            'sleep_seconds': 0.0
+        }
+
+    def should_retry(self, status):
+        '''
+            Takes in integer representing response status.
+            Returns boolean indicating whether request is worth retrying.
+        '''
+
+        return status in self.retry_statuses or status >= 500
+
+    def backoff(self, attempt, retry_after=None):
+        '''
+            Takes in integer representing number of attempts made so far and optional value of response's Retry-After header.
+            Returns number of seconds to wait before next attempt.
+        '''
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+
+        return delay
+
+    async def call(self, request, url, session, deadline=None, outcome=None):
+        '''
+            Takes in coroutine function taking url and aiohttp.ClientSession object and returning tuple of response status, response
+            text and value of Retry-After header, string representing url, aiohttp.ClientSession object, and optional number of seconds
+            the call may take overall (defaults to policy's deadline), and optional dict to also count this call's attempts in, under
+            the same keys as stats, for callers that need to know how their own requests went rather than every caller's.
+            Returns tuple of response status and response text of last attempt. Re-raises last connection error if every attempt failed
+            with one.
+        '''
+
+        def count(key, amount=1):
+            self.stats[key] += amount
+            if outcome is not None:
+                outcome[key] = outcome.get(key, 0) + amount
+
+        deadline = deadline if deadline is not None else self.deadline
+        give_up_at = time.monotonic() + deadline if deadline is not None else float('inf')
+        count('requests')
+
+        attempt = 0
+        while True:
+            attempt += 1
+            count('attempts')
+            retry_after = None
+
+            try:
+                (status, text, retry_after) = await request(url, session)
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                count('connection_errors')
+                (status, text, error) = (None, None, err)
+
+            else:
+                if not self.should_retry(status):
+                    if 400 <= status < 500:
+                        count('client_errors')
+                    return (status, text)
+
+                count('throttled' if status == 429 else 'server_errors' if status >= 500 else 'client_errors')
+
+            delay = self.backoff(attempt, retry_after)
+            if attempt >= self.max_attempts or time.monotonic() + delay > give_up_at:
+                count('gave_up')
+                if status is None:
+                    raise error
+                return (status, text)
+
+            count('retries')
+            count('sleep_seconds', delay)
+            await asyncio.sleep(delay)
+
+
+def parse_retry_after(value):
+    '''
+        Takes in value of Retry-After header, either a number of seconds or an HTTP date, or None.
+        Returns number of seconds to wait, or None if value is missing or can't be parsed.
+    '''
+
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
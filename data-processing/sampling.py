@@ -0,0 +1,99 @@
+'''
+    Streaming per-user sampling of scraped ratings in data/ratings, for building the model's training set.
+'''
+
+from rating_store import RatingStore
+import columnar
+import numpy as np
+
+
+def encode(values, codes):
+    '''
+        Takes in array of strings and dict mapping each string seen so far to its integer code.
+        Returns numpy int32 array of each string's code, giving strings not seen before the next codes in order.
+    '''
+
+    return np.array([codes.setdefault(value, len(codes)) for value in values.tolist()], dtype=np.int32)
+
+
+def keep_per_user(users, keys, per_user):
+    '''
+        Takes in numpy arrays of user codes and random sort keys in [0, 1) of ratings, and number of ratings to keep per user.
+        Returns numpy array of indices of the ratings kept, the per_user with the smallest keys for each user, ordered by user then key.
+    '''
+
+    # Keys are in [0, 1), so adding them to user codes sorts by user then key in a single argsort
+    order = np.argsort(users + keys)
+    sorted_users = users[order]
+
+    # Position of each rating within its user's ratings
+    starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+    ranks = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    return order[ranks < per_user]
+
+
+def sample_ratings(directory='data/ratings', per_user=200, seed=None, batch_rows=2000000):
+    '''
+        Takes in string representing directory of ratings table, maximum number of ratings to sample per user, optional seed for
+        random sampling, and number of rows to read before merging them into the sample.
+        Returns RatingStore object with a uniform random sample of up to per_user ratings of every user, without replacement.
+        Every rating is given a random key and each user's per_user smallest keys are kept, which is reservoir sampling done a batch
+        at a time. Only the sample and one batch of rows are held in memory at once, however many ratings the table holds.
+    '''
+
+    rng = np.random.default_rng(seed)
+    (user_codes, film_codes, film_titles) = ({}, {}, [])
+
+    sample = {'users': np.empty(0, np.int32), 'films': np.empty(0, np.int32), 'ratings': np.empty(0, np.float32), 'keys': np.empty(0)}
+    batch = {name: [] for name in sample}
+    batch_size = 0
+
+    def merge():
+        # Merging batch into sample and keeping each user's smallest keys
+        merged = {name: np.concatenate([sample[name]] + batch[name]) for name in sample}
+        kept = keep_per_user(merged['users'], merged['keys'], per_user)
+        for name in sample:
+            sample[name] = merged[name][kept]
+            batch[name] = []
+
+    for chunk in columnar.iter_chunks(directory, ['User', 'Film', 'Film Link', 'Rating']):
+        chunk = chunk[~np.isnan(chunk['Rating'].to_numpy())]
+
+        # Codes of chunk's distinct hrefs are looked up once, then spread over its rows
+        users = encode(chunk['User'].cat.categories, user_codes)[chunk['User'].cat.codes.to_numpy()]
+        n_films = len(film_codes)
+        films = encode(chunk['Film Link'].cat.categories, film_codes)[chunk['Film Link'].cat.codes.to_numpy()]
+
+        # Title of each film is taken from its first rating
+        (chunk_films, first_rows) = np.unique(films, return_index=True)
+        new = chunk_films >= n_films
+        film_titles += [None] * (len(film_codes) - n_films)
+        for (film, title) in zip(chunk_films[new].tolist(), chunk['Film'].to_numpy()[first_rows[new]]):
+            film_titles[film] = str(title)
+
+        batch['users'].append(users)
+        batch['films'].append(films)
+        batch['ratings'].append(chunk['Rating'].to_numpy().astype(np.float32))
+        batch['keys'].append(rng.random(len(chunk)))
+        batch_size += len(chunk)
+
+        if batch_size >= batch_rows:
+            merge()
+            batch_size = 0
+
+    merge()
+
+    # Recoding users and films so codes only cover those that made it into the sample
+    (users, user_ids) = np.unique(sample['users'], return_inverse=True)
+    (films, film_ids) = np.unique(sample['films'], return_inverse=True)
+    (user_links, film_links) = (list(user_codes), list(film_codes))
+
+    return RatingStore(
+        user_ids.astype(np.int32),
+        film_ids.astype(np.int32),
+        sample['ratings'],
+        [user_links[user] for user in users],
+        [film_links[film] for film in films],
+        [film_titles[film] for film in films]
+    )
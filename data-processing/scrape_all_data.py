@@ -11,6 +11,7 @@ os.system('py members_scraper.py')
 os.system('py ratings_scraper.py')
 os.system('py film_scraper.py')
 os.system('py create_model.py')
+os.system('py film_scraper.py enrich')
 
 t1 = time.time()
 
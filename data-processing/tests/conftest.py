@@ -0,0 +1,5 @@
+import sys
+import os
+
+# Scripts in data-processing import each other as top-level modules, the way they're run from data-processing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,73 @@
+from evaluation import holdout_mask, ranking_metrics
+from types import SimpleNamespace
+import numpy as np
+
+
+def make_trainset(users, films, ratings, logged=None, n_films=None):
+    # Stand-in for TrainingSet with the arrays and lookups evaluation reads
+    (users, films, ratings) = (np.asarray(users, dtype=np.int32), np.asarray(films, dtype=np.int32), np.asarray(ratings, dtype=np.float32))
+
+    def user_ratings(selected):
+        mask = np.isin(users, selected)
+        return (users[mask], films[mask], ratings[mask])
+
+    return SimpleNamespace(
+        users=users, films=films, ratings=ratings,
+        logged=np.asarray(logged if logged is not None else np.arange(len(users)), dtype=np.int64),
+        n_users=int(users.max()) + 1, n_films=n_films or int(films.max()) + 1, n_ratings=len(users),
+        user_ratings=user_ratings
+    )
+
+
+def test_holdout_mask_holds_out_fraction_of_each_user_with_enough_ratings():
+    users = [0] * 20 + [1] * 6 + [2] * 3
+    trainset = make_trainset(users, np.arange(len(users)), np.ones(len(users)))
+
+    held = holdout_mask(trainset, 'random', fraction=0.1, min_ratings=5, seed=0)
+
+    assert np.bincount(trainset.users[held], minlength=3).tolist() == [2, 1, 0]
+
+
+def test_holdout_mask_by_time_holds_out_most_recently_logged():
+    users = [0] * 10 + [1] * 10
+    logged = list(range(10)) + list(range(100, 90, -1))
+    trainset = make_trainset(users, np.arange(20), np.ones(20), logged)
+
+    held = holdout_mask(trainset, 'time', fraction=0.2)
+
+    assert np.flatnonzero(held).tolist() == [8, 9, 10, 11]
+
+
+def test_holdout_mask_at_random_depends_only_on_seed():
+    users = np.repeat(np.arange(50), 20)
+    trainset = make_trainset(users, np.arange(len(users)), np.ones(len(users)))
+
+    assert np.array_equal(holdout_mask(trainset, seed=1), holdout_mask(trainset, seed=1))
+    assert not np.array_equal(holdout_mask(trainset, seed=1), holdout_mask(trainset, seed=2))
+
+
+def test_precision_and_recall_at_k_count_relevant_held_out_films_ranked_first():
+    # User 0 rated films 0 to 3 and films 0 to 2 are held out, of which 0 and 1 are relevant. Model ranks film 0 first, film 2
+    # second, every unrated film next and film 1 last.
+    trainset = make_trainset([0, 0, 0, 0, 1], [0, 1, 2, 3, 4], [9, 9, 3, 7, 5], n_films=20)
+    held = np.array([True, True, True, False, False])
+    bi = np.zeros(20, dtype=np.float32)
+    (bi[0], bi[2], bi[1]) = (10, 9, -10)
+    model = SimpleNamespace(bi=bi, qi=np.zeros((20, 2), dtype=np.float32), pu=np.zeros((2, 2), dtype=np.float32))
+
+    metrics = ranking_metrics(model, trainset, held, ks=(1, 2, 19), n_negatives=16, relevant_rating=8, seed=0)
+
+    assert metrics['users'] == 1
+    assert (metrics['precision@1'], metrics['recall@1']) == (1.0, 0.5)
+    assert (metrics['precision@2'], metrics['recall@2']) == (0.5, 0.5)
+    assert (metrics['precision@19'], metrics['recall@19']) == (round(2 / 19, 4), 1.0)
+
+
+def test_ranking_metrics_without_relevant_held_out_ratings_reports_none():
+    trainset = make_trainset([0, 0, 1], [0, 1, 2], [3, 4, 5], n_films=10)
+    model = SimpleNamespace(bi=np.zeros(10, dtype=np.float32), qi=np.zeros((10, 2), dtype=np.float32), pu=np.zeros((2, 2), dtype=np.float32))
+
+    metrics = ranking_metrics(model, trainset, np.array([True, False, True]), ks=(5,), seed=0)
+
+    assert metrics['users'] == 0
+    assert metrics['precision@5'] is None and metrics['recall@5'] is None
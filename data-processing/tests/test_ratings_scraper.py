@@ -0,0 +1,84 @@
+import ratings_scraper
+import asyncio
+import pytest
+
+
+def member_pages(links, per_page=3, failed=()):
+    # Stand-in for scrape_member_page serving member's films, listed most recent first, a page at a time. Pages in failed fail.
+    requested = []
+
+    async def scrape_member_page(member, page, session):
+        requested.append(page)
+        if page in failed:
+            return None
+        films = links[(page - 1) * per_page:page * per_page]
+        return [{'User': member, 'Film': link, 'Film Link': link, 'Rating': '8'} for link in films]
+
+    return (scrape_member_page, requested)
+
+
+def scrape_new_films(monkeypatch, links, recent, **pages_args):
+    (scrape_member_page, requested) = member_pages(links, **pages_args)
+    monkeypatch.setattr(ratings_scraper, 'scrape_member_page', scrape_member_page)
+    (films, pages) = asyncio.run(ratings_scraper.scrape_new_films('/member/', recent, None, asyncio.Semaphore(1)))
+
+    return ([film['Film Link'] for film in films], pages, requested)
+
+
+def test_stops_at_newest_film_from_last_crawl(monkeypatch):
+    links = [f'/film/{i}/' for i in range(10)]
+
+    (films, pages, requested) = scrape_new_films(monkeypatch, links, ['/film/4/', '/film/5/'])
+
+    assert films == ['/film/0/', '/film/1/', '/film/2/', '/film/3/']
+    assert pages == 2 and requested == [1, 2]
+
+
+def test_nothing_new_stops_after_first_page(monkeypatch):
+    links = [f'/film/{i}/' for i in range(10)]
+
+    (films, pages, _) = scrape_new_films(monkeypatch, links, ['/film/0/'])
+
+    assert films == [] and pages == 1
+
+
+def test_stops_at_next_recent_film_when_newest_was_removed(monkeypatch):
+    links = ['/film/new/'] + [f'/film/{i}/' for i in range(2, 10)]
+
+    (films, _, requested) = scrape_new_films(monkeypatch, links, ['/film/1/', '/film/2/', '/film/3/'])
+
+    assert films == ['/film/new/']
+    assert requested == [1]
+
+
+def test_member_not_crawled_before_is_scraped_to_the_end(monkeypatch):
+    links = [f'/film/{i}/' for i in range(7)]
+
+    (films, pages, _) = scrape_new_films(monkeypatch, links, [])
+
+    assert films == links and pages == 4
+
+
+def test_failed_page_raises_rather_than_ending_list(monkeypatch):
+    links = [f'/film/{i}/' for i in range(10)]
+
+    with pytest.raises(Exception, match="Couldn't scrape page 2"):
+        scrape_new_films(monkeypatch, links, ['/film/7/'], failed={2})
+
+
+def test_raises_rather_than_rescraping_history_when_recent_films_are_gone(monkeypatch):
+    links = [f'/film/{i}/' for i in range(10)]
+
+    with pytest.raises(Exception, match='None of the films'):
+        scrape_new_films(monkeypatch, links, ['/film/removed/'])
+
+
+def test_crawl_member_keeps_state_of_last_crawl_when_nothing_is_new(monkeypatch):
+    (scrape_member_page, _) = member_pages([f'/film/{i}/' for i in range(5)])
+    monkeypatch.setattr(ratings_scraper, 'scrape_member_page', scrape_member_page)
+    previous = {'newest': '/film/0/', 'mean': 7.0, 'rated': 5}
+
+    (films, state, _) = asyncio.run(ratings_scraper.crawl_member('/member/', previous, 'incremental', None, asyncio.Semaphore(1)))
+
+    assert films == []
+    assert state == {'recent': ['/film/0/'], 'mean': 7.0, 'rated': 5}
@@ -0,0 +1,66 @@
+from trainer import StreamingSVD, drift_report
+from types import SimpleNamespace
+import numpy as np
+
+
+def make_model(n_users, n_films, n_factors=4, seed=0):
+    rng = np.random.default_rng(seed)
+    model = StreamingSVD(n_factors=n_factors, verbose=False)
+    model.global_mean = 6.0
+    (model.bu, model.bi) = (rng.normal(0, 0.5, n_users).astype(np.float32), rng.normal(0, 0.5, n_films).astype(np.float32))
+    (model.pu, model.qi) = (rng.normal(0, 0.5, (n_users, n_factors)).astype(np.float32), rng.normal(0, 0.5, (n_films, n_factors)).astype(np.float32))
+
+    return model
+
+
+def make_trainset(n_users, n_films, n_ratings, seed=0):
+    # Stand-in for TrainingSet, drift_report only reads its rating arrays
+    rng = np.random.default_rng(seed)
+    return SimpleNamespace(
+        users=rng.integers(0, n_users, n_ratings).astype(np.int32),
+        films=rng.integers(0, n_films, n_ratings).astype(np.int32),
+        ratings=rng.integers(1, 11, n_ratings).astype(np.float32)
+    )
+
+
+def test_unchanged_model_has_no_drift():
+    model = make_model(50, 80)
+    trainset = make_trainset(50, 80, 2000)
+    affected = np.arange(10)
+
+    report = drift_report(model, model, trainset, 1500, affected, top_n=10, seed=0)
+
+    assert report['new_ratings'] == 500
+    assert report['new_users'] == 0 and report['new_films'] == 0
+    assert report['new_ratings_rmse']['previous'] == report['new_ratings_rmse']['updated']
+    assert report['unaffected_prediction_shift'] == {'mean': 0.0, 'max': 0.0}
+    assert report['unaffected_top_10_overlap'] == 1.0
+
+
+def test_counts_users_and_films_added_by_update():
+    previous = make_model(50, 80)
+    updated = make_model(60, 90, seed=1)
+
+    report = drift_report(previous, updated, make_trainset(50, 80, 1000), 900, np.arange(50, 60), top_n=10, seed=0)
+
+    assert report['new_users'] == 10 and report['new_films'] == 10
+    assert 0.0 <= report['unaffected_top_10_overlap'] <= 1.0
+
+
+def test_fewer_unaffected_users_than_compared_still_reports():
+    model = make_model(20, 80)
+    affected = np.arange(15)
+
+    report = drift_report(model, model, make_trainset(20, 80, 1000), 800, affected, top_n=10, n_users=200, seed=0)
+
+    assert report['affected_users'] == 15
+    assert report['unaffected_top_10_overlap'] == 1.0
+
+
+def test_every_user_affected_has_no_overlap_to_report():
+    model = make_model(20, 80)
+
+    report = drift_report(model, model, make_trainset(20, 80, 1000), 800, np.arange(20), top_n=10, seed=0)
+
+    assert report['unaffected_top_10_overlap'] is None
+    assert report['unaffected_rmse'] == {'previous': None, 'updated': None}
@@ -0,0 +1,481 @@
+'''
+    Out-of-core trainer for the SVD model, so it can be trained on every scraped rating rather than a sample of them. Ratings are
+    integer coded once into memory-mapped arrays on disk, and each epoch streams them back a shuffled block at a time into minibatch
+    SGD over NumPy arrays. Follows surprise.SVD's objective and defaults as a minibatch approximation of its per rating updates, and
+    its parameters are exported the way surprise.SVD's are, so the trained model is served like one. A trained model can also be
+    updated with ratings scraped since, warm starting from its parameters rather than training again.
+'''
+
+from surprise import SVD, Trainset
+from rating_store import RatingStore
+from sampling import encode
+import columnar
+import numpy as np
+import resource
+import json
+import time
+import os
+
+
+class TrainingSet:
+    '''
+        Integer coded ratings written to a directory of .npy arrays of user codes, film codes, ratings and when each was logged
+        relative to the user's others, along with the hrefs and titles codes stand for and how much of the ratings table they cover.
+        Ratings are stored in blocks, each a random subset of the ratings appended with it, so reading blocks in a random order and
+        shuffling within each gives a shuffled pass over all ratings while only holding one block in memory.
+    '''
+
+    record = np.dtype([('user', '<i4'), ('film', '<i4'), ('rating', '<f4'), ('logged', '<i8')])
+    columns = (('users', 'user', np.int32), ('films', 'film', np.int32), ('ratings', 'rating', np.float32), ('logged', 'logged', np.int64))
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._open()
+
+    def _open(self):
+        # Mapping arrays and reading meta, again after ratings are appended
+        self.users = np.load(f'{self.directory}/users.npy', mmap_mode='r')
+        self.films = np.load(f'{self.directory}/films.npy', mmap_mode='r')
+        self.ratings = np.load(f'{self.directory}/ratings.npy', mmap_mode='r')
+        self.logged = np.load(f'{self.directory}/logged.npy', mmap_mode='r')
+
+        with np.load(f'{self.directory}/meta.npz') as meta:
+            self.user_links = meta['user_links'].tolist()
+            self.film_links = meta['film_links'].tolist()
+            self.film_titles = meta['film_titles'].tolist()
+            self.block_offsets = meta['block_offsets']
+            self.global_mean = float(meta['global_mean'])
+            self.table_created = str(meta['table_created'])
+            self.table_chunks = int(meta['table_chunks'])
+
+        self.n_ratings = len(self.ratings)
+        self.n_users = len(self.user_links)
+        self.n_films = len(self.film_links)
+
+    @classmethod
+    def build(cls, table_dir, directory, block_rows=1000000, seed=None):
+        '''
+            Takes in string representing directory of ratings table, string representing directory to write training set to, number
+            of ratings per block, and optional seed for assigning ratings to blocks.
+            Returns TrainingSet object with every rating in table.
+        '''
+
+        os.makedirs(directory, exist_ok=True)
+        for (name, _, dtype) in cls.columns:
+            np.save(f'{directory}/{name}.npy', np.empty(0, dtype=dtype))
+
+        manifest = columnar.read_manifest(table_dir)
+        _save_meta(directory, [], [], [], np.zeros(1, dtype=np.int64), 0.0, manifest.get('created', ''), 0)
+
+        trainset = cls(directory)
+        trainset.append(table_dir, block_rows, seed)
+
+        return trainset
+
+    def is_current(self, table_dir):
+        '''
+            Takes in string representing directory of ratings table.
+            Returns boolean indicating whether table is the one training set was coded from, with at most chunks appended since.
+            A table that was scraped again from scratch isn't.
+        '''
+
+        manifest = columnar.read_manifest(table_dir)
+
+        return manifest.get('created', '') == self.table_created and len(manifest['chunks']) >= self.table_chunks
+
+    def append(self, table_dir, block_rows=1000000, seed=None):
+        '''
+            Takes in string representing directory of ratings table, number of ratings per block, and optional seed for assigning
+            ratings to blocks. Codes ratings in chunks of table added since training set was last coded, giving users and films not
+            seen before the next codes, and appends them as new blocks.
+            Returns integer representing position of first appended rating. Table is read a chunk at a time and each rating is written
+            to a random block's file, then blocks are copied after the existing ratings, so memory use is one chunk or block however
+            large the table is.
+        '''
+
+        rng = np.random.default_rng(seed)
+        manifest = columnar.read_manifest(table_dir)
+        (start, stop) = (self.table_chunks, len(manifest['chunks']))
+        n_blocks = max(1, -(-sum(chunk['rows'] for chunk in manifest['chunks'][start:stop]) // block_rows))
+
+        block_files = [open(f'{self.directory}/block-{block}.tmp', 'wb') for block in range(n_blocks)]
+        user_codes = {link: user for user, link in enumerate(self.user_links)}
+        film_codes = {link: film for film, link in enumerate(self.film_links)}
+        film_titles = list(self.film_titles)
+        (rating_sum, n_new) = (self.global_mean * self.n_ratings, 0)
+
+        for (position, chunk) in enumerate(columnar.iter_chunks(table_dir, ['User', 'Film', 'Film Link', 'Rating'], start, stop), start):
+            # Members' films are listed most recently logged first and later chunks are later crawls, so ratings are ordered by when
+            # they were logged by chunk, then by row backwards
+            logged = (position << 32) - np.arange(len(chunk), dtype=np.int64)
+            rated = ~np.isnan(chunk['Rating'].to_numpy())
+            (chunk, logged) = (chunk[rated], logged[rated])
+
+            records = np.empty(len(chunk), dtype=self.record)
+            records['user'] = encode(chunk['User'].cat.categories, user_codes)[chunk['User'].cat.codes.to_numpy()]
+            n_films = len(film_codes)
+            records['film'] = encode(chunk['Film Link'].cat.categories, film_codes)[chunk['Film Link'].cat.codes.to_numpy()]
+            records['rating'] = chunk['Rating'].to_numpy()
+            records['logged'] = logged
+
+            # Title of each film is taken from its first rating
+            (chunk_films, first_rows) = np.unique(records['film'], return_index=True)
+            new = chunk_films >= n_films
+            film_titles += [None] * (len(film_codes) - n_films)
+            for (film, title) in zip(chunk_films[new].tolist(), chunk['Film'].to_numpy()[first_rows[new]]):
+                film_titles[film] = str(title)
+
+            # Scattering chunk's ratings over blocks
+            blocks = rng.integers(n_blocks, size=len(records))
+            order = np.argsort(blocks, kind='stable')
+            for (block, block_records) in enumerate(np.split(records[order], np.cumsum(np.bincount(blocks, minlength=n_blocks))[:-1])):
+                block_records.tofile(block_files[block])
+
+            rating_sum += float(records['rating'].sum(dtype=np.float64))
+            n_new += len(records)
+
+        for fh in block_files:
+            fh.close()
+
+        # Copying existing ratings then new blocks into new arrays, which replace the old ones once written
+        n_ratings = self.n_ratings + n_new
+        arrays = {name: np.lib.format.open_memmap(f'{self.directory}/{name}.npy.tmp', mode='w+', dtype=dtype, shape=(n_ratings,))
+                  for name, _, dtype in self.columns}
+
+        for offset in range(0, self.n_ratings, block_rows):
+            part = slice(offset, min(offset + block_rows, self.n_ratings))
+            for (name, _, _) in self.columns:
+                arrays[name][part] = getattr(self, name)[part]
+
+        block_offsets = list(self.block_offsets)
+        for block in range(n_blocks):
+            block_records = np.fromfile(f'{self.directory}/block-{block}.tmp', dtype=self.record)
+            if len(block_records):
+                part = slice(block_offsets[-1], block_offsets[-1] + len(block_records))
+                for (name, field, _) in self.columns:
+                    arrays[name][part] = block_records[field]
+                block_offsets.append(part.stop)
+            os.remove(f'{self.directory}/block-{block}.tmp')
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        # Dropping maps of old arrays before they're replaced
+        first_new = self.n_ratings
+        (self.users, self.films, self.ratings, self.logged) = (None, None, None, None)
+        for (name, _, _) in self.columns:
+            os.replace(f'{self.directory}/{name}.npy.tmp', f'{self.directory}/{name}.npy')
+
+        _save_meta(
+            self.directory,
+            list(user_codes),
+            list(film_codes),
+            film_titles,
+            np.array(block_offsets, dtype=np.int64),
+            rating_sum / max(n_ratings, 1),
+            manifest.get('created', ''),
+            stop
+        )
+        self._open()
+
+        return first_new
+
+    def blocks(self, rng, exclude=None):
+        '''
+            Takes in numpy.random.Generator object and optional boolean numpy array over ratings that's True for ratings to leave out.
+            Yields tuple of numpy arrays of user codes, film codes and ratings of each block, in a random order of blocks, read into
+            memory and shuffled.
+        '''
+
+        for block in rng.permutation(len(self.block_offsets) - 1):
+            (start, end) = self.block_offsets[block], self.block_offsets[block + 1]
+            order = rng.permutation(end - start)
+            if exclude is not None:
+                order = order[~exclude[start:end][order]]
+            yield (np.asarray(self.users[start:end])[order], np.asarray(self.films[start:end])[order], np.asarray(self.ratings[start:end])[order])
+
+    def user_ratings(self, users, block_rows=1000000):
+        '''
+            Takes in numpy array of user codes and number of ratings to scan at a time.
+            Returns tuple of numpy arrays of user codes, film codes and ratings of every rating by those users, read into memory.
+        '''
+
+        parts = []
+        for start in range(0, self.n_ratings, block_rows):
+            part = slice(start, start + block_rows)
+            selected = np.isin(self.users[part], users)
+            parts.append((self.users[part][selected], self.films[part][selected], self.ratings[part][selected]))
+
+        return tuple(np.concatenate([part[i] for part in parts]) if parts else np.empty(0) for i in range(3))
+
+    def to_store(self):
+        '''
+            Returns RatingStore object over training set's ratings. Its arrays stay memory-mapped, so saving it streams them from disk.
+        '''
+
+        return RatingStore(self.users, self.films, self.ratings, self.user_links, self.film_links, self.film_titles)
+
+
+def _save_meta(directory, user_links, film_links, film_titles, block_offsets, global_mean, table_created, table_chunks):
+    # Writing hrefs codes stand for and what ratings table training set covers
+    np.savez(
+        f'{directory}/meta.npz',
+        user_links=np.array(user_links, dtype=str),
+        film_links=np.array(film_links, dtype=str),
+        film_titles=np.array(film_titles, dtype=str),
+        block_offsets=block_offsets,
+        global_mean=global_mean,
+        table_created=table_created,
+        table_chunks=table_chunks
+    )
+
+
+class StreamingSVD:
+    '''
+        Biased matrix factorization following surprise.SVD's objective and defaults: each rating's error moves user and film biases
+        and factors towards it, with every parameter regularized per rating. It's a minibatch approximation of surprise.SVD's SGD
+        rather than a copy of it. Ratings are taken in minibatches of batch_size, so a batch's updates to a parameter are summed
+        rather than applied one after another, and the parameters it reaches differ from surprise.SVD's on the same ratings.
+        Keeps timing and memory of every epoch in epochs, printing them as they finish if verbose.
+    '''
+
+    def __init__(self, n_factors=100, n_epochs=20, init_mean=0, init_std_dev=0.1, lr_all=0.005, reg_all=0.02, batch_size=1024, random_state=None,
+                 verbose=True):
+        self.n_factors = n_factors
+        self.n_epochs = n_epochs
+        self.init_mean = init_mean
+        self.init_std_dev = init_std_dev
+        self.lr_all = lr_all
+        self.reg_all = reg_all
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.verbose = verbose
+        self.epochs = []
+
+    @classmethod
+    def from_surprise(cls, algo):
+        '''
+            Takes in trained surprise.SVD algorithm, such as one to_surprise returned.
+            Returns StreamingSVD object with copies of algorithm's parameters and hyperparameters, to be updated by partial_fit.
+        '''
+
+        model = cls(algo.n_factors, algo.n_epochs, algo.init_mean, algo.init_std_dev, algo.lr_bu, algo.reg_bu, random_state=algo.random_state)
+        model.global_mean = float(algo.trainset.global_mean)
+        (model.bu, model.bi) = (np.array(algo.bu, dtype=np.float32), np.array(algo.bi, dtype=np.float32))
+        (model.pu, model.qi) = (np.array(algo.pu, dtype=np.float32), np.array(algo.qi, dtype=np.float32))
+
+        return model
+
+    def fit(self, trainset, exclude=None):
+        '''
+            Takes in TrainingSet object and optional boolean numpy array over its ratings that's True for ratings to leave out, like
+            ones held out for evaluation.
+            Returns self, with user biases bu, film biases bi, user factors pu and film factors qi trained over every other rating.
+        '''
+
+        rng = np.random.default_rng(self.random_state)
+        n_ratings = trainset.n_ratings - int(exclude.sum()) if exclude is not None else trainset.n_ratings
+        self.global_mean = trainset.global_mean if exclude is None else float(np.mean(trainset.ratings[~exclude], dtype=np.float64))
+        self.bu = np.zeros(0, dtype=np.float32)
+        self.bi = np.zeros(0, dtype=np.float32)
+        self.pu = np.zeros((0, self.n_factors), dtype=np.float32)
+        self.qi = np.zeros((0, self.n_factors), dtype=np.float32)
+        self._grow(trainset.n_users, trainset.n_films, rng)
+
+        for epoch in range(self.n_epochs):
+            self._epoch(trainset.blocks(rng, exclude), n_ratings, epoch, self.n_epochs)
+
+        return self
+
+    def partial_fit(self, trainset, users, n_epochs=3):
+        '''
+            Takes in TrainingSet object that ratings have been appended to since model was fit, numpy array of codes of users whose
+            ratings should be trained on, and number of epochs to train for.
+            Returns self, warm started from its current parameters and trained only on those users' ratings. Users and films new to
+            training set get parameters initialized as fit would.
+        '''
+
+        rng = np.random.default_rng(self.random_state)
+        self._grow(trainset.n_users, trainset.n_films, rng)
+        (user_codes, film_codes, ratings) = trainset.user_ratings(users)
+
+        def shuffled():
+            order = rng.permutation(len(ratings))
+            yield (user_codes[order], film_codes[order], ratings[order])
+
+        for epoch in range(n_epochs):
+            self._epoch(shuffled(), len(ratings), epoch, n_epochs)
+
+        return self
+
+    def predict(self, users, films, rating_scale=(1, 10)):
+        '''
+            Takes in numpy arrays of user codes and film codes, and tuple of lowest and highest rating.
+            Returns numpy array of estimated ratings, clipped to rating scale. Users and films model doesn't have parameters for only
+            contribute what's known, like surprise.SVD does.
+        '''
+
+        known_users = users < len(self.bu)
+        known_films = films < len(self.bi)
+        both = known_users & known_films
+
+        ests = np.full(len(users), self.global_mean, dtype=np.float32)
+        ests[known_users] += self.bu[users[known_users]]
+        ests[known_films] += self.bi[films[known_films]]
+        ests[both] += np.einsum('ij,ij->i', self.pu[users[both]], self.qi[films[both]])
+
+        return np.clip(ests, *rating_scale)
+
+    def to_surprise(self, trainset, rating_scale=(1, 10)):
+        '''
+            Takes in TrainingSet object model was fit on and tuple of lowest and highest rating.
+            Returns surprise.SVD algorithm holding model's parameters, with a trainset that maps hrefs to the model's ids but holds no
+            ratings, so it pickles, predicts and exports like an algorithm surprise trained.
+        '''
+
+        algo = SVD(n_factors=self.n_factors, n_epochs=self.n_epochs, init_mean=self.init_mean, init_std_dev=self.init_std_dev,
+                   lr_all=self.lr_all, reg_all=self.reg_all, random_state=self.random_state)
+
+        algo.trainset = Trainset(
+            {user: [] for user in range(trainset.n_users)},
+            {film: [] for film in range(trainset.n_films)},
+            trainset.n_users,
+            trainset.n_films,
+            trainset.n_ratings,
+            rating_scale,
+            {link: user for user, link in enumerate(trainset.user_links)},
+            {link: film for film, link in enumerate(trainset.film_links)}
+        )
+        algo.trainset._global_mean = self.global_mean
+        (algo.bu, algo.bi, algo.pu, algo.qi) = (self.bu, self.bi, self.pu, self.qi)
+
+        return algo
+
+    def _grow(self, n_users, n_films, rng):
+        # Adding zero biases and randomly initialized factors for users and films past the ones model has parameters for
+        (new_users, new_films) = (n_users - len(self.bu), n_films - len(self.bi))
+        self.bu = np.concatenate([self.bu, np.zeros(new_users, dtype=np.float32)])
+        self.bi = np.concatenate([self.bi, np.zeros(new_films, dtype=np.float32)])
+        self.pu = np.concatenate([self.pu, rng.normal(self.init_mean, self.init_std_dev, (new_users, self.n_factors)).astype(np.float32)])
+        self.qi = np.concatenate([self.qi, rng.normal(self.init_mean, self.init_std_dev, (new_films, self.n_factors)).astype(np.float32)])
+
+    def _epoch(self, blocks, n_ratings, epoch, n_epochs):
+        # Training on every block of ratings once and recording how it went
+        t0 = time.time()
+        squared_error = 0.0
+
+        for (users, films, ratings) in blocks:
+            for start in range(0, len(ratings), self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                squared_error += self._step(users[batch], films[batch], ratings[batch])
+
+        seconds = time.time() - t0
+        self.epochs.append({
+            'epoch': epoch + 1,
+            'ratings': n_ratings,
+            'seconds': round(seconds, 2),
+            'ratings_per_second': round(n_ratings / max(seconds, 1e-9)),
+            'train_rmse': round(float(np.sqrt(squared_error / max(n_ratings, 1))), 4),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1)
+        })
+        if self.verbose:
+            print(f"Epoch {epoch + 1}/{n_epochs}: {self.epochs[-1]}")
+
+    def _step(self, users, films, ratings):
+        # One minibatch of SGD. Returns summed squared error of batch's ratings before updating.
+        (lr, reg) = (self.lr_all, self.reg_all)
+        (bu, bi, pu, qi) = (self.bu[users], self.bi[films], self.pu[users], self.qi[films])
+
+        errors = ratings - (self.global_mean + bu + bi + np.einsum('ij,ij->i', pu, qi))
+
+        _scatter_add(self.bu, users, lr * (errors - reg * bu))
+        _scatter_add(self.bi, films, lr * (errors - reg * bi))
+        _scatter_add(self.pu, users, lr * (errors[:, None] * qi - reg * pu))
+        _scatter_add(self.qi, films, lr * (errors[:, None] * pu - reg * qi))
+
+        return float(errors @ errors)
+
+
+def _scatter_add(params, ids, updates):
+    # Adding each row of updates to params at its id, summing rows that share an id. Sorting and reducing runs faster than np.add.at.
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    params[sorted_ids[starts]] += np.add.reduceat(updates[order], starts)
+
+
+def drift_report(previous, updated, trainset, first_new, affected, sample_size=100000, top_n=50, n_users=200, seed=None):
+    '''
+        Takes in StreamingSVD objects of model before and after an update, TrainingSet object model was updated on, integer
+        representing position of first rating appended for update, numpy array of codes of users update trained on, number of
+        ratings of other users to compare models on, number of top films to compare per user, and number of those users to compare.
+        Returns dict comparing the models: RMSE of each on the new ratings and on a sample of unaffected users' ratings, how far
+        their predictions for those moved, and how much of unaffected users' top films stayed the same.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    def rmse(model, users, films, ratings):
+        return round(float(np.sqrt(np.mean((model.predict(users, films) - ratings) ** 2))), 4) if len(ratings) else None
+
+    new = (np.asarray(trainset.users[first_new:]), np.asarray(trainset.films[first_new:]), np.asarray(trainset.ratings[first_new:]))
+
+    # Sampling ratings of users update didn't train on from before the update
+    positions = np.sort(rng.choice(first_new, size=min(sample_size, first_new), replace=False)) if first_new else np.empty(0, dtype=np.int64)
+    sample = (trainset.users[positions], trainset.films[positions], trainset.ratings[positions])
+    unaffected = ~np.isin(sample[0], affected)
+    sample = tuple(array[unaffected] for array in sample)
+
+    # Comparing top films of unaffected users among films both models know
+    n_films = len(previous.bi)
+    top_n = min(top_n, n_films - 1)
+    overlaps = []
+    pool = np.setdiff1d(np.arange(len(previous.bu)), affected)
+    for user in rng.choice(pool, size=min(n_users, len(pool)), replace=False) if len(pool) else []:
+        tops = [np.argpartition(-(model.qi[:n_films] @ model.pu[user] + model.bi[:n_films]), top_n)[:top_n] for model in (previous, updated)]
+        overlaps.append(len(np.intersect1d(*tops)) / top_n)
+
+    shift = np.abs(updated.predict(*sample[:2]) - previous.predict(*sample[:2])) if len(sample[2]) else np.zeros(1)
+
+    return {
+        'new_ratings': len(new[2]),
+        'new_users': int(len(updated.bu) - len(previous.bu)),
+        'new_films': int(len(updated.bi) - len(previous.bi)),
+        'affected_users': len(affected),
+        'new_ratings_rmse': {'previous': rmse(previous, *new), 'updated': rmse(updated, *new)},
+        'unaffected_rmse': {'previous': rmse(previous, *sample), 'updated': rmse(updated, *sample)},
+        'unaffected_prediction_shift': {'mean': round(float(shift.mean()), 4), 'max': round(float(shift.max()), 4)},
+        f'unaffected_top_{top_n}_overlap': round(float(np.mean(overlaps)), 4) if overlaps else None
+    }
+
+
+def open_training_set(table_dir='data/ratings', directory='data/train', block_rows=1000000, seed=None):
+    '''
+        Takes in string representing directory of ratings table, string representing directory of training set, number of ratings
+        per block, and optional seed for assigning ratings to blocks.
+        Returns TrainingSet object over every rating in table. Training set is coded from scratch if it hasn't been or table was
+        scraped again from scratch since, and has chunks added to table since it was coded appended otherwise.
+    '''
+
+    if os.path.exists(f'{directory}/meta.npz'):
+        trainset = TrainingSet(directory)
+        if trainset.is_current(table_dir):
+            if len(columnar.read_manifest(table_dir)['chunks']) > trainset.table_chunks:
+                trainset.append(table_dir, block_rows, seed)
+            return trainset
+
+    return TrainingSet.build(table_dir, directory, block_rows, seed)
+
+
+def load_params(path='pickles/svd_params.json'):
+    '''
+        Takes in string representing path of hyperparameters saved by a search (py create_model.py search).
+        Returns dict of SVD hyperparameters the search found best, to pass to StreamingSVD or surprise.SVD. Empty if no search was run.
+    '''
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as fh:
+        return json.load(fh)['params']
@@ -0,0 +1,163 @@
+'''
+    Hyperparameter search for the SVD model. Ratings coded in data/train are memory-mapped by every worker, so they're read from
+    disk once and shared through the page cache rather than copied into each process. Trials train on the same held out split
+    evaluation.py uses, run in a process pool so every core trains a model, and the configuration with the lowest held out RMSE
+    is saved for create_model.py to train with.
+'''
+
+from trainer import TrainingSet, StreamingSVD, open_training_set
+from evaluation import holdout_mask, rating_metrics, ranking_metrics
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import itertools
+import tempfile
+import resource
+import json
+import time
+import os
+
+
+# Values tried for each hyperparameter by grid search
+param_grid = {
+    'n_factors': [50, 100, 200],
+    'n_epochs': [10, 20, 30],
+    'lr_all': [0.002, 0.005, 0.01],
+    'reg_all': [0.02, 0.05, 0.1]
+}
+
+# Each worker's training set and held out ratings, opened once by init_worker rather than sent with every trial
+_trainset = None
+_held = None
+
+
+def grid_trials(grid=param_grid):
+    '''
+        Takes in dict mapping hyperparameter names to lists of values to try.
+        Returns list of dicts of hyperparameters, one for every combination of values.
+    '''
+
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def random_trials(n_trials, seed=None):
+    '''
+        Takes in number of trials and optional seed.
+        Returns list of n_trials dicts of hyperparameters drawn at random, with learning rate and regularization drawn on a log scale
+        since their useful values span orders of magnitude.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    return [
+        {
+            'n_factors': int(rng.choice([25, 50, 100, 150, 200, 300])),
+            'n_epochs': int(rng.integers(10, 41)),
+            'lr_all': round(float(10 ** rng.uniform(-3, np.log10(0.02))), 5),
+            'reg_all': round(float(10 ** rng.uniform(np.log10(0.005), np.log10(0.2))), 5)
+        }
+        for _ in range(n_trials)
+    ]
+
+
+def init_worker(train_dir, held_path):
+    # Mapping training set and held out mask in each worker process. Pages are shared by every process mapping them.
+    global _trainset, _held
+    _trainset = TrainingSet(train_dir)
+    _held = np.load(held_path, mmap_mode='r')
+
+
+def run_trial(params, seed=None):
+    '''
+        Takes in dict of StreamingSVD hyperparameters and optional seed. Run in a worker process set up by init_worker.
+        Returns dict of hyperparameters, held out RMSE, MAE, precision@k and recall@k, how long training and evaluating took, and
+        worker's peak memory.
+    '''
+
+    t0 = time.time()
+    model = StreamingSVD(**params, random_state=seed, verbose=False).fit(_trainset, _held)
+
+    t1 = time.time()
+    (rmse, mae) = rating_metrics(model, _trainset, _held)
+    ranking = ranking_metrics(model, _trainset, _held, seed=seed)
+    t2 = time.time()
+
+    return {
+        'params': params,
+        'rmse': rmse,
+        'mae': mae,
+        'ranking': ranking,
+        'train_rmse': model.epochs[-1]['train_rmse'] if model.epochs else None,
+        'seconds': {'train': round(t1 - t0, 2), 'evaluate': round(t2 - t1, 2)},
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1),
+        'pid': os.getpid()
+    }
+
+
+def search(trials, train_dir='data/train', fraction=0.1, seed=None, workers=None, on_trial=None):
+    '''
+        Takes in list of dicts of hyperparameters to try, string representing directory of training set, fraction of each user's
+        ratings to hold out, optional seed, number of worker processes (one per core if None), and optional function called with
+        each trial's result as it finishes.
+        Returns list of trial results ordered by held out RMSE, best first.
+    '''
+
+    trainset = TrainingSet(train_dir)
+    held = holdout_mask(trainset, 'random', fraction, seed=seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Held out mask is written once and mapped by workers, like the training set
+        held_path = f'{tmp}/held.npy'
+        np.save(held_path, held)
+
+        results = []
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=init_worker, initargs=(train_dir, held_path)) as pool:
+            futures = [pool.submit(run_trial, params, seed) for params in trials]
+            for future in as_completed(futures):
+                results.append(future.result())
+                if on_trial is not None:
+                    on_trial(results[-1])
+
+    return sorted(results, key=lambda result: result['rmse'])
+
+
+def main(mode='grid'):
+    # Searching over hyperparameters on ratings coded in data/train, coding them first if they haven't been or data/ratings has
+    # changed since. Grid search tries every combination in param_grid, random search SEARCH_TRIALS random ones. Runs SEARCH_WORKERS
+    # trials at once (one per core by default) with the holdout from EVAL_HOLDOUT and EVAL_SEED. Every trial is logged to reports/
+    # as it finishes, and the best configuration is saved to pickles/svd_params.json.
+    open_training_set(block_rows=int(os.environ.get('TRAIN_BLOCK_ROWS', 1000000)))
+
+    seed = int(os.environ.get('EVAL_SEED', 0))
+    trials = grid_trials() if mode == 'grid' else random_trials(int(os.environ.get('SEARCH_TRIALS', 20)), seed)
+    workers = int(os.environ.get('SEARCH_WORKERS', 0)) or os.cpu_count()
+    fraction = float(os.environ.get('EVAL_HOLDOUT', 0.1))
+
+    os.makedirs('reports', exist_ok=True)
+    log_path = f'reports/search-{mode}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl'
+    print(f'Running {len(trials)} trials on {workers} workers, logging to {log_path}')
+
+    t0 = time.time()
+    finished = []
+    with open(log_path, 'w') as log:
+        def on_trial(result):
+            finished.append(result)
+            log.write(json.dumps(result) + '\n')
+            log.flush()
+            print(f"Trial {len(finished)}/{len(trials)}: {result['params']} rmse {result['rmse']} mae {result['mae']} "
+                  f"in {result['seconds']['train']}s")
+
+        results = search(trials, fraction=fraction, seed=seed, workers=workers, on_trial=on_trial)
+
+    best = results[0]
+    with open('pickles/svd_params.json', 'w') as fh:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'search': {'mode': mode, 'trials': len(trials), 'workers': workers, 'holdout': fraction, 'seconds': round(time.time() - t0, 2)},
+            'params': best['params'],
+            'rmse': best['rmse'],
+            'mae': best['mae'],
+            'ranking': best['ranking']
+        }, fh, indent=4)
+
+    print(f'Searched {len(trials)} configurations in {(time.time() - t0) / 60:.1f} minutes. Best: {best["params"]} with rmse {best["rmse"]}')
+    print('Saved best configuration to pickles/svd_params.json')